@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+#
+# ibex-bench.py - Runs full -> firstinc -> inc -> lastinc cycles of
+# ibex-backup.py against the innobackupex stand-in in this directory and a
+# synthetic datadir, and reports per-phase timings and peak RSS.
+#
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import collections
+from subprocess import Popen
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+ibexBackup = os.path.join(os.path.dirname(benchDir), 'ibex-backup.py')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--workdir',
+                    help='Directory for the datadir, backups and logs',
+                    type=str,
+                    default='/tmp/ibex-bench'
+                    )
+parser.add_argument('--size',
+                    help='Size of the synthetic datadir in MB',
+                    type=int,
+                    default=256
+                    )
+parser.add_argument('--files',
+                    help='Number of tablespace files in the datadir',
+                    type=int,
+                    default=32
+                    )
+parser.add_argument('--compressibility',
+                    help='Fraction of every file that is zeroes',
+                    type=float,
+                    default=0.5
+                    )
+parser.add_argument('--inc-fraction',
+                    help='Fraction of every file captured by an incremental',
+                    type=float,
+                    default=0.1
+                    )
+parser.add_argument('--lsn-step',
+                    help='LSN advance per backup',
+                    type=int,
+                    default=1000000
+                    )
+parser.add_argument('--cycles',
+                    help='Number of full to lastinc cycles',
+                    type=int,
+                    default=1
+                    )
+parser.add_argument('--incs',
+                    help='Number of plain incrementals per cycle',
+                    type=int,
+                    default=2
+                    )
+parser.add_argument('-s', '--set',
+                    help='Extra setting for settings.conf, e.g. archiveCodec=gzip',
+                    action='append',
+                    default=[]
+                    )
+parser.add_argument('-j', '--json',
+                    help='Also write the results as JSON to this file',
+                    type=str
+                    )
+args = parser.parse_args()
+
+
+def generateDatadir(datadir):
+    # Tablespaces spread over a few schemas, part random and part zeroes
+    # so the compression stages have something realistic to chew on
+    fileSize = args.size * 1024 * 1024 // max(args.files, 1)
+    randomSize = int(fileSize * (1 - args.compressibility))
+    os.makedirs(datadir)
+    with open(os.path.join(datadir, 'ibdata1'), 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+    for index in range(args.files):
+        schema = os.path.join(datadir, 'schema{0}'.format(index % 4))
+        if not os.path.isdir(schema):
+            os.makedirs(schema)
+        with open(os.path.join(schema, 'table{0}.ibd'.format(index)), 'wb') as f:
+            f.write(os.urandom(randomSize))
+            f.write(b'\0' * (fileSize - randomSize))
+
+
+def writeSettings(path):
+    settings = collections.OrderedDict([
+        ('dbuser', 'bench'),
+        ('dbpass', 'bench'),
+        ('baseDir', os.path.join(args.workdir, 'backups')),
+        ('secondaryBaseDir', os.path.join(args.workdir, 'backups', 'unprepared')),
+        ('offsiteBaseDir', os.path.join(args.workdir, 'offsite')),
+        ('logDir', os.path.join(args.workdir, 'log')),
+        ('databaseDir', os.path.join(args.workdir, 'datadir')),
+    ])
+    for extra in args.set:
+        (key, val) = extra.split('=', 1)
+        settings[key.strip()] = val.strip()
+    with open(path, 'w') as f:
+        for (key, val) in settings.items():
+            f.write('{0} = {1}\n'.format(key, val))
+    return settings
+
+
+def runBackup(backupType, settingsFile, logDir, env):
+    started = time.time()
+    proc = Popen([sys.executable, ibexBackup, backupType, '-s', settingsFile], env=env)
+    (pid, status, usage) = os.wait4(proc.pid, 0)
+    elapsed = time.time() - started
+
+    result = {
+        'backupType': backupType,
+        'returncode': os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1,
+        'seconds': round(elapsed, 3),
+        # KB on Linux; covers the script and the children it waited for
+        'peakRssKB': usage.ru_maxrss,
+        'phases': {},
+    }
+    try:
+        with open(os.path.join(logDir, 'stats-' + backupType + '.json'), 'r') as f:
+            stats = json.load(f)
+        if stats.get('started', 0) >= started - 1:
+            result['phases'] = stats['phases']
+    except (IOError, ValueError):
+        pass
+    return result
+
+
+def report(results):
+    print('{0:<10} {1:<14} {2:>9} {3:>9} {4:>10} {5:>9}'.format('run', 'phase', 'seconds', 'cpu', 'MB', 'MB/s'))
+    totals = collections.OrderedDict()
+    for result in results:
+        print('{0:<10} {1:<14} {2:>9.2f} {3:>9} {4:>10} {5:>9}   rc={6} peak RSS {7} MB'.format(
+            result['backupType'], '(total)', result['seconds'], '', '', '',
+            result['returncode'], result['peakRssKB'] // 1024))
+        for (name, phase) in result['phases'].items():
+            size = phase.get('bytes') or 0
+            print('{0:<10} {1:<14} {2:>9.2f} {3:>9.2f} {4:>10.1f} {5:>9}'.format(
+                '', name, phase.get('seconds', 0), phase.get('cpuSeconds', 0),
+                size / 1048576.0, phase.get('mbPerSecond') or ''))
+            totals[name] = totals.get(name, 0) + phase.get('seconds', 0)
+    print('')
+    print('Time per phase over all runs:')
+    for (name, seconds) in totals.items():
+        print('  {0:<14} {1:>9.2f}s'.format(name, seconds))
+
+
+def main():
+    if os.path.exists(args.workdir):
+        shutil.rmtree(args.workdir)
+    settingsFile = os.path.join(args.workdir, 'settings.conf')
+    datadir = os.path.join(args.workdir, 'datadir')
+    generateDatadir(datadir)
+    settings = writeSettings(settingsFile)
+    for directory in [settings['logDir'], settings['offsiteBaseDir']]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    env = dict(os.environ)
+    env['PATH'] = benchDir + os.pathsep + env.get('PATH', '')
+    env['IBEX_BENCH_DATADIR'] = datadir
+    env['IBEX_BENCH_INC_FRACTION'] = str(args.inc_fraction)
+    env['IBEX_BENCH_LSN_STEP'] = str(args.lsn_step)
+
+    results = []
+    for cycle in range(args.cycles):
+        for backupType in ['full', 'firstinc'] + ['inc'] * args.incs + ['lastinc']:
+            # Backups are named by the second they start in
+            time.sleep(1)
+            result = runBackup(backupType, settingsFile, settings['logDir'], env)
+            results.append(result)
+            if result['returncode'] != 0:
+                print('Run "' + backupType + '" failed, see ' + settings['logDir'] + '/ibex-backup.log')
+                report(results)
+                return 1
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+sys.exit(main())
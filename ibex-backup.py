@@ -1,19 +1,65 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 import os
 import errno
 import sys
 import time
 import argparse
 import logging
+import logging.handlers
+import queue
 import shlex
-from subprocess import Popen, PIPE, STDOUT
+import threading
+import json
+import tarfile
+import gzip
+import bz2
+import collections
+import multiprocessing
+import fcntl
+import stat
+import shutil
+import hashlib
+import re
+import signal
+import atexit
+import sqlite3
+import socket
+import zlib
+import fnmatch
+import select
+import ctypes
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
+
+# Optional compression codecs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Optional fast hashing
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# syncfs(2), to flush one filesystem instead of all of them
+try:
+    syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (OSError, AttributeError):
+    syncfs = None
 
 # Read options from command line
 parser = argparse.ArgumentParser()
 parser.add_argument('backupType',
                     help='Type of backup to run',
                     type=str,
-                    choices=['full', 'firstinc', 'inc', 'lastinc'],
+                    choices=['full', 'firstinc', 'inc', 'lastinc', 'prepare', 'restore', 'catalog', 'snapshots', 'status', 'cleanup', 'verify', 'calibrate', 'daemon', 'control'],
                     default='/etc/ibex-backup/settings.conf'
                     )
 parser.add_argument('-o', '--no-offsite',
@@ -24,28 +70,217 @@ parser.add_argument('-n', '--dryrun',
                     help='Dry run',
                     action="store_true"
                     )
+parser.add_argument('-r', '--resume',
+                    help='Resume the last failed backup of this type from its first incomplete phase',
+                    action="store_true"
+                    )
+parser.add_argument('-i', '--id',
+                    help='Backup to show with the catalog command, or backup (or path of a copy) to check with the verify command',
+                    type=str
+                    )
+parser.add_argument('-c', '--command',
+                    help='Command for the daemon with the control type: status, "run <type>" or "cancel <type>"',
+                    type=str,
+                    default='status'
+                    )
+parser.add_argument('-f', '--format',
+                    help='Output of the status command: nagios (plugin output and exit code), json or line (monitor file format)',
+                    choices=['nagios', 'json', 'line'],
+                    default='nagios'
+                    )
+parser.add_argument('-t', '--time',
+                    help='Restore the newest backup taken at or before this time (YYYY-MM-DD_HH-MM-SS or a prefix of it)',
+                    type=str
+                    )
+parser.add_argument('--target',
+                    help='Empty directory to restore into (default: databaseDir)',
+                    type=str
+                    )
+parser.add_argument('--files',
+                    help='Only restore the files matching these comma separated patterns (e.g. "db1/*"), from a sharded archive',
+                    type=str
+                    )
+parser.add_argument('--instance',
+                    help='Instance section of the settings file to run for',
+                    type=str
+                    )
 parser.add_argument('-s', '--settings',
                     help='Settings file',
                     type=str
                     )
 args = parser.parse_args()
 
-# Read settings from file
+# Read settings from file; settings after an [instance] line only apply
+# to that instance
 settings = {}
+instances = collections.OrderedDict()
+section = settings
 with open(args.settings, 'r') as f:
     for line in f:
-        (key, val) = line.split('=')
-        settings[str(key).strip()] = str(val).strip()
+        # Skip blank lines and comments
+        if line.strip() == '' or line.strip().startswith('#'):
+            continue
+        if line.strip().startswith('['):
+            section = instances.setdefault(line.strip().strip('[]').strip(), {})
+            continue
+        (key, val) = line.split('=', 1)
+        section[str(key).strip()] = str(val).strip()
+
+# Locks and budgets shared by all instances live in the global logDir
+globalLogDir = settings.get('logDir', '')
+sharedSettings = dict(settings)
+if args.instance is not None:
+    if args.instance not in instances:
+        sys.exit('Unknown instance "' + args.instance + '"')
+    settings.update(instances[args.instance])
+    if 'logDir' not in instances[args.instance]:
+        settings['logDir'] = globalLogDir + '/' + args.instance
+        if not os.path.isdir(settings['logDir']):
+            os.makedirs(settings['logDir'])
+elif len(instances) > 0:
+    # Only starts and waits for the instances, but needs complete settings
+    # for that like any other run
+    settings = dict(settings, **instances[next(iter(instances))])
+    settings['logDir'] = globalLogDir
+
+# Logging: records are queued by the code that logs them and written by a
+# background thread, to ibex-backup.log and to a JSON lines file for the
+# run in <logDir>/runs; files are flushed whenever the queue runs dry
+timeStamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+currentPhase = None
+logLevel = getattr(logging, settings.get('logLevel', 'debug').upper(), logging.DEBUG)
+logMaxSize = int(settings.get('logMaxSize', '100')) * 1024 * 1024
+logBackups = int(settings.get('logBackups', '5'))
+logRetainDays = int(settings.get('logRetainDays', '30'))
+logListener = None
+# innobackupex lines about single files; dropped with commandOutput = summary
+commandChatter = re.compile(r'(^|\s)\[\d+\]\s|>> log scanned up to')
+summaryOutput = settings.get('commandOutput', 'all') == 'summary'
+
+
+class BatchedFileHandler(logging.FileHandler):
+    # Leaves flushing to the listener, so a burst of records is one write
+
+    def flush(self):
+        pass
+
+    def flushBatch(self):
+        logging.FileHandler.flush(self)
+
+
+class ErrorHandler(logging.StreamHandler):
+    # Problems on stderr for commands that must not touch the log files
+
+    def flushBatch(self):
+        self.flush()
+
+
+class BatchingListener(logging.handlers.QueueListener):
+    # Flushes every handler once there is nothing left to write
+
+    def dequeue(self, block):
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flushBatch()
+        return self.queue.get(block)
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps(collections.OrderedDict([
+            ('time', self.formatTime(record, '%Y-%m-%d %H:%M:%S')),
+            ('level', record.levelname),
+            ('run', getattr(record, 'run', timeStamp)),
+            ('type', getattr(record, 'backupType', args.backupType)),
+            ('instance', args.instance),
+            ('phase', getattr(record, 'phase', None)),
+            ('message', record.getMessage()),
+        ]))
+
+
+def tagRecord(record):
+    # Runs in the thread that logs, where the run and phase are known
+    record.run = timeStamp
+    record.backupType = args.backupType
+    record.phase = currentPhase
+    return True
+
+
+def rotateLog(path):
+    # Size based, once per run: path.1 is the newest old log
+    if not os.path.exists(path) or os.path.getsize(path) < logMaxSize:
+        return
+    for number in range(logBackups - 1, 0, -1):
+        if os.path.exists(path + '.' + str(number)):
+            os.rename(path + '.' + str(number), path + '.' + str(number + 1))
+    if logBackups > 0:
+        os.rename(path, path + '.1')
+    else:
+        os.remove(path)
+
+
+def pruneRunLogs(directory):
+    # Age based: run logs older than logRetainDays go
+    cutoff = time.time() - logRetainDays * 86400
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.jsonl') and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+
+
+def startLogging(forked=False):
+    # Also called in a job forked off by the daemon: the writer thread did
+    # not survive the fork and the job gets a run log of its own
+    global logListener
+    if forked:
+        queueHandler.queue = queue.Queue()
+    # Status queries come every minute or so and are not runs: no log
+    # records, rotation or pruning, only warnings on stderr
+    if args.backupType == 'status':
+        errorHandler = ErrorHandler(sys.stderr)
+        errorHandler.setLevel(logging.WARNING)
+        errorHandler.setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+        logListener = BatchingListener(queueHandler.queue, errorHandler, respect_handler_level=True)
+        logListener.start()
+        return
+    runLogDir = settings['logDir'] + '/runs'
+    try:
+        if not os.path.isdir(runLogDir):
+            os.makedirs(runLogDir)
+        rotateLog(settings['logDir'] + '/ibex-backup.log')
+        pruneRunLogs(runLogDir)
+    except OSError:
+        pass
+    mainHandler = BatchedFileHandler(settings['logDir'] + '/ibex-backup.log')
+    mainHandler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(message)s', '%Y-%m-%d %T'))
+    runHandler = BatchedFileHandler(runLogDir + '/' + timeStamp + '-' + args.backupType + '.jsonl', delay=True)
+    runHandler.setFormatter(JsonFormatter())
+    logListener = BatchingListener(queueHandler.queue, mainHandler, runHandler)
+    logListener.start()
+
+
+def stopLogging():
+    # Write out whatever is still queued
+    if logListener is None:
+        return
+    logListener.stop()
+    for handler in logListener.handlers:
+        handler.flushBatch()
+        handler.close()
+
 
 # Start logging
-logging.basicConfig(
-    filename=settings['logDir'] + '/ibex-backup.log',
-    format='%(asctime)s:%(levelname)s:%(message)s',
-    datefmt='%Y-%m-%d %T',
-    level=logging.DEBUG
-    )
+queueHandler = logging.handlers.QueueHandler(queue.Queue())
+queueHandler.addFilter(tagRecord)
+logging.getLogger().addHandler(queueHandler)
+logging.getLogger().setLevel(logLevel)
+startLogging()
+atexit.register(stopLogging)
 
-logging.info('Starting ' + args.backupType + ' backup run')
+if args.backupType == 'status':
+    logging.debug('Starting status query')
+else:
+    logging.info('Starting ' + args.backupType + ' backup run')
 
 # Check for all settings
 mandatory_settings = [
@@ -61,6 +296,10 @@ for m in mandatory_settings:
     if m not in settings or settings[m] == '':
         logging.critical('Setting "' + m + '" is missing!')
         sys.exit(1)
+    for name in instances:
+        if m not in sharedSettings and m not in instances[name]:
+            logging.critical('Setting "' + m + '" is missing for instance ' + name + '!')
+            sys.exit(1)
 
 # Set defaults
 if 'databaseDir' not in settings or settings['databaseDir'] == '':
@@ -69,6 +308,156 @@ if 'databaseDir' not in settings or settings['databaseDir'] == '':
 if 'socketPath' not in settings or settings['socketPath'] == '':
     settings['socketPath'] = '/var/run/mysqld/mysqld.sock'
 
+if 'streamBackup' not in settings or settings['streamBackup'] == '':
+    settings['streamBackup'] = 'no'
+
+if 'streamFormat' not in settings or settings['streamFormat'] == '':
+    settings['streamFormat'] = 'xbstream'
+
+if 'streamCompressor' not in settings:
+    settings['streamCompressor'] = ''
+
+if 'archiveCodec' not in settings or settings['archiveCodec'] == '':
+    settings['archiveCodec'] = 'bzip2'
+
+if 'archiveLevel' not in settings:
+    settings['archiveLevel'] = ''
+
+if 'archiveWorkers' not in settings or settings['archiveWorkers'] == '':
+    settings['archiveWorkers'] = '0'
+
+if 'archiveChunkSize' not in settings or settings['archiveChunkSize'] == '':
+    settings['archiveChunkSize'] = '4'
+
+if 'archivePartSize' not in settings or settings['archivePartSize'] == '':
+    settings['archivePartSize'] = '0'
+
+if 'copyThreads' not in settings or settings['copyThreads'] == '':
+    settings['copyThreads'] = '0'
+
+if 'copyRangeSize' not in settings or settings['copyRangeSize'] == '':
+    settings['copyRangeSize'] = '256'
+
+if 'transferBwlimit' not in settings or settings['transferBwlimit'] == '':
+    settings['transferBwlimit'] = '5000'
+
+if 'transferChunkSize' not in settings or settings['transferChunkSize'] == '':
+    settings['transferChunkSize'] = '64'
+
+if 'statusHistory' not in settings or settings['statusHistory'] == '':
+    settings['statusHistory'] = '100'
+
+if 'statusMaxAgeFull' not in settings or settings['statusMaxAgeFull'] == '':
+    settings['statusMaxAgeFull'] = '192'
+
+if 'statusMaxAgeInc' not in settings or settings['statusMaxAgeInc'] == '':
+    settings['statusMaxAgeInc'] = '48'
+
+if 'forecastMargin' not in settings or settings['forecastMargin'] == '':
+    settings['forecastMargin'] = '10'
+
+if 'forecastHistory' not in settings or settings['forecastHistory'] == '':
+    settings['forecastHistory'] = '10'
+
+if 'transferRetries' not in settings or settings['transferRetries'] == '':
+    settings['transferRetries'] = '3'
+
+if 'offsiteDestinations' not in settings:
+    settings['offsiteDestinations'] = ''
+
+if 'commandTimeout' not in settings or settings['commandTimeout'] == '':
+    settings['commandTimeout'] = '0'
+
+if 'checksumAlgorithm' not in settings or settings['checksumAlgorithm'] == '':
+    settings['checksumAlgorithm'] = 'sha256'
+
+if 'verifyThreads' not in settings or settings['verifyThreads'] == '':
+    settings['verifyThreads'] = '0'
+
+if 'backupParallel' not in settings or settings['backupParallel'] == '':
+    settings['backupParallel'] = '0'
+
+if 'useMemory' not in settings or settings['useMemory'] == '':
+    settings['useMemory'] = '0'
+
+if 'useMemoryMax' not in settings or settings['useMemoryMax'] == '':
+    settings['useMemoryMax'] = '4096'
+
+if 'useMemoryShare' not in settings or settings['useMemoryShare'] == '':
+    settings['useMemoryShare'] = '25'
+
+if 'calibrateSize' not in settings or settings['calibrateSize'] == '':
+    settings['calibrateSize'] = '256'
+
+if 'secondaryStore' not in settings or settings['secondaryStore'] == '':
+    settings['secondaryStore'] = 'copy'
+
+if 'dedupCodec' not in settings or settings['dedupCodec'] == '':
+    settings['dedupCodec'] = 'gzip'
+
+if 'dedupLevel' not in settings or settings['dedupLevel'] == '':
+    settings['dedupLevel'] = '1'
+
+for backupType in ['Full', 'Firstinc', 'Inc', 'Lastinc', 'Prepare', 'Cleanup', 'Verify']:
+    if 'schedule' + backupType not in settings:
+        settings['schedule' + backupType] = ''
+
+if 'controlSocket' not in settings or settings['controlSocket'] == '':
+    settings['controlSocket'] = settings['logDir'] + '/ibex-backup.sock'
+
+if 'lazyPrepare' not in settings or settings['lazyPrepare'] == '':
+    settings['lazyPrepare'] = 'no'
+if 'snapshots' not in settings or settings['snapshots'] == '':
+    settings['snapshots'] = 'no'
+
+if 'maxParallelJobs' not in settings or settings['maxParallelJobs'] == '':
+    settings['maxParallelJobs'] = '0'
+
+if 'deviceBwlimit' not in settings or settings['deviceBwlimit'] == '':
+    settings['deviceBwlimit'] = '0'
+
+if 'cpuBudget' not in settings or settings['cpuBudget'] == '':
+    settings['cpuBudget'] = '0'
+
+if 'adaptiveThrottle' not in settings or settings['adaptiveThrottle'] == '':
+    settings['adaptiveThrottle'] = 'no'
+
+if 'throttleDevice' not in settings:
+    settings['throttleDevice'] = ''
+
+if 'throttleMin' not in settings or settings['throttleMin'] == '':
+    settings['throttleMin'] = '5000'
+
+if 'throttleMax' not in settings or settings['throttleMax'] == '':
+    settings['throttleMax'] = '100000'
+
+if 'throttleBusy' not in settings or settings['throttleBusy'] == '':
+    settings['throttleBusy'] = '70'
+
+if 'throttleLatency' not in settings or settings['throttleLatency'] == '':
+    settings['throttleLatency'] = '20'
+
+if 'throttleInterval' not in settings or settings['throttleInterval'] == '':
+    settings['throttleInterval'] = '2'
+
+if 'retainDaily' not in settings or settings['retainDaily'] == '':
+    settings['retainDaily'] = '7'
+
+if 'retainWeekly' not in settings or settings['retainWeekly'] == '':
+    settings['retainWeekly'] = '4'
+
+if 'retainMonthly' not in settings or settings['retainMonthly'] == '':
+    settings['retainMonthly'] = '12'
+
+if 'localRetainDaily' not in settings or settings['localRetainDaily'] == '':
+    settings['localRetainDaily'] = '2'
+
+if 'localRetainWeekly' not in settings or settings['localRetainWeekly'] == '':
+    settings['localRetainWeekly'] = '0'
+
+if 'localRetainMonthly' not in settings or settings['localRetainMonthly'] == '':
+    settings['localRetainMonthly'] = '0'
+
 
 # Setup variables
 # ---------------
@@ -77,7 +466,6 @@ if 'socketPath' not in settings or settings['socketPath'] == '':
 dbuser = settings['dbuser']
 dbpass = settings['dbpass']
 # Misc
-timeStamp = time.strftime("%Y-%m-%d_%H-%M-%S")
 socketPath = settings['socketPath']
 # Directories
 databaseDir = settings['databaseDir']
@@ -85,6 +473,175 @@ baseDir = settings['baseDir']
 secondaryBaseDir = settings['secondaryBaseDir']
 offsiteBaseDir = settings['offsiteBaseDir']
 targetDir = baseDir + '/prepared/' + timeStamp
+# Streaming
+streaming = settings['streamBackup'].lower() in ['yes', 'true', '1']
+streamFormat = settings['streamFormat']
+streamCompressor = settings['streamCompressor']
+streamChunkSize = 1024 * 1024
+extractCommands = {
+    'xbstream': 'xbstream -x -C {0}',
+    'tar': 'tar -xif - -C {0}',
+}
+# Apply increments in one batch at lastinc (or prepare) instead of every run
+lazyPrepare = settings['lazyPrepare'].lower() in ['yes', 'true', '1']
+# Point-in-time copies of the prepared full, one per applied backup
+snapshots = settings['snapshots'].lower() in ['yes', 'true', '1']
+snapshotDir = baseDir + '/snapshots'
+# Resource profile: what the host has and what every phase gets of it,
+# unless settings.conf or a calibration run says otherwise
+hostCores = multiprocessing.cpu_count()
+useMemoryMax = int(settings['useMemoryMax'])
+useMemoryShare = int(settings['useMemoryShare'])
+
+
+def readMemory():
+    memory = {'MemTotal': 0, 'MemAvailable': 0}
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields[0].rstrip(':') in memory:
+                    memory[fields[0].rstrip(':')] = int(fields[1]) // 1024
+    except (IOError, ValueError, IndexError):
+        logging.warning('Unable to read /proc/meminfo')
+    return memory
+
+
+def memoryBudget(memory):
+    # Buffer pool for applying logs (MB): half of what is free right now,
+    # never more than useMemoryShare percent of the host or useMemoryMax,
+    # so mysqld keeps what it needs
+    budget = min(memory['MemAvailable'] // 2, memory['MemTotal'] * useMemoryShare // 100, useMemoryMax)
+    return max(budget, 128)
+
+
+hostMemory = readMemory()
+calibrationFile = settings['logDir'] + '/calibration.json'
+calibrated = {}
+try:
+    with open(calibrationFile, 'r') as f:
+        calibrated = json.load(f)
+except (IOError, ValueError):
+    pass
+derived = {
+    # MySQL keeps running during the backup, leave it half the cores
+    'backupParallel': min(max(hostCores // 2, 1), 16),
+    'useMemory': memoryBudget(hostMemory),
+    'copyThreads': min(max(hostCores, 4), 16),
+    'archiveWorkers': hostCores,
+    'verifyThreads': hostCores,
+}
+resourceProfile = collections.OrderedDict([
+    ('cores', hostCores),
+    ('memoryMB', hostMemory['MemTotal']),
+    ('availableMB', hostMemory['MemAvailable']),
+    ('source', {}),
+])
+for key in ['backupParallel', 'useMemory', 'copyThreads', 'archiveWorkers', 'verifyThreads']:
+    if int(settings[key]) > 0:
+        resourceProfile[key] = int(settings[key])
+        resourceProfile['source'][key] = 'settings'
+    elif key in calibrated:
+        resourceProfile[key] = calibrated[key]
+        resourceProfile['source'][key] = 'calibration'
+    else:
+        resourceProfile[key] = derived[key]
+        resourceProfile['source'][key] = 'host'
+# Options for innobackupex; a tar stream is always written by one thread
+backupOptions = ' --parallel={0}'.format(resourceProfile['backupParallel'])
+if streaming and streamFormat == 'tar':
+    backupOptions = ''
+
+
+def sizeMemory():
+    # Free memory changes between the runs of a daemon, so the buffer pool
+    # is worked out again at the start of every run
+    global prepareOptions
+    memory = readMemory()
+    resourceProfile['availableMB'] = memory['MemAvailable']
+    if resourceProfile['source']['useMemory'] == 'host':
+        resourceProfile['useMemory'] = memoryBudget(memory)
+    elif resourceProfile['source']['useMemory'] == 'calibration':
+        resourceProfile['useMemory'] = min(calibrated['useMemory'], memoryBudget(memory))
+    prepareOptions = ' --use-memory={0}M'.format(resourceProfile['useMemory'])
+
+
+sizeMemory()
+logging.debug('Resource profile: ' + json.dumps(resourceProfile))
+calibrateSize = int(settings['calibrateSize']) * 1024 * 1024
+# Archiving
+archiveCodec = settings['archiveCodec']
+archiveLevel = settings['archiveLevel']
+archiveWorkers = resourceProfile['archiveWorkers']
+archiveChunkSize = int(settings['archiveChunkSize']) * 1024 * 1024
+# Split the archive into parts of this size (0 = one tar stream)
+archivePartSize = int(settings['archivePartSize']) * 1024 * 1024
+# Files kept next to an archive
+archiveSidecars = ['.checksums', '.index']
+# Codec: (file extension, default level)
+archiveCodecs = {
+    'gzip': ('gz', 6),
+    'bzip2': ('bz2', 9),
+    'zstd': ('zst', 3),
+    'lz4': ('lz4', 0),
+}
+# Copying
+copyThreads = resourceProfile['copyThreads']
+copyRangeSize = int(settings['copyRangeSize']) * 1024 * 1024
+# Deduplicated secondary store: chunks are cut on page boundaries, at
+# least dedupMinChunk and at most dedupMaxChunk bytes, where the checksum
+# of a page ends in four zero bits (64 KB chunks on average)
+dedupStore = settings['secondaryStore'] == 'dedup'
+dedupChunkDir = secondaryBaseDir + '/store/chunks'
+dedupCodec = settings['dedupCodec']
+dedupLevel = int(settings['dedupLevel'])
+dedupPageSize = 16 * 1024
+dedupMinChunk = 4 * dedupPageSize
+dedupMaxChunk = 64 * dedupPageSize
+dedupMask = 0xF
+# ioctl to clone a whole file on reflink capable filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+# Commands
+commandTimeout = int(settings['commandTimeout'])
+runningProcesses = set()
+cancelled = threading.Event()
+# Offsite transfer
+transferBwlimit = int(settings['transferBwlimit'])
+transferChunkSize = int(settings['transferChunkSize']) * 1024 * 1024
+# Write a number (KB/s, 0 = unlimited) here to change the limit mid transfer
+transferBwlimitFile = settings['logDir'] + '/transfer-bwlimit'
+transferRetries = int(settings['transferRetries'])
+# Chunks kept in memory for destinations that are a little behind
+transferWindow = 4
+# Every offsite destination, offsiteBaseDir first; the others are
+# "<path> [bwlimit=KB/s] [retries=N]", separated by commas
+offsiteDestinations = [{'path': offsiteBaseDir, 'bwlimit': transferBwlimit, 'retries': transferRetries, 'bwlimitFile': transferBwlimitFile}]
+for entry in settings['offsiteDestinations'].split(','):
+    fields = entry.split()
+    if len(fields) == 0:
+        continue
+    destination = {'path': fields[0].rstrip('/'), 'bwlimit': transferBwlimit, 'retries': transferRetries,
+                   'bwlimitFile': transferBwlimitFile + '-' + str(len(offsiteDestinations) + 1)}
+    for field in fields[1:]:
+        (key, separator, value) = field.partition('=')
+        if key not in ['bwlimit', 'retries'] or not value.isdigit():
+            logging.critical('Invalid offsite destination "' + entry.strip() + '"')
+            sys.exit(1)
+        destination[key] = int(value)
+    offsiteDestinations.append(destination)
+# Checksums
+checksumAlgorithm = settings['checksumAlgorithm']
+if checksumAlgorithm not in ['sha256', 'xxh64', 'none']:
+    logging.warning('Unknown checksum algorithm "' + checksumAlgorithm + '", using sha256')
+    checksumAlgorithm = 'sha256'
+elif checksumAlgorithm == 'xxh64' and xxhash is None:
+    logging.warning('xxh64 checksums need the xxhash module, using sha256')
+    checksumAlgorithm = 'sha256'
+verifyThreads = resourceProfile['verifyThreads']
+# Retention, (daily, weekly, monthly) chains to keep
+offsiteRetention = (int(settings['retainDaily']), int(settings['retainWeekly']), int(settings['retainMonthly']))
+localRetention = (int(settings['localRetainDaily']), int(settings['localRetainWeekly']), int(settings['localRetainMonthly']))
+backupIdPattern = re.compile(r'^(\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d)')
 # Directories to check and create
 criticalDirectories = [baseDir, secondaryBaseDir]
 # Symbolic links
@@ -96,11 +653,274 @@ incStatusFile = settings['logDir'] + '/status-inc-backup'
 # Monitor files
 fullMonitorFile = settings['logDir'] + '/monitor-full-backup'
 incMonitorFile = settings['logDir'] + '/monitor-inc-backup'
+# Status store: newest results per monitor, with their durations
+statusFile = settings['logDir'] + '/status.db'
+statusHistory = max(int(settings['statusHistory']), 1)
+# Seconds after which a good result is too old (a backup did not run)
+statusMaxAge = {'full': int(settings['statusMaxAgeFull']) * 3600, 'inc': int(settings['statusMaxAgeInc']) * 3600}
+# Progress files
+fullProgressFile = settings['logDir'] + '/progress-full-backup'
+incProgressFile = settings['logDir'] + '/progress-inc-backup'
+# Run statistics
+statsFile = settings['logDir'] + '/stats-' + args.backupType
+statsHistoryFile = settings['logDir'] + '/stats-history'
+runStats = {
+    'backupType': args.backupType,
+    'timestamp': timeStamp,
+    'status': 'running',
+    'started': time.time(),
+    'phases': collections.OrderedDict(),
+    'profile': resourceProfile,
+}
+# Backup catalog
+catalogFile = baseDir + '/catalog.db'
+catalogConnection = None
+catalogLock = threading.Lock()
+catalogErrors = 0
+# Resuming
+resumed = None
+completedPhases = set()
+# Archive statistics
+archiveStatsFile = settings['logDir'] + '/archive-stats'
+# Space forecast: extra room asked for in percent, earlier runs looked at
+forecastMargin = int(settings['forecastMargin'])
+forecastHistory = int(settings['forecastHistory'])
+# Locks held by this run
+heldLocks = {}
+# Limits shared by all instances (0 = unlimited)
+maxParallelJobs = int(settings['maxParallelJobs'])
+deviceBwlimit = int(settings['deviceBwlimit'])
+cpuBudget = int(settings['cpuBudget'])
+deviceBuckets = {}
+deviceBucketsLock = threading.Lock()
+# Adaptive throttling: KB/s for copy, archive and transfer together,
+# following how busy the database device is
+adaptiveThrottle = settings['adaptiveThrottle'].lower() in ['yes', 'true', '1']
+throttleDevice = settings['throttleDevice']
+throttleMin = int(settings['throttleMin'])
+throttleMax = int(settings['throttleMax'])
+throttleBusy = int(settings['throttleBusy'])
+throttleLatency = float(settings['throttleLatency'])
+throttleInterval = float(settings['throttleInterval'])
+ioThrottle = None
+jobSlot = None
+# Daemon
+controlSocket = settings['controlSocket']
+daemonJobTypes = ['full', 'firstinc', 'inc', 'lastinc', 'prepare', 'cleanup', 'verify']
+daemonStopping = threading.Event()
+weekDays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 
 
 # Functions
 # ---------
 
+def openCatalog():
+    global catalogConnection
+    if catalogConnection is None:
+        # A dry run reads an empty catalog rather than creating one
+        database = catalogFile
+        if args.dryrun and not os.path.exists(catalogFile):
+            database = ':memory:'
+        catalogConnection = sqlite3.connect(database, timeout=60, isolation_level=None, check_same_thread=False)
+        catalogConnection.row_factory = sqlite3.Row
+        catalogConnection.execute('PRAGMA journal_mode=WAL')
+        # Phase checkpoints have to survive a crash
+        catalogConnection.execute('PRAGMA synchronous=FULL')
+        catalogConnection.executescript("""
+            CREATE TABLE IF NOT EXISTS backups (
+                id TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                state TEXT NOT NULL,
+                backup_type TEXT,
+                from_lsn INTEGER,
+                to_lsn INTEGER,
+                prepared_lsn INTEGER,
+                parent TEXT,
+                full_id TEXT,
+                size INTEGER,
+                path TEXT,
+                secondary_path TEXT,
+                archive TEXT,
+                archive_checksum TEXT,
+                offsite_path TEXT,
+                created REAL,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS backups_type ON backups (type, state, id);
+            CREATE INDEX IF NOT EXISTS backups_chain ON backups (full_id, to_lsn);
+            CREATE INDEX IF NOT EXISTS backups_path ON backups (path);
+            CREATE INDEX IF NOT EXISTS backups_secondary_path ON backups (secondary_path);
+            CREATE TABLE IF NOT EXISTS phases (
+                backup_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                state TEXT NOT NULL,
+                started REAL,
+                finished REAL,
+                bytes INTEGER,
+                PRIMARY KEY (backup_id, name)
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                backup_id TEXT PRIMARY KEY,
+                full_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                lsn INTEGER,
+                bytes INTEGER,
+                created REAL
+            );
+            CREATE INDEX IF NOT EXISTS snapshots_chain ON snapshots (full_id, lsn);
+        """)
+    return catalogConnection
+
+
+def catalogQuery(query, parameters=()):
+    # Catalog problems are logged but never fail a backup on their own;
+    # anything that removes or restores data checks catalogHealthy() first
+    global catalogErrors
+    try:
+        with catalogLock:
+            return openCatalog().execute(query, parameters).fetchall()
+    except sqlite3.Error as exception:
+        catalogErrors += 1
+        logging.error('Catalog query failed: ' + str(exception))
+        return []
+
+
+def catalogHealthy(action):
+    # A locked or damaged catalog looks like one without backups; never
+    # decide what to delete, apply or restore from that
+    if catalogErrors == 0:
+        return True
+    logging.critical('Catalog "' + catalogFile + '" could not be read, not ' + action)
+    return False
+
+
+def catalogRecord(backupId, **fields):
+    if args.dryrun:
+        logging.info('Would have cataloged ' + backupId + ': ' + str(fields))
+        return
+    fields['updated'] = time.time()
+    catalogQuery('INSERT OR IGNORE INTO backups (id, type, state, created) VALUES (?, ?, ?, ?)',
+                 (backupId, fields.get('type', 'unknown'), fields.get('state', 'running'), fields['updated']))
+    columns = ', '.join(key + ' = ?' for key in sorted(fields))
+    catalogQuery('UPDATE backups SET ' + columns + ' WHERE id = ?', tuple(fields[key] for key in sorted(fields)) + (backupId,))
+
+
+def catalogPhase(name, phase):
+    if args.dryrun or args.backupType == 'restore':
+        return
+    catalogQuery('INSERT OR REPLACE INTO phases (backup_id, name, state, started, finished, bytes) VALUES (?, ?, ?, ?, ?, ?)',
+                 (timeStamp, name, phase['status'], phase['started'],
+                  phase['started'] + phase['seconds'] if 'seconds' in phase else None, phase.get('bytes')))
+
+
+def catalogBackup(backupId):
+    rows = catalogQuery('SELECT * FROM backups WHERE id = ?', (backupId,))
+    if len(rows) == 0:
+        return None
+    return dict(rows[0])
+
+
+def latestBackup(types, fullId=None):
+    query = 'SELECT * FROM backups WHERE state = ? AND type IN (' + ', '.join('?' * len(types)) + ')'
+    parameters = ['completed'] + list(types)
+    if fullId is not None:
+        query += ' AND full_id = ?'
+        parameters.append(fullId)
+    rows = catalogQuery(query + ' ORDER BY id DESC LIMIT 1', tuple(parameters))
+    if len(rows) == 0:
+        return None
+    return dict(rows[0])
+
+
+def readCheckpoints(path):
+    # xtrabackup_checkpoints as a dict, LSNs as integers
+    checkpoints = {}
+    try:
+        with open(path + '/xtrabackup_checkpoints', 'r') as f:
+            for line in f:
+                if '=' not in line:
+                    continue
+                (key, val) = line.split('=', 1)
+                checkpoints[key.strip()] = val.strip()
+    except IOError:
+        logging.warning('Unable to read "' + path + '/xtrabackup_checkpoints"')
+        return None
+    for key in ['from_lsn', 'to_lsn', 'last_lsn']:
+        if key in checkpoints:
+            checkpoints[key] = int(checkpoints[key])
+    return checkpoints
+
+
+def recordCheckpoints(backupId, path):
+    checkpoints = readCheckpoints(path)
+    if checkpoints is not None and not args.dryrun:
+        catalogRecord(backupId,
+                      backup_type=checkpoints.get('backup_type'),
+                      from_lsn=checkpoints.get('from_lsn'),
+                      to_lsn=checkpoints.get('to_lsn'))
+
+
+def recordPrepared(fullId, path):
+    # The LSN the prepared full has been rolled forward to
+    checkpoints = readCheckpoints(path)
+    if checkpoints is not None and not args.dryrun:
+        catalogRecord(fullId, backup_type=checkpoints.get('backup_type'), prepared_lsn=checkpoints.get('to_lsn'))
+
+
+def syncCatalog():
+    # Backups made before the catalog existed are imported from the
+    # latest_full and latest_inc links the first time they are needed
+    if args.dryrun:
+        return
+    fullId = None
+    for (link, backupType) in [(lastFull, 'full'), (lastInc, 'inc')]:
+        if not os.path.islink(link):
+            continue
+        path = os.path.realpath(link)
+        backupId = os.path.basename(path)
+        if backupType == 'full':
+            fullId = backupId
+        if catalogBackup(backupId) is not None:
+            continue
+        checkpoints = readCheckpoints(path)
+        if checkpoints is None:
+            continue
+        logging.info('Importing "' + path + '" into the catalog')
+        catalogRecord(backupId, type=backupType, state='completed', path=path,
+                      full_id=fullId if backupType == 'inc' else backupId,
+                      backup_type=checkpoints.get('backup_type'),
+                      from_lsn=checkpoints.get('from_lsn'), to_lsn=checkpoints.get('to_lsn'))
+        if backupType == 'full':
+            catalogRecord(backupId, prepared_lsn=checkpoints.get('to_lsn'))
+
+
+def showCatalog(backupId):
+    # Print the catalog, or everything known about one backup
+    if backupId is None:
+        rows = catalogQuery('SELECT * FROM backups ORDER BY id')
+        line = '{0:<20} {1:<9} {2:<10} {3:>14} {4:>14} {5:>14} {6:<20} {7:>10}'
+        print(line.format('id', 'type', 'state', 'from_lsn', 'to_lsn', 'prepared_lsn', 'parent', 'size (MB)'))
+        for row in rows:
+            print(line.format(row['id'], row['type'], row['state'], str(row['from_lsn']), str(row['to_lsn']),
+                              str(row['prepared_lsn'] if row['prepared_lsn'] is not None else ''),
+                              row['parent'] or '', str(row['size'] // 1024 if row['size'] else '')))
+        return 0
+
+    backup = catalogBackup(backupId)
+    if backup is None:
+        print('No backup "' + backupId + '" in the catalog')
+        return 1
+    for key in sorted(backup):
+        print('{0:<17} {1}'.format(key, backup[key]))
+    print('')
+    for phase in catalogQuery('SELECT * FROM phases WHERE backup_id = ? ORDER BY started', (backupId,)):
+        seconds = ''
+        if phase['finished'] is not None:
+            seconds = '{0:.1f}s'.format(phase['finished'] - phase['started'])
+        print('phase {0:<14} {1:<10} {2:>10} {3}'.format(phase['name'], phase['state'], seconds, phase['bytes'] or ''))
+    return 0
+
+
 def checkDirectory(directory):
     if not os.path.exists(directory):
         try:
@@ -115,32 +935,89 @@ def checkDirectory(directory):
         return 0
 
 
-def checkFreeSpace(path, partition, multiplicator):
-    # Check if the path is a path or file
+def treeSize(path):
+    # Disk usage in KB, like "du -s" but without leaving the process
+    total = os.lstat(path).st_blocks * 512
+    directories = [path]
+    while len(directories) > 0:
+        for entry in os.scandir(directories.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            total += entry.stat(follow_symlinks=False).st_blocks * 512
+    return total // 1024
+
+
+def recordBackupSize(path, size=None):
+    # Remember the size of a backup when it is created, so admission
+    # checks never have to walk it again
+    if args.dryrun:
+        return
+
+    path = os.path.realpath(path)
+    try:
+        if size is None:
+            size = treeSize(path)
+    except OSError:
+        logging.warning('Unable to measure "' + path + '"')
+        return
+
+    catalogQuery('UPDATE backups SET size = ? WHERE path = ?', (int(size), path))
+    logging.debug('Recorded size of "' + path + '": ' + str(size) + 'KB')
+
+
+def catalogSize(path):
+    rows = catalogQuery('SELECT size FROM backups WHERE (path = ? OR secondary_path = ?) AND size IS NOT NULL', (path, path))
+    if len(rows) == 0:
+        return None
+    return rows[0]['size']
+
+
+def cachedBackupBytes(path):
+    # Size in bytes of a backup if it is known without measuring it
+    path = os.path.realpath(path)
     if os.path.isfile(path):
-        if not os.path.islink(path):
-            logging.debug(path + ' is a file')
-        else:
-            path = path + '/'
-    else:
-        path = path + '/'
+        return os.stat(path).st_size
+    size = catalogSize(path)
+    if size is None:
+        return None
+    return size * 1024
+
+
+def backupSize(path):
+    # Size in KB of a backup, archive or data directory
+    path = os.path.realpath(path)
+    if os.path.isfile(path):
+        return os.stat(path).st_size // 1024
+
+    size = catalogSize(path)
+    if size is not None:
+        logging.debug('Using cataloged size for "' + path + '"')
+        return size
 
-    # Check the backup size
-    du = Popen(['du', '-s', path], stdout=PIPE)
-    output = du.communicate()[0]
-    backupSize = output.split('\t')[0]
+    logging.debug('No cataloged size for "' + path + '", measuring')
+    return treeSize(path)
 
-    # Check the partition free space
-    df = Popen(['df', '-k', partition], stdout=PIPE)
-    output = df.communicate()[0]
-    partitionFreeSpace = output.split()[-3]
+
+def partitionFreeSpaceKB(partition):
+    # Free space in KB available to us on the partition
+    stat = os.statvfs(partition)
+    return stat.f_bavail * stat.f_frsize // 1024
+
+
+def checkFreeSpace(path, partition, multiplicator, extra=0):
+    try:
+        size = backupSize(path)
+        partitionFreeSpace = partitionFreeSpaceKB(partition)
+    except OSError as exception:
+        logging.critical('Unable to check free space: ' + str(exception))
+        return False
 
     # Calculate the size needed
-    spaceNeeded = int(backupSize) * multiplicator
+    spaceNeeded = int(size * multiplicator) + extra
     logging.debug('Space needed on "' + partition + '" is: ' + str(spaceNeeded) + 'KB')
     logging.debug('Space available is: ' + str(partitionFreeSpace) + 'KB')
 
-    if int(spaceNeeded) >= int(partitionFreeSpace):
+    if spaceNeeded >= partitionFreeSpace:
         logging.debug('Space needed is more then space available')
         return False
     else:
@@ -148,180 +1025,3205 @@ def checkFreeSpace(path, partition, multiplicator):
         return True
 
 
-def setStatus(statFile, status):
+def readHistory(path):
+    # JSON lines written by earlier runs, oldest first
+    entries = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    return entries
 
-    # If dry run, return log statement
-    if args.dryrun:
-        logging.info('Would have written "' + status + '" to "' + statFile + '"')
-        return 0
 
+def median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def growthForecast(points, when):
+    # Least squares line through (time, bytes), evaluated at when; also
+    # returns the slope in bytes per day
+    if len(points) == 0:
+        return (None, 0)
+    # Runs minutes apart say nothing about growth
+    if max(x for (x, y) in points) - min(x for (x, y) in points) < 86400:
+        return (max(points)[1], 0)
+    meanX = sum(x for (x, y) in points) / float(len(points))
+    meanY = sum(y for (x, y) in points) / float(len(points))
+    spread = sum((x - meanX) ** 2 for (x, y) in points)
+    if spread == 0:
+        return (int(meanY), 0)
+    slope = sum((x - meanX) * (y - meanY) for (x, y) in points) / spread
+    return (max(int(meanY + slope * (when - meanX)), 0), slope * 86400)
+
+
+def mountPoint(path):
+    # Filesystem a location is on; it does not have to exist yet
+    path = os.path.realpath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    device = os.stat(path).st_dev
+    while os.path.dirname(path) != path and os.stat(os.path.dirname(path)).st_dev == device:
+        path = os.path.dirname(path)
+    return path
+
+
+def forecastRun(backupType, copy=True):
+    # Bytes each location gets, peak use per filesystem and duration of the
+    # next run, from the sizes, growth, compression ratios and phase times
+    # of earlier runs
+    now = time.time()
+    types = ['full'] if backupType == 'full' else ['firstinc', 'inc', 'lastinc']
+    rows = catalogQuery('SELECT size, created FROM backups WHERE state = ? AND size IS NOT NULL AND type IN (' + ', '.join('?' * len(types)) + ') ORDER BY id DESC LIMIT ?',
+                        tuple(['completed'] + types + [forecastHistory]))
+    (backupBytes, growth) = growthForecast([(row['created'], row['size'] * 1024) for row in rows], now)
+    if backupBytes is not None:
+        basis = '{0} earlier backups, {1:+.0f} MB/day'.format(len(rows), growth / 1048576)
+    else:
+        # Nothing to go on yet: the size of what is being backed up
+        source = lastFull if backupType == 'full' else lastInc
+        if not os.path.islink(source):
+            source = databaseDir
+        backupBytes = int(backupSize(source) * 1024 * 1.5)
+        basis = 'no history, 1.5 times the size of "' + source + '"'
+
+    # Location: bytes written there
+    writes = collections.OrderedDict()
+    writes[targetDir] = backupBytes
+    if copy:
+        writes[secondaryPath()] = backupBytes
+    if snapshots:
+        snapshotRows = catalogQuery('SELECT bytes FROM snapshots WHERE bytes IS NOT NULL ORDER BY backup_id DESC LIMIT ?', (forecastHistory,))
+        if backupType == 'full' or len(snapshotRows) == 0:
+            writes[snapshotDir] = backupBytes
+        else:
+            writes[snapshotDir] = int(median([row['bytes'] for row in snapshotRows]))
+    ratio = None
+    if backupType == 'lastinc':
+        ratios = [entry['ratio'] for entry in readHistory(archiveStatsFile)[-forecastHistory:]
+                  if entry.get('codec') == archiveCodec and entry.get('ratio')]
+        ratio = median(ratios) or 1.0
+        fullBytes = backupSize(lastFull) * 1024 if os.path.exists(lastFull) else backupBytes
+        archiveBytes = int(fullBytes / ratio)
+        fullId = os.path.basename(os.path.realpath(lastFull))
+        tarball = "{0}/prepared/{1}.tar.{2}".format(baseDir, fullId, archiveCodecs.get(archiveCodec, (archiveCodec, None))[0])
+        writes[tarball] = archiveBytes
+        # Compressed parts wait next to the archive until they are appended
+        if archivePartSize > 0:
+            writes[tarball + '.part-*'] = min(archiveStagingKB() * 1024, archiveBytes)
+        for target in offsiteDestinations:
+            if args.no_offsite and not remoteDestination(target['path']):
+                writes[target['path']] = archiveBytes
+    offsite = [target['path'] for target in offsiteDestinations]
+
+    # Everything on one filesystem adds up; the archive is only removed
+    # once it is offsite, so nothing is freed before the peak
+    devices = collections.OrderedDict()
+    for (location, size) in writes.items():
+        parent = mountPoint(location)
+        device = os.stat(parent).st_dev
+        if device not in devices:
+            devices[device] = {'path': parent, 'locations': [], 'bytes': 0, 'offsite': True,
+                               'free': partitionFreeSpaceKB(parent) * 1024}
+        devices[device]['locations'].append(location)
+        devices[device]['offsite'] = devices[device]['offsite'] and location in offsite
+        devices[device]['bytes'] += size
+    for device in devices.values():
+        device['needed'] = int(device['bytes'] * (1 + forecastMargin / 100.0))
+
+    # Median phase times of earlier runs of this type, scaled by the growth
+    history = [entry for entry in readHistory(statsHistoryFile) if entry.get('backupType') == backupType and entry.get('status') == 'ok'][-forecastHistory:]
+    previous = median([entry['phases']['backup']['bytes'] for entry in history
+                       if entry['phases'].get('backup', {}).get('bytes')])
+    scale = backupBytes / float(previous) if previous else 1.0
+    phases = collections.OrderedDict()
+    for entry in history:
+        for name in entry['phases']:
+            phases[name] = None
+    for name in list(phases):
+        seconds = median([entry['phases'][name]['seconds'] for entry in history
+                          if name in entry['phases'] and 'seconds' in entry['phases'][name]])
+        # Phases that never finished in earlier runs have no time to go on
+        if seconds is None:
+            del phases[name]
+        else:
+            phases[name] = round(seconds * scale, 1)
+
+    return {
+        'basis': basis,
+        'backupBytes': backupBytes,
+        'growthPerDay': int(growth),
+        'ratio': ratio,
+        'writes': writes,
+        'devices': list(devices.values()),
+        'phases': phases,
+        'seconds': round(sum(phases.values()), 1) if phases else None,
+    }
+
+
+def showForecast(forecast):
+    # The plan for the next run, printed by a dry run and logged otherwise
+    lines = ['Plan for {0} backup ({1}{2}):'.format(args.backupType, forecast['basis'],
+                                                   ', {0} ratio {1:.2f}'.format(archiveCodec, forecast['ratio']) if forecast['ratio'] else '')]
+    for (location, size) in forecast['writes'].items():
+        lines.append('  write {0:>10} MB to "{1}"'.format(size // 1048576, location))
+    for device in forecast['devices']:
+        lines.append('  peak  {0:>10} MB on "{1}" ({2}% margin), {3} MB free: {4}'.format(
+            device['needed'] // 1048576, device['path'], forecastMargin, device['free'] // 1048576,
+            'ok' if device['needed'] < device['free'] else 'NOT ENOUGH'))
+    for (name, seconds) in forecast['phases'].items():
+        lines.append('  {0:<12} {1:>8.1f}s'.format(name, seconds))
+    if forecast['seconds'] is not None:
+        lines.append('  {0:<12} {1:>8.1f}s'.format('total', forecast['seconds']))
+    else:
+        lines.append('  no earlier ' + args.backupType + ' runs to predict the duration from')
+    for line in lines:
+        logging.info(line)
+        if args.dryrun:
+            print(line)
+
+
+def admitRun(backupType):
+    # Whether the run fits, and whether it fits with the secondary copy
     try:
-        with open(statFile, 'w') as stat:
-            logging.debug('Writing "' + status + '" to "' + statFile + '"')
-            stat.write(status)
-        return
-    except IOError:
-        logging.critical('Unable to write "' + statFile + '" file')
-        sys.exit(1)
+        forecast = forecastRun(backupType)
+    except OSError as exception:
+        logging.critical('Unable to forecast the space needed: ' + str(exception))
+        return (False, False)
+    showForecast(forecast)
+    runStats['forecast'] = {'backupBytes': forecast['backupBytes'], 'seconds': forecast['seconds'],
+                            'peak': dict((device['path'], device['needed']) for device in forecast['devices'])}
+    # A full offsite destination only fails the transfer, at the end
+    for device in forecast['devices']:
+        if device['offsite'] and device['needed'] >= device['free']:
+            logging.warning('Not enough free space forecast for the offsite copy on "' + device['path'] + '"')
+    local = [device for device in forecast['devices'] if not device['offsite']]
+    if all(device['needed'] < device['free'] for device in local):
+        return (True, True)
 
+    # Without the copy to the secondary location
+    local = [device for device in forecastRun(backupType, copy=False)['devices'] if not device['offsite']]
+    return (all(device['needed'] < device['free'] for device in local), False)
 
-def setMonitor(monitorFile, status, message):
 
-    # Get a current timestamp
-    currentTimeStamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+def newDigest(algorithm=None):
+    if (algorithm or checksumAlgorithm) == 'xxh64':
+        return xxhash.xxh64()
+    return hashlib.sha256()
 
-    # Line to be put in to monitor file
-    line = "{0}:{1}:{2}\n".format(currentTimeStamp, status.upper(), message)
 
-    # If dry run, return log statement
+class Manifest(object):
+    # Digests of every chunkSize piece of every file in a backup, filled in
+    # by whatever reads the data anyway (copy threads, stream, archive)
+
+    def __init__(self, chunkSize):
+        self.chunkSize = chunkSize
+        self.files = {}
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def declare(self, name, size):
+        with self.lock:
+            self.files.setdefault(name, {'size': size, 'chunks': {}})['size'] = size
+
+    def add(self, name, index, digest):
+        with self.lock:
+            self.files.setdefault(name, {'size': None, 'chunks': {}})['chunks'][index] = digest
+
+    def save(self, manifestFile):
+        files = {}
+        for name in self.files:
+            chunks = self.files[name]['chunks']
+            files[name] = {'size': self.files[name]['size'], 'chunks': [chunks[index] for index in sorted(chunks)]}
+        # One digest for the whole backup, over the per-file digests
+        digest = newDigest()
+        digest.update(json.dumps(files, sort_keys=True).encode('utf-8'))
+        writeManifest(manifestFile, {
+            'algorithm': checksumAlgorithm,
+            'chunkSize': self.chunkSize,
+            'created': time.strftime("%Y-%m-%d_%H-%M-%S"),
+            'digest': digest.hexdigest(),
+            'files': files,
+        })
+        logging.debug('Wrote checksums of ' + str(len(files)) + ' file(s) to "' + manifestFile + '"')
+
+
+class ChunkHasher(object):
+    # Digests a sequential stream of one file chunk by chunk
+
+    def __init__(self, manifest, name):
+        self.manifest = manifest
+        self.name = name
+        self.index = 0
+        self.filled = 0
+        self.size = 0
+        self.digest = newDigest()
+
+    def update(self, data):
+        self.size += len(data)
+        view = memoryview(data)
+        while len(view) > 0:
+            piece = view[:self.manifest.chunkSize - self.filled]
+            self.digest.update(piece)
+            self.filled += len(piece)
+            view = view[len(piece):]
+            if self.filled == self.manifest.chunkSize:
+                self.manifest.add(self.name, self.index, self.digest.hexdigest())
+                self.index += 1
+                self.filled = 0
+                self.digest = newDigest()
+
+    def finish(self):
+        if self.filled > 0:
+            self.manifest.add(self.name, self.index, self.digest.hexdigest())
+        self.manifest.declare(self.name, self.size)
+
+
+def hashTarStream(stream, manifest):
+    # Digest every file in a tar stream as it goes past
+    try:
+        with tarfile.open(fileobj=stream, mode='r|', ignore_zeros=True) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                hasher = ChunkHasher(manifest, os.path.normpath(member.name))
+                data = tar.extractfile(member)
+                while True:
+                    chunk = data.read(streamChunkSize)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                hasher.finish()
+    except (IOError, OSError, tarfile.TarError) as exception:
+        logging.error('Unable to checksum stream: ' + str(exception))
+        manifest.failed = True
+        # Keep reading so the stream is not blocked
+        while stream.read(streamChunkSize):
+            pass
+
+
+def hashChunk(path, offset, length, algorithm):
+    digest = newDigest(algorithm)
+    end = offset + length
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while offset < end:
+            data = os.pread(fd, min(streamChunkSize * 4, end - offset), offset)
+            if not data:
+                break
+            digest.update(data)
+            offset += len(data)
+    finally:
+        os.close(fd)
+    return digest.hexdigest()
+
+
+def manifestChunks(path, files, chunkSize):
+    # (name, file, index, offset, length) for every chunk of a copy
+    chunks = []
+    for name in sorted(files):
+        if os.path.isdir(path):
+            filePath = os.path.join(path, name)
+        else:
+            filePath = os.path.join(os.path.dirname(path), name)
+        size = files[name]['size']
+        for index in range(len(files[name]['chunks'])):
+            chunks.append((name, filePath, index, index * chunkSize, min(chunkSize, size - index * chunkSize)))
+    return chunks
+
+
+def writeChecksums(path):
+    # Checksums for a copy that was not read on the way in, hashed in parallel
     if args.dryrun:
-        logging.info('Would have written "' + line + '" to "' + monitorFile + '"')
+        logging.info('Would have written checksums of "' + path + '"')
         return 0
 
+    manifest = Manifest(copyRangeSize)
+    files = {}
     try:
-        with open(monitorFile, 'a') as f:
-            logging.debug('Writing "' + line + '" to "' + monitorFile + '"')
-            f.write(line)
-        return
-    except IOError:
-        logging.critical('Unable to write to"' + monitorFile + '"')
-        sys.exit(1)
+        if os.path.isdir(path):
+            for (root, dirs, names) in os.walk(path):
+                for name in names:
+                    filePath = os.path.join(root, name)
+                    if not os.path.islink(filePath):
+                        files[os.path.relpath(filePath, path)] = {'size': os.path.getsize(filePath)}
+        else:
+            files[os.path.basename(path)] = {'size': os.path.getsize(path)}
+        for name in files:
+            manifest.declare(name, files[name]['size'])
+            files[name]['chunks'] = [None] * ((files[name]['size'] + copyRangeSize - 1) // copyRangeSize)
+        chunks = manifestChunks(path, files, copyRangeSize)
+        with ThreadPoolExecutor(max_workers=verifyThreads) as pool:
+            digests = pool.map(lambda chunk: hashChunk(chunk[1], chunk[3], chunk[4], checksumAlgorithm), chunks)
+            for (chunk, digest) in zip(chunks, digests):
+                manifest.add(chunk[0], chunk[2], digest)
+        manifest.save(path + '.checksums')
+    except (IOError, OSError) as exception:
+        logging.error('Unable to checksum "' + path + '": ' + str(exception))
+        return 1
+    return 0
+
+
+def verifyCopy(path):
+    # Check a copy against the checksums written when it was made; every
+    # chunk is read once, spread over verifyThreads threads
+    manifestFile = path + '.checksums'
+    try:
+        with open(manifestFile, 'r') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        logging.critical('Unable to read "' + manifestFile + '"')
+        return 1
+
+    started = time.time()
+    files = manifest['files']
+    errors = []
+    for name in sorted(files):
+        filePath = os.path.join(path, name) if os.path.isdir(path) else os.path.join(os.path.dirname(path), name)
+        try:
+            size = os.path.getsize(filePath)
+        except OSError:
+            errors.append(name + ' is missing')
+            continue
+        if size != files[name]['size']:
+            errors.append(name + ' has size ' + str(size) + ', expected ' + str(files[name]['size']))
+
+    chunks = [chunk for chunk in manifestChunks(path, files, manifest['chunkSize']) if os.path.exists(chunk[1])]
+    verifiedBytes = 0
+    with ThreadPoolExecutor(max_workers=verifyThreads) as pool:
+        digests = pool.map(lambda chunk: hashChunk(chunk[1], chunk[3], chunk[4], manifest['algorithm']), chunks)
+        for (chunk, digest) in zip(chunks, digests):
+            verifiedBytes += chunk[4]
+            if digest != files[chunk[0]]['chunks'][chunk[2]]:
+                errors.append(chunk[0] + ' chunk ' + str(chunk[2]) + ' does not match')
+
+    elapsed = max(time.time() - started, 0.001)
+    if len(errors) > 0:
+        for error in errors:
+            logging.error('"' + path + '": ' + error)
+        msg = 'FAILED {0}: {1} error(s)'.format(path, len(errors))
+        logging.critical(msg)
+        print(msg)
+        return 1
+    msg = 'OK {0}: {1} file(s), {2} MB in {3:.1f}s ({4:.1f} MB/s)'.format(
+        path, len(files), verifiedBytes // 1048576, elapsed, verifiedBytes / 1048576.0 / elapsed)
+    logging.info(msg)
+    print(msg)
+    return 0
+
+
+def verifyBackups(target):
+    # Verify one copy, every copy of one backup, or by default every copy
+    # in the current chain
+    if target is not None and '/' in target:
+        if target.endswith('.dedup'):
+            return verifyDedup(target)
+        return verifyCopy(target.rstrip('/'))
+
+    if target is not None:
+        backups = [catalogBackup(target)]
+        if backups[0] is None:
+            logging.critical('No backup "' + target + '" in the catalog')
+            return 1
+    else:
+        syncCatalog()
+        full = latestBackup(['full'])
+        if full is None:
+            logging.critical('No full backup in the catalog')
+            return 1
+        backups = [dict(row) for row in catalogQuery('SELECT * FROM backups WHERE full_id = ? ORDER BY id', (full['id'],))]
+
+    paths = []
+    for backup in backups:
+        for column in ['secondary_path', 'archive', 'offsite_path']:
+            if backup[column] and (os.path.exists(backup[column] + '.checksums') or backup[column].endswith('.dedup')):
+                paths.append(backup[column])
+    if len(paths) == 0:
+        logging.critical('Nothing with checksums to verify')
+        return 1
+
+    status = 0
+    for path in paths:
+        if path.endswith('.dedup'):
+            if verifyDedup(path) == 1:
+                status = 1
+        elif verifyCopy(path) == 1:
+            status = 1
+    return status
+
+
+def copyRange(source, destination, offset, length, manifest=None, name=None, index=None):
+    # Copy one byte range inside the kernel where possible; the checksum is
+    # taken from the copy afterwards, while it is still in the page cache,
+    # so checksumming never forces the copy through user space
+    copyBytes(source, destination, offset, length)
+    if manifest is not None:
+        manifest.add(name, index, hashChunk(destination, offset, length, checksumAlgorithm))
+
+
+def hashRange(manifest, name, index, path, offset, length):
+    # Checksum of a range that was reflinked instead of copied
+    manifest.add(name, index, hashChunk(path, offset, length, checksumAlgorithm))
+
+
+def copyBytes(source, destination, offset, length):
+    if cancelled.is_set():
+        raise OSError(errno.ECANCELED, 'Run has been cancelled')
+    bucket = deviceBucket(os.path.dirname(destination))
+    # Small steps only when they have to be paced
+    step = streamChunkSize * 4 if bucket.limited() else length
+    with open(source, 'rb') as src:
+        with open(destination, 'r+b') as dst:
+            end = offset + length
+            try:
+                while offset < end:
+                    bucket.consume(min(step, end - offset))
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), min(step, end - offset), offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                return
+            except OSError as exception:
+                # Cross filesystem copies on older kernels and the like
+                if exception.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+                    raise
+            dst.seek(offset)
+            while offset < end:
+                bucket.consume(min(step, end - offset))
+                copied = os.sendfile(dst.fileno(), src.fileno(), offset, min(step, end - offset))
+                if copied == 0:
+                    break
+                offset += copied
+
+
+def cloneFile(source, destination):
+    # Share the extents with the source where the filesystem allows it
+    try:
+        with open(source, 'rb') as src:
+            with open(destination, 'r+b') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def copyMetadata(source, destination):
+    info = os.lstat(source)
+    try:
+        os.chown(destination, info.st_uid, info.st_gid, follow_symlinks=False)
+    except OSError as exception:
+        if exception.errno != errno.EPERM:
+            raise
+    if not stat.S_ISLNK(info.st_mode):
+        os.chmod(destination, stat.S_IMODE(info.st_mode))
+    os.utime(destination, ns=(info.st_atime_ns, info.st_mtime_ns), follow_symlinks=False)
+
+
+def copyTree(source, destination, checksums=True):
+    # Parallel replacement for "cp -a source destination"; big files are
+    # split into ranges so a single huge table can use every thread
+
+    # If dry run, return log statement
+    if args.dryrun:
+        logging.info('Would have copied "' + source + '" to "' + destination + '"')
+        return 0
+
+    logging.debug('Copying "' + source + '" to "' + destination + '" using ' + str(copyThreads) + ' threads')
+    started = time.time()
+    copiedBytes = 0
+    cloned = 0
+    directories = []
+    files = []
+    # Hardlinks are kept, as cp -a does: (st_dev, st_ino) -> first copy
+    inodes = {}
+    links = []
+    manifest = None
+    if checksumAlgorithm != 'none' and checksums:
+        manifest = Manifest(copyRangeSize)
+    try:
+        # Recreate the directory structure and links, collect the files
+        for (root, dirs, names) in os.walk(source):
+            target = os.path.normpath(os.path.join(destination, os.path.relpath(root, source)))
+            os.mkdir(target)
+            directories.append((root, target))
+            for name in dirs + names:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                    files.append((path, os.path.join(target, name), None))
+                elif name in names:
+                    info = os.lstat(path)
+                    if info.st_nlink > 1 and (info.st_dev, info.st_ino) in inodes:
+                        links.append((inodes[(info.st_dev, info.st_ino)], os.path.join(target, name)))
+                        continue
+                    if info.st_nlink > 1:
+                        inodes[(info.st_dev, info.st_ino)] = os.path.join(target, name)
+                    files.append((path, os.path.join(target, name), info.st_size))
+
+        with ThreadPoolExecutor(max_workers=copyThreads) as pool:
+            ranges = []
+            reflink = True
+            for (path, target, size) in files:
+                if size is None:
+                    continue
+                with open(target, 'wb') as f:
+                    f.truncate(size)
+                name = os.path.relpath(path, source)
+                if manifest is not None:
+                    manifest.declare(name, size)
+                if size == 0:
+                    continue
+                # Stop trying as soon as the filesystem turns out not to support it
+                if reflink and cloneFile(path, target):
+                    cloned += 1
+                    # Reading the clone is the only cost of its checksum
+                    if manifest is not None:
+                        for offset in range(0, size, copyRangeSize):
+                            ranges.append(pool.submit(hashRange, manifest, name, offset // copyRangeSize,
+                                                      target, offset, min(copyRangeSize, size - offset)))
+                    continue
+                reflink = False
+                for offset in range(0, size, copyRangeSize):
+                    ranges.append(pool.submit(copyRange, path, target, offset, min(copyRangeSize, size - offset),
+                                              manifest, name, offset // copyRangeSize))
+                copiedBytes += size
+            for future in ranges:
+                future.result()
+        for (first, target) in links:
+            os.link(first, target)
+
+        # Metadata last, so writing the files does not touch the mtimes
+        for (path, target, size) in files:
+            copyMetadata(path, target)
+        for (root, target) in reversed(directories):
+            copyMetadata(root, target)
+        if manifest is not None:
+            manifest.save(os.path.normpath(destination) + '.checksums')
+    except (IOError, OSError) as exception:
+        logging.critical('Copy failed: ' + str(exception))
+        return 1
+
+    elapsed = max(time.time() - started, 0.001)
+    logging.info('Copied {0} MB in {1:.1f}s ({2:.1f} MB/s), {3} file(s) reflinked'.format(
+        copiedBytes // 1048576, elapsed, copiedBytes / 1048576.0 / elapsed, cloned))
+    return 0
+
+
+def secondaryPath():
+    # Where this run's unprepared copy goes on the secondary location
+    if dedupStore:
+        return secondaryBaseDir + '/' + timeStamp + '.dedup'
+    return secondaryBaseDir + '/' + timeStamp
+
+
+def storeSecondary(source, destination):
+    if dedupStore:
+        return dedupTree(source, destination)
+    return copyTree(source, destination)
+
+
+def chunkPath(digest, codec):
+    return dedupChunkDir + '/' + digest[:2] + '/' + digest + '.' + archiveCodecs[codec][0]
+
+
+def dedupRange(path, offset, length):
+    # Cut a range of a file into chunks on page boundaries chosen by the
+    # page contents, so an insert only changes the chunks around it, and
+    # store every chunk not yet in the store
+    chunks = []
+    written = 0
+    bucket = deviceBucket(secondaryBaseDir)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunk = bytearray()
+        end = offset + length
+        while offset < end:
+            if cancelled.is_set():
+                raise IOError(errno.ECANCELED, 'Run has been cancelled')
+            data = os.pread(fd, min(streamChunkSize * 4, end - offset), offset)
+            if not data:
+                break
+            offset += len(data)
+            bucket.consume(len(data))
+            for start in range(0, len(data), dedupPageSize):
+                page = data[start:start + dedupPageSize]
+                chunk += page
+                if len(chunk) >= dedupMaxChunk or (len(chunk) >= dedupMinChunk and zlib.crc32(page) & dedupMask == 0):
+                    written += storeChunk(bytes(chunk), chunks)
+                    chunk = bytearray()
+        if len(chunk) > 0:
+            written += storeChunk(bytes(chunk), chunks)
+    finally:
+        os.close(fd)
+    return (chunks, written)
+
+
+def storeChunk(data, chunks):
+    digest = hashlib.sha256(data).hexdigest()
+    chunks.append([digest, len(data)])
+    path = chunkPath(digest, dedupCodec)
+    if os.path.exists(path):
+        return 0
+    compressed = compressChunk(dedupCodec, dedupLevel, data)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique name, two threads may store the same chunk at once
+    temporary = path + '.' + str(threading.get_ident()) + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(compressed)
+    os.rename(temporary, path)
+    return len(compressed)
+
+
+def dedupTree(source, index):
+    # Store a backup in the deduplicated store; index lists what is needed
+    # to rebuild the tree
+    if args.dryrun:
+        logging.info('Would have stored "' + source + '" in "' + dedupChunkDir + '"')
+        return 0
+    if not checkCodec(dedupCodec):
+        return 1
+
+    logging.debug('Storing "' + source + '" in "' + dedupChunkDir + '" using ' + str(copyThreads) + ' threads')
+    started = time.time()
+    tree = {'codec': dedupCodec, 'created': time.strftime("%Y-%m-%d_%H-%M-%S"), 'dirs': [], 'links': [], 'files': []}
+    try:
+        ranges = []
+        with ThreadPoolExecutor(max_workers=copyThreads) as pool:
+            for (root, dirs, names) in os.walk(source):
+                info = os.stat(root)
+                tree['dirs'].append([os.path.relpath(root, source), stat.S_IMODE(info.st_mode), info.st_mtime, info.st_uid, info.st_gid])
+                for name in dirs + names:
+                    path = os.path.join(root, name)
+                    if os.path.islink(path):
+                        info = os.lstat(path)
+                        tree['links'].append([os.path.relpath(path, source), os.readlink(path), info.st_uid, info.st_gid])
+                    elif name in names:
+                        info = os.stat(path)
+                        entry = [os.path.relpath(path, source), stat.S_IMODE(info.st_mode), info.st_mtime, info.st_size, [],
+                                 info.st_uid, info.st_gid]
+                        tree['files'].append(entry)
+                        # Large files are cut into ranges like a copy
+                        for offset in range(0, info.st_size, copyRangeSize):
+                            ranges.append((entry, pool.submit(dedupRange, path, offset, min(copyRangeSize, info.st_size - offset))))
+            written = 0
+            for (entry, future) in ranges:
+                (chunks, rangeWritten) = future.result()
+                entry[4].extend(chunks)
+                written += rangeWritten
+        writeManifest(index, tree)
+    except (IOError, OSError) as exception:
+        logging.critical('Storing "' + source + '" failed: ' + str(exception))
+        return 1
+
+    total = sum(entry[3] for entry in tree['files'])
+    elapsed = max(time.time() - started, 0.001)
+    logging.info('Stored {0} MB as {1} MB of new chunks in {2:.1f}s ({3:.1f} MB/s)'.format(
+        total // 1048576, written // 1048576, elapsed, total / 1048576.0 / elapsed))
+    return 0
+
+
+def readChunk(digest, length, codec):
+    with open(chunkPath(digest, codec), 'rb') as f:
+        data = decompressChunk(codec, f.read())
+    if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+        raise IOError(errno.EIO, 'Chunk ' + digest + ' is damaged')
+    return data
+
+
+def rebuildTree(index, destination):
+    # Recreate a stored backup from its index, files in parallel
+    logging.debug('Rebuilding "' + index + '" in "' + destination + '"')
+    try:
+        with open(index, 'r') as f:
+            tree = json.load(f)
+        writeTree(tree, destination)
+    except (IOError, OSError, ValueError) as exception:
+        logging.critical('Rebuilding "' + index + '" failed: ' + str(exception))
+        return 1
+    return 0
+
+
+def restoreOwner(path, owner):
+    # Same as copyMetadata: the owner is kept where the user may set it.
+    # Indexes written before owners were recorded have none.
+    if len(owner) < 2:
+        return
+    try:
+        os.chown(path, owner[0], owner[1], follow_symlinks=False)
+    except OSError as exception:
+        if exception.errno != errno.EPERM:
+            raise
+
+
+def writeTree(tree, destination):
+    codec = tree['codec']
+    for entry in tree['dirs']:
+        target = os.path.normpath(os.path.join(destination, entry[0]))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+    for entry in tree['links']:
+        target = os.path.join(destination, entry[0])
+        os.symlink(entry[1], target)
+        restoreOwner(target, entry[2:4])
+
+    def rebuildFile(entry):
+        (name, mode, mtime, size, chunks) = entry[:5]
+        target = os.path.join(destination, name)
+        with open(target, 'wb') as f:
+            for (digest, length) in chunks:
+                f.write(readChunk(digest, length, codec))
+        restoreOwner(target, entry[5:7])
+        os.chmod(target, mode)
+        os.utime(target, (mtime, mtime))
+
+    with ThreadPoolExecutor(max_workers=copyThreads) as pool:
+        list(pool.map(rebuildFile, tree['files']))
+    for entry in reversed(tree['dirs']):
+        (name, mode, mtime) = entry[:3]
+        target = os.path.normpath(os.path.join(destination, name))
+        restoreOwner(target, entry[3:5])
+        os.chmod(target, mode)
+        os.utime(target, (mtime, mtime))
+
+
+def verifyDedup(index):
+    # Every chunk a stored backup needs must be there and hash correctly
+    started = time.time()
+    try:
+        with open(index, 'r') as f:
+            tree = json.load(f)
+    except (IOError, ValueError):
+        logging.critical('Unable to read "' + index + '"')
+        return 1
+    chunks = {}
+    for entry in tree['files']:
+        for (digest, length) in entry[4]:
+            chunks[digest] = length
+
+    def check(item):
+        try:
+            readChunk(item[0], item[1], tree['codec'])
+            return None
+        except (IOError, OSError, ValueError) as exception:
+            return str(exception)
+
+    with ThreadPoolExecutor(max_workers=verifyThreads) as pool:
+        errors = [error for error in pool.map(check, chunks.items()) if error is not None]
+    elapsed = max(time.time() - started, 0.001)
+    if len(errors) > 0:
+        for error in errors:
+            logging.error('"' + index + '": ' + error)
+        msg = 'FAILED {0}: {1} error(s)'.format(index, len(errors))
+        logging.critical(msg)
+        print(msg)
+        return 1
+    msg = 'OK {0}: {1} file(s), {2} chunk(s) in {3:.1f}s'.format(index, len(tree['files']), len(chunks), elapsed)
+    logging.info(msg)
+    print(msg)
+    return 0
+
+
+def collectChunks(removed):
+    # Chunks no longer referenced by any index once removed is gone
+    referenced = set()
+    for entry in os.scandir(secondaryBaseDir):
+        if entry.name.endswith('.dedup') and entry.path not in removed:
+            with open(entry.path, 'r') as f:
+                tree = json.load(f)
+            extension = archiveCodecs[tree['codec']][0]
+            for fileEntry in tree['files']:
+                for (digest, length) in fileEntry[4]:
+                    referenced.add(digest + '.' + extension)
+    garbage = []
+    if not os.path.isdir(dedupChunkDir):
+        return garbage
+    for directory in os.scandir(dedupChunkDir):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            if entry.name not in referenced:
+                garbage.append((entry.path, entry.stat().st_size))
+    return garbage
+
+
+def collectGarbage(removed):
+    # A backup being stored has chunks no index refers to yet, so the
+    # store is only collected while no backup can run
+    if not os.path.isdir(dedupChunkDir):
+        return 0
+    if not acquireLock('full'):
+        logging.info('Full backup running, not collecting unreferenced chunks')
+        return 0
+    if not acquireLock('inc'):
+        heldLocks.pop('full').close()
+        logging.info('Incremental backup running, not collecting unreferenced chunks')
+        return 0
+    try:
+        garbage = collectChunks(removed)
+        reclaimed = sum(size for (path, size) in garbage)
+        if args.dryrun:
+            msg = 'Would have removed {0} unreferenced chunks ({1} MB)'.format(len(garbage), reclaimed // (1024 * 1024))
+            logging.info(msg)
+            print(msg)
+            return 0
+        with ThreadPoolExecutor(max_workers=copyThreads) as executor:
+            results = list(executor.map(lambda chunk: removeEntry(chunk[0], False), garbage))
+    finally:
+        heldLocks.pop('inc').close()
+        heldLocks.pop('full').close()
+    logging.info('Removed ' + str(len(garbage)) + ' unreferenced chunks (' + str(reclaimed // (1024 * 1024)) + 'MB)')
+    if 1 in results:
+        return 1
+    return 0
+
+
+class TokenBucket(object):
+    # Bandwidth limiter in KB/s (0 = unlimited) that picks up changes to
+    # an override file while it runs; whatever passes also has to pass
+    # the parent limiter
+
+    def __init__(self, rate, overrideFile=None, device=None, parent=None):
+        self.rate = rate
+        self.overrideFile = overrideFile
+        self.device = device
+        self.parent = parent
+        self.registration = None
+        self.overrideMtime = None
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        self.checked = time.time()
+        if self.device is not None:
+            # Split the device budget evenly between the jobs using it
+            rate = deviceBwlimit // max(deviceJobs(self.device) + (1 if self.registration is None else 0), 1)
+            if rate != self.rate:
+                logging.debug('Device share changed from ' + str(self.rate) + ' to ' + str(rate) + ' KB/s')
+                self.rate = rate
+            return
+        try:
+            mtime = os.stat(self.overrideFile).st_mtime
+            if mtime != self.overrideMtime:
+                self.overrideMtime = mtime
+                with open(self.overrideFile, 'r') as f:
+                    rate = int(f.read().strip())
+                if rate != self.rate:
+                    logging.info('Bandwidth limit changed from ' + str(self.rate) + ' to ' + str(rate) + ' KB/s')
+                    self.rate = rate
+        except (IOError, OSError, ValueError):
+            pass
+
+    def limited(self):
+        return self.rate > 0 or (self.parent is not None and self.parent.limited())
+
+    def consume(self, amount):
+        if self.parent is not None:
+            self.parent.consume(amount)
+        with self.lock:
+            if (self.overrideFile is not None or self.device is not None) and time.time() - self.checked > 1:
+                self.refresh()
+            if self.rate <= 0:
+                return
+            now = time.time()
+            # Allow at most one second worth of burst
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate * 1024, self.rate * 1024)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens < 0:
+                wait = -self.tokens / (self.rate * 1024)
+                time.sleep(wait)
+                self.updated += wait
+                self.tokens = 0
+
+
+def chunkDigest(data):
+    if xxhash is not None:
+        return xxhash.xxh64(data).hexdigest()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def writeManifest(manifestFile, manifest):
+    with open(manifestFile + '.tmp', 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(manifestFile + '.tmp', manifestFile)
+
+
+def remoteDestination(path):
+    # host:path destinations are handed to rsync
+    return ':' in path.split('/')[0]
+
+
+class SharedReader(object):
+    # Reads a file once for several destinations. The reader stays one
+    # chunk ahead of the fastest destination and keeps the last
+    # transferWindow chunks it needed; a destination that falls further
+    # behind reads the chunks it missed itself, so a slow destination
+    # never holds up the others
+
+    def __init__(self, path, chunks):
+        self.path = path
+        self.chunks = chunks
+        self.cache = {}
+        self.wanted = 0
+        self.next = 0
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            with open(self.path, 'rb') as src:
+                while True:
+                    with self.condition:
+                        while not self.closed and self.next >= min(self.wanted + 1, self.chunks):
+                            self.condition.wait()
+                        if self.closed:
+                            return
+                        # Skip ahead when the fastest destination resumed
+                        # past the chunks read so far
+                        index = max(self.next, self.wanted - 1)
+                    data = os.pread(src.fileno(), transferChunkSize, index * transferChunkSize)
+                    with self.condition:
+                        self.cache[index] = data
+                        self.next = index + 1
+                        for old in [key for key in self.cache if key < self.wanted - transferWindow]:
+                            del self.cache[old]
+                        self.condition.notify_all()
+        except (IOError, OSError) as exception:
+            with self.condition:
+                self.error = exception
+                self.condition.notify_all()
+
+    def get(self, index, fd):
+        # The chunk, and whether it had to be read again
+        with self.condition:
+            if index + 1 > self.wanted:
+                self.wanted = index + 1
+                self.condition.notify_all()
+            while index not in self.cache and index >= self.next and self.error is None and not self.closed:
+                self.condition.wait()
+            data = self.cache.get(index)
+            lag = self.next - index
+        if data is None:
+            data = os.pread(fd, transferChunkSize, index * transferChunkSize)
+            return (data, True, lag)
+        return (data, False, lag)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+def sendFile(reader, source, target, stats):
+    # Chunked, resumable and verified copy of a file to one locally mounted
+    # offsite destination; completed chunks are tracked in a manifest next
+    # to the partial file so an interrupted transfer picks up where it stopped
+    destinationDir = target['path']
+    destination = destinationDir + '/' + os.path.basename(source)
+    partialFile = destination + '.partial'
+    manifestFile = destination + '.manifest'
+
+    # Remote destinations read the file themselves
+    if remoteDestination(destinationDir):
+        sources = source
+        for sidecar in archiveSidecars:
+            if os.path.exists(source + sidecar):
+                sources += ' ' + source + sidecar
+        command = "rsync -rl --partial --append-verify --bwlimit={0} {1} {2}/".format(target['bwlimit'], sources, destinationDir)
+        status = runCommand(command)
+        if status == 0:
+            stats['bytes'] = os.path.getsize(source)
+        return status
+
+    # If dry run, return log statement
+    if args.dryrun:
+        logging.info('Would have transferred "' + source + '" to "' + destination + '"')
+        return 0
+
+    try:
+        info = os.stat(source)
+        chunks = (info.st_size + transferChunkSize - 1) // transferChunkSize
+        # Done in an earlier run that failed on another destination
+        if (not os.path.exists(manifestFile) and os.path.isfile(destination)
+                and os.path.getsize(destination) == info.st_size):
+            logging.info('"' + destination + '" already transferred')
+            return 0
+
+        manifest = None
+        try:
+            with open(manifestFile, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+        if (manifest is not None and os.path.exists(partialFile)
+                and manifest['size'] == info.st_size
+                and manifest['mtime'] == info.st_mtime
+                and manifest['chunkSize'] == transferChunkSize):
+            logging.info('Resuming transfer to "' + destinationDir + '", ' + str(len(manifest['chunks'])) + ' of ' + str(chunks) + ' chunks already done')
+        else:
+            manifest = {
+                'source': source,
+                'size': info.st_size,
+                'mtime': info.st_mtime,
+                'chunkSize': transferChunkSize,
+                'chunks': {},
+            }
+            with open(partialFile, 'wb') as f:
+                f.truncate(info.st_size)
+            writeManifest(manifestFile, manifest)
+
+        bucket = TokenBucket(target['bwlimit'], target['bwlimitFile'])
+        share = deviceBucket(destinationDir)
+        with open(source, 'rb') as src:
+            fd = os.open(partialFile, os.O_RDWR)
+            try:
+                for index in range(chunks):
+                    if str(index) in manifest['chunks']:
+                        continue
+                    if cancelled.is_set():
+                        logging.critical('Transfer to "' + destinationDir + '" cancelled, ' + str(len(manifest['chunks'])) + ' of ' + str(chunks) + ' chunks done')
+                        return 1
+                    offset = index * transferChunkSize
+                    (data, reread, lag) = reader.get(index, src.fileno())
+                    if reread:
+                        stats['rereadBytes'] += len(data)
+                    stats['maxLagBytes'] = max(stats['maxLagBytes'], lag * transferChunkSize)
+                    digest = chunkDigest(data)
+                    bucket.consume(len(data))
+                    share.consume(len(data))
+                    os.pwrite(fd, data, offset)
+                    os.fdatasync(fd)
+
+                    # Read the chunk back from the destination, not the cache
+                    os.posix_fadvise(fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+                    if chunkDigest(os.pread(fd, len(data), offset)) != digest:
+                        logging.error('Chunk ' + str(index) + ' of "' + destination + '" failed verification')
+                        return 1
+
+                    manifest['chunks'][str(index)] = digest
+                    writeManifest(manifestFile, manifest)
+                    stats['bytes'] += len(data)
+            finally:
+                os.close(fd)
+
+        os.rename(partialFile, destination)
+        os.remove(manifestFile)
+        # Checksums and index go along so the offsite copy stands on its own
+        for sidecar in archiveSidecars:
+            if os.path.exists(source + sidecar):
+                shutil.copyfile(source + sidecar, destination + sidecar)
+    except (IOError, OSError) as exception:
+        logging.error('Transfer to "' + destinationDir + '" failed: ' + str(exception))
+        return 1
+    return 0
+
+
+def retryTransfer(reader, source, target, stats):
+    # A failed attempt continues from the manifest after a growing pause
+    status = 1
+    for attempt in range(target['retries'] + 1):
+        if attempt > 0:
+            wait = min(5 * 2 ** (attempt - 1), 300)
+            logging.warning('Retrying transfer to "{0}" in {1}s (attempt {2} of {3})'.format(target['path'], wait, attempt + 1, target['retries'] + 1))
+            if cancelled.wait(wait):
+                break
+        stats['attempts'] = attempt + 1
+        try:
+            status = sendFile(reader, source, target, stats)
+        except Exception as exception:
+            # Not worth retrying, but the other destinations carry on
+            logging.critical('Transfer to "' + target['path'] + '" failed: ' + repr(exception))
+            status = 1
+            break
+        if status == 0 or cancelled.is_set():
+            break
+    stats['status'] = 'completed' if status == 0 else 'failed'
+    stats['seconds'] = round(time.time() - stats['started'], 2)
+    stats['mbPerSecond'] = round(stats['bytes'] / 1048576.0 / max(stats['seconds'], 0.001), 2)
+    stats['finished'] = time.time()
+    if status == 0 and stats['bytes'] > 0:
+        logging.info('Transferred {0} MB to "{1}" in {2:.1f}s ({3:.1f} MB/s, {4} MB read again)'.format(
+            stats['bytes'] // 1048576, target['path'], stats['seconds'], stats['mbPerSecond'], stats['rereadBytes'] // 1048576))
+    elif status == 1:
+        logging.critical('Transfer to "' + target['path'] + '" failed after ' + str(stats['attempts']) + ' attempt(s)')
+    return status
+
+
+def transferFile(source, destinations):
+    # Send a file to every offsite destination at once from a single read,
+    # each destination with its own bandwidth limit and retries
+    chunks = 0
+    if not args.dryrun:
+        chunks = (os.path.getsize(source) + transferChunkSize - 1) // transferChunkSize
+    reader = SharedReader(source, chunks)
+    transfers = collections.OrderedDict()
+    reachable = []
+    results = []
+    for target in destinations:
+        transfers[target['path']] = {'status': 'running', 'started': time.time(), 'attempts': 0, 'bytes': 0,
+                                     'rereadBytes': 0, 'maxLagBytes': 0}
+        # A missing mount fails its own destination, not the others
+        if not remoteDestination(target['path']) and not os.path.isdir(target['path']):
+            logging.critical('Offsite destination "' + target['path'] + '" does not exist, not transferring to it')
+            transfers[target['path']].update(status='failed', seconds=0, mbPerSecond=0)
+            results.append(1)
+        else:
+            reachable.append(target)
+    try:
+        if len(reachable) > 0:
+            with ThreadPoolExecutor(max_workers=len(reachable)) as executor:
+                results += list(executor.map(lambda target: retryTransfer(reader, source, target, transfers[target['path']]), reachable))
+    finally:
+        reader.close()
+
+    # How long each completed destination finished after the fastest one
+    finished = [stats['finished'] for stats in transfers.values() if stats['status'] == 'completed']
+    for stats in transfers.values():
+        stats['lagSeconds'] = None
+        if stats['status'] == 'completed':
+            stats['lagSeconds'] = round(stats['finished'] - min(finished), 2)
+        stats.pop('finished', None)
+    runStats['transfers'] = transfers
+    if 1 in results:
+        return 1
+    return 0
+
+
+def cpuTime():
+    # CPU seconds used by this process and its finished children
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def startPhase(name):
+    global currentPhase
+    currentPhase = name
+    runStats['phases'][name] = {
+        'status': 'running',
+        'started': time.time(),
+        'cpuStarted': cpuTime(),
+    }
+    catalogPhase(name, runStats['phases'][name])
+    writeStats()
+
+
+def syncBackups():
+    # Flush the filesystems backups are written to, and only those: a
+    # global sync would also flush the datadir under a running MySQL
+    paths = [baseDir, secondaryBaseDir] + [target['path'] for target in offsiteDestinations if not remoteDestination(target['path'])]
+    synced = set()
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            device = os.fstat(fd).st_dev
+            if device in synced:
+                continue
+            synced.add(device)
+            if syncfs is None:
+                os.sync()
+                return
+            if syncfs(fd) != 0:
+                logging.warning('Unable to sync "' + path + '": ' + os.strerror(ctypes.get_errno()))
+        finally:
+            os.close(fd)
+
+
+def endPhase(name, status, bytesProcessed=None):
+    # Record how a phase went; returns status so it can wrap a step
+    global currentPhase
+    phase = runStats['phases'][name]
+    if status == 0 and not args.dryrun and args.backupType != 'restore':
+        # What the phase wrote must be on disk before it is checkpointed
+        syncBackups()
+    phase['seconds'] = round(time.time() - phase['started'], 3)
+    phase['cpuSeconds'] = round(cpuTime() - phase.pop('cpuStarted'), 3)
+    phase['bytes'] = bytesProcessed
+    phase['mbPerSecond'] = None
+    if bytesProcessed is not None:
+        phase['mbPerSecond'] = round(bytesProcessed / 1048576.0 / max(phase['seconds'], 0.001), 2)
+    phase['status'] = 'completed' if status == 0 else 'failed'
+    logging.debug('Phase "' + name + '" ' + phase['status'] + ' in ' + str(phase['seconds']) + 's')
+    catalogPhase(name, phase)
+    writeStats()
+    currentPhase = None
+    return status
+
+
+def prometheusStats():
+    lines = []
+    labels = '{{type="{0}",phase="{1}"}}'
+    metrics = [
+        ('ibex_backup_phase_seconds', 'seconds', 'Wall time of the phase in the last run'),
+        ('ibex_backup_phase_cpu_seconds', 'cpuSeconds', 'CPU time of the phase in the last run'),
+        ('ibex_backup_phase_bytes', 'bytes', 'Bytes processed by the phase in the last run'),
+        ('ibex_backup_phase_mb_per_second', 'mbPerSecond', 'Throughput of the phase in the last run'),
+    ]
+    for (metric, key, description) in metrics:
+        lines.append('# HELP ' + metric + ' ' + description)
+        lines.append('# TYPE ' + metric + ' gauge')
+        for (name, phase) in runStats['phases'].items():
+            if phase.get(key) is not None:
+                lines.append(metric + labels.format(args.backupType, name) + ' ' + str(phase[key]))
+    lines.append('# HELP ibex_backup_phase_success Whether the phase completed in the last run')
+    lines.append('# TYPE ibex_backup_phase_success gauge')
+    for (name, phase) in runStats['phases'].items():
+        lines.append('ibex_backup_phase_success' + labels.format(args.backupType, name) + ' ' + str(int(phase['status'] == 'completed')))
+    lines.append('# HELP ibex_backup_profile Resources given to the phases in the last run')
+    lines.append('# TYPE ibex_backup_profile gauge')
+    for key in ['backupParallel', 'useMemory', 'copyThreads', 'archiveWorkers', 'verifyThreads']:
+        lines.append('ibex_backup_profile{{type="{0}",setting="{1}",source="{2}"}} {3}'.format(
+            args.backupType, key, resourceProfile['source'][key], resourceProfile[key]))
+    transferMetrics = [
+        ('ibex_backup_transfer_success', 'status', 'Whether the transfer to the destination completed in the last run'),
+        ('ibex_backup_transfer_bytes', 'bytes', 'Bytes sent to the destination in the last run'),
+        ('ibex_backup_transfer_mb_per_second', 'mbPerSecond', 'Throughput to the destination in the last run'),
+        ('ibex_backup_transfer_lag_seconds', 'lagSeconds', 'How long after the fastest destination this one finished'),
+    ]
+    for (metric, key, description) in transferMetrics:
+        if 'transfers' not in runStats:
+            break
+        lines.append('# HELP ' + metric + ' ' + description)
+        lines.append('# TYPE ' + metric + ' gauge')
+        for (path, transfer) in runStats['transfers'].items():
+            if transfer[key] is None:
+                continue
+            value = int(transfer[key] == 'completed') if key == 'status' else transfer[key]
+            lines.append(metric + '{{type="{0}",destination="{1}"}} {2}'.format(args.backupType, path, value))
+    lines.append('# HELP ibex_backup_last_run_timestamp_seconds Start of the last run')
+    lines.append('# TYPE ibex_backup_last_run_timestamp_seconds gauge')
+    lines.append('ibex_backup_last_run_timestamp_seconds{{type="{0}"}} {1}'.format(args.backupType, int(runStats['started'])))
+    lines.append('# HELP ibex_backup_last_run_success Whether the last run succeeded')
+    lines.append('# TYPE ibex_backup_last_run_success gauge')
+    lines.append('ibex_backup_last_run_success{{type="{0}"}} {1}'.format(args.backupType, int(runStats['status'] == 'ok')))
+    return '\n'.join(lines) + '\n'
+
+
+def writeStats():
+    # Latest run as JSON and as a Prometheus textfile collector file
+    if args.dryrun:
+        return
+    try:
+        with open(statsFile + '.json.tmp', 'w') as f:
+            json.dump(runStats, f, indent=1)
+        os.rename(statsFile + '.json.tmp', statsFile + '.json')
+        with open(statsFile + '.prom.tmp', 'w') as f:
+            f.write(prometheusStats())
+        os.rename(statsFile + '.prom.tmp', statsFile + '.prom')
+    except (IOError, OSError):
+        logging.warning('Unable to write "' + statsFile + '" files')
+
+
+def finishRun():
+    # Called on exit; runs that never started a phase are not recorded
+    if len(runStats['phases']) == 0 or args.dryrun:
+        return
+    for phase in runStats['phases'].values():
+        if phase['status'] == 'running':
+            phase['status'] = 'failed'
+    failed = [p for p in runStats['phases'].values() if p['status'] != 'completed']
+    if runStats['status'] == 'failed':
+        failed.append(runStats)
+    runStats['status'] = 'failed' if failed else 'ok'
+    runStats['seconds'] = round(time.time() - runStats['started'], 3)
+    writeStats()
+    if catalogBackup(timeStamp) is not None:
+        catalogRecord(timeStamp, state='failed' if failed else 'completed')
+    try:
+        with open(statsHistoryFile, 'a') as f:
+            f.write(json.dumps(runStats) + '\n')
+    except IOError:
+        logging.warning('Unable to write to "' + statsHistoryFile + '"')
+
+
+def setStatus(statFile, status):
+
+    # If dry run, return log statement
+    if args.dryrun:
+        logging.info('Would have written "' + status + '" to "' + statFile + '"')
+        return 0
+
+    try:
+        with open(statFile, 'w') as stat:
+            logging.debug('Writing "' + status + '" to "' + statFile + '"')
+            stat.write(status)
+        return
+    except IOError:
+        logging.critical('Unable to write "' + statFile + '" file')
+        sys.exit(1)
+
+
+def setMonitor(monitorFile, status, message):
+
+    # Get a current timestamp
+    currentTimeStamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+
+    # Line to be put in to monitor file
+    line = "{0}:{1}:{2}\n".format(currentTimeStamp, status.upper(), message)
+
+    # A critical result fails the run even if every phase that ran completed
+    if status == 'critical':
+        runStats['status'] = 'failed'
+
+    # If dry run, return log statement
+    if args.dryrun:
+        logging.info('Would have written "' + line + '" to "' + monitorFile + '"')
+        return 0
+
+    recordResult('full' if monitorFile == fullMonitorFile else 'inc', status, message)
+    try:
+        with open(monitorFile, 'a') as f:
+            logging.debug('Writing "' + line + '" to "' + monitorFile + '"')
+            f.write(line)
+        trimMonitor(monitorFile)
+        return
+    except (IOError, OSError):
+        logging.critical('Unable to write to"' + monitorFile + '"')
+        sys.exit(1)
+
+
+def openStatusStore():
+    connection = sqlite3.connect(statusFile, timeout=10, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            monitor TEXT NOT NULL,
+            type TEXT NOT NULL,
+            run TEXT,
+            status TEXT NOT NULL,
+            message TEXT,
+            time REAL NOT NULL,
+            seconds REAL
+        );
+        CREATE INDEX IF NOT EXISTS results_monitor ON results (monitor, id);
+    """)
+    return connection
+
+
+def recordResult(monitor, status, message):
+    # Newest result per monitor plus the statusHistory before it; the
+    # index makes the newest one a single lookup however often it is asked
+    try:
+        connection = openStatusStore()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('INSERT INTO results (monitor, type, run, status, message, time, seconds) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (monitor, args.backupType, timeStamp, status, message, time.time(), round(time.time() - runStats['started'], 1)))
+            connection.execute('DELETE FROM results WHERE monitor = ? AND id < (SELECT id FROM results WHERE monitor = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                               (monitor, monitor, statusHistory - 1))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+    except sqlite3.Error as exception:
+        logging.warning('Unable to record the result in "' + statusFile + '": ' + str(exception))
+
+
+def trimMonitor(monitorFile):
+    # Older checks still read the monitor files, the last statusHistory
+    # lines are all they need
+    with open(monitorFile, 'r') as f:
+        lines = f.readlines()
+    if len(lines) <= statusHistory:
+        return
+    with open(monitorFile + '.tmp', 'w') as f:
+        f.writelines(lines[-statusHistory:])
+    os.rename(monitorFile + '.tmp', monitorFile)
+
+
+def showStatus(outputFormat):
+    # Latest result per monitor for monitoring agents: Nagios plugin output
+    # and exit code, JSON with the recent history, or monitor file lines
+    now = time.time()
+    severity = ['ok', 'warning', 'critical', 'unknown']
+    results = collections.OrderedDict([('full', []), ('inc', [])])
+    try:
+        # Nothing has been recorded yet; a poll does not create the store
+        connection = None
+        if os.path.exists(statusFile):
+            connection = openStatusStore()
+        try:
+            for monitor in results:
+                if connection is None:
+                    continue
+                rows = connection.execute('SELECT * FROM results WHERE monitor = ? ORDER BY id DESC LIMIT ?',
+                                          (monitor, 10 if outputFormat == 'json' else 1)).fetchall()
+                results[monitor] = [dict(row) for row in rows]
+        finally:
+            if connection is not None:
+                connection.close()
+    except sqlite3.Error as exception:
+        print('IBEX-BACKUP UNKNOWN - unable to read "' + statusFile + '": ' + str(exception))
+        return 3
+
+    if outputFormat == 'line':
+        for (monitor, rows) in results.items():
+            for row in rows:
+                print('{0}:{1}:{2}'.format(time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(row['time'])), row['status'].upper(), row['message']))
+        return 0
+
+    states = collections.OrderedDict()
+    for (monitor, rows) in results.items():
+        if len(rows) == 0:
+            states[monitor] = {'state': 'unknown', 'message': 'no result yet'}
+            continue
+        state = dict(rows[0])
+        state['age'] = int(now - state['time'])
+        state['state'] = state['status'] if state['status'] in severity else 'unknown'
+        if state['age'] > statusMaxAge[monitor] and state['state'] == 'ok':
+            state['state'] = 'warning'
+            state['message'] += ', but it is older than ' + str(statusMaxAge[monitor] // 3600) + ' hours'
+        state['history'] = rows
+        states[monitor] = state
+
+    worst = severity[worstStatus([severity.index(state['state']) for state in states.values()])]
+    if outputFormat == 'json':
+        print(json.dumps(states, indent=1))
+        return 0
+
+    summaries = []
+    perfdata = []
+    for (monitor, state) in states.items():
+        if 'age' not in state:
+            summaries.append(monitor + ': ' + state['message'])
+            continue
+        summaries.append('{0}: {1} {2} ago in {3} ({4})'.format(monitor, state['status'].upper(), formatAge(state['age']),
+                                                                 formatAge(state['seconds'] or 0), state['message']))
+        perfdata.append("{0}_age={1}s {0}_duration={2}s".format(monitor, state['age'], int(state['seconds'] or 0)))
+    print('IBEX-BACKUP ' + worst.upper() + ' - ' + '; '.join(summaries) + (' | ' + ' '.join(perfdata) if perfdata else ''))
+    return severity.index(worst)
+
+
+def worstStatus(codes):
+    # Nagios states of several checks in one: critical, then warning, then
+    # unknown, then ok; anything else a check exits with counts as unknown
+    ranks = {2: 3, 1: 2, 3: 1, 0: 0}
+    return max([code if code in ranks else 3 for code in codes] or [3], key=lambda code: ranks[code])
+
+
+def showInstanceStatus(outputs):
+    # One answer for all instances, from the answer each one gave
+    if args.format == 'json':
+        combined = collections.OrderedDict()
+        for (name, output, code) in outputs:
+            try:
+                combined[name] = json.loads(output)
+            except ValueError:
+                combined[name] = {'state': 'unknown', 'message': output.strip()}
+        print(json.dumps(combined, indent=1))
+        return 0
+    if args.format == 'line':
+        for (name, output, code) in outputs:
+            for line in output.splitlines():
+                fields = line.split(':', 2)
+                if len(fields) == 3:
+                    print(fields[0] + ':' + fields[1] + ':' + name + ': ' + fields[2])
+        return 0
+
+    severity = ['ok', 'warning', 'critical', 'unknown']
+    codes = []
+    summaries = []
+    perfdata = []
+    for (name, output, code) in outputs:
+        line = output.strip().split('\n')[0]
+        (summary, separator, data) = line.partition(' | ')
+        # A child that did not answer like a plugin is in an unknown state
+        if line.startswith('IBEX-BACKUP '):
+            summary = summary.split(' - ', 1)[-1]
+        else:
+            code = 3
+        codes.append(worstStatus([code]))
+        summaries.append('{0} {1} ({2})'.format(name, severity[codes[-1]].upper(), summary or 'no output'))
+        perfdata += [name + '_' + value for value in data.split()]
+    worst = worstStatus(codes)
+    print('IBEX-BACKUP ' + severity[worst].upper() + ' - ' + '; '.join(summaries) + (' | ' + ' '.join(perfdata) if perfdata else ''))
+    return worst
+
+
+def formatAge(seconds):
+    if seconds >= 86400:
+        return '{0:.1f}d'.format(seconds / 86400.0)
+    if seconds >= 3600:
+        return '{0:.1f}h'.format(seconds / 3600.0)
+    if seconds >= 60:
+        return '{0}m'.format(int(seconds // 60))
+    return '{0}s'.format(int(seconds))
+
+
+def checkStatus(statFile):
+    try:
+        with open(statFile, 'r') as stat:
+            logging.debug('Reading "' + statFile + '"')
+            status = stat.readline().strip()
+            logging.debug('Status: "' + status + '"')
+        return status
+    except IOError:
+        logging.warning('Unable to read "' + statFile + '" file')
+        return None
+
+
+class CommandProgress(object):
+    # Follows innobackupex output and keeps the progress file up to date
+
+    copyPattern = re.compile(r'^\[(\d+)\] (?:Copying|Streaming|Compressing and streaming|Compressing) (\S+)')
+    donePattern = re.compile(r'^\[(\d+)\]\s+\.\.\.done')
+    lsnPattern = re.compile(r'log scanned up to \((\d+)\)')
+
+    def __init__(self, command, expectedBytes=None):
+        self.command = command.split()[0]
+        self.expectedBytes = expectedBytes
+        self.bytes = 0
+        self.files = 0
+        self.lsn = None
+        self.current = {}
+        self.started = time.time()
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def parse(self, line):
+        match = self.copyPattern.match(line)
+        if match:
+            with self.lock:
+                self.current[match.group(1)] = match.group(2)
+            return
+        match = self.donePattern.match(line)
+        if match:
+            with self.lock:
+                path = self.current.pop(match.group(1), None)
+                self.files += 1
+                if path is not None:
+                    try:
+                        self.bytes += os.path.getsize(os.path.join(databaseDir, path))
+                    except OSError:
+                        pass
+            self.write()
+            return
+        match = self.lsnPattern.search(line)
+        if match:
+            self.lsn = int(match.group(1))
+            self.write()
+
+    def write(self, force=False):
+        # At most once a second, monitoring does not need more
+        now = time.time()
+        if (now - self.written < 1 and not force) or args.dryrun:
+            return
+        self.written = now
+        elapsed = now - self.started
+        progress = {
+            'command': self.command,
+            'started': time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime(self.started)),
+            'elapsed': round(elapsed, 1),
+            'files': self.files,
+            'bytes': self.bytes,
+            'mbPerSecond': round(self.bytes / 1048576.0 / max(elapsed, 0.001), 2),
+            'lsn': self.lsn,
+            'expectedBytes': self.expectedBytes,
+            'percent': None,
+            'eta': None,
+        }
+        if self.expectedBytes and self.bytes > 0:
+            progress['percent'] = round(min(100.0 * self.bytes / self.expectedBytes, 100.0), 1)
+            progress['eta'] = int(max(self.expectedBytes - self.bytes, 0) * elapsed / self.bytes)
+        progressFile = fullProgressFile if args.backupType == 'full' else incProgressFile
+        try:
+            with open(progressFile + '.tmp', 'w') as f:
+                json.dump(progress, f, sort_keys=True)
+            os.rename(progressFile + '.tmp', progressFile)
+        except (IOError, OSError):
+            pass
+
+
+def cancelRun(signum, frame):
+    logging.critical('Received signal ' + str(signum) + ', cancelling run')
+    cancelled.set()
+    for proc in list(runningProcesses):
+        proc.kill()
+
+
+def pumpLines(stream, level, progress=None):
+    # Log (and parse) one output stream of a child until it closes
+    dropped = 0
+    for line in iter(stream.readline, b''):
+        line = line.decode('utf-8', 'replace').strip()
+        if summaryOutput and commandChatter.search(line):
+            dropped += 1
+        else:
+            logging.log(level, line)
+        if progress is not None:
+            progress.parse(line)
+    stream.close()
+    if dropped > 0:
+        logging.info('Left ' + str(dropped) + ' lines of per-file output out of the log')
+
+
+def startCommand(cmd, **kwargs):
+    # Start a child that can be timed out and cancelled
+    if cancelled.is_set():
+        raise OSError(errno.ECANCELED, 'Run has been cancelled')
+    proc = Popen(cmd, **kwargs)
+    runningProcesses.add(proc)
+    proc.timer = None
+    if commandTimeout > 0:
+        proc.timer = threading.Timer(commandTimeout, timeoutCommand, args=(proc,))
+        proc.timer.daemon = True
+        proc.timer.start()
+    return proc
+
+
+def timeoutCommand(proc):
+    logging.critical('Command timed out after ' + str(commandTimeout) + ' seconds, killing it')
+    proc.kill()
+
+
+def finishCommand(proc):
+    proc.wait()
+    if proc.timer is not None:
+        proc.timer.cancel()
+    runningProcesses.discard(proc)
+    return proc.returncode
+
+
+def runCommand(command, expectedBytes=None):
+
+    # If dry run, just return the command
+    if args.dryrun:
+        logging.info('Would run command: "' + command + '"')
+        return 0
+
+    cmd = shlex.split(command)
+    logging.debug('Running command: "' + command + '"')
+
+    try:
+        proc = startCommand(cmd, stdout=PIPE, stderr=PIPE)
+    except OSError as exception:
+        logging.critical('Unable to run command: ' + str(exception))
+        return 1
+
+    # Drain both pipes at the same time, a child blocked on a full stdout
+    # pipe would otherwise never get to close stderr
+    progress = CommandProgress(command, expectedBytes)
+    pumps = [
+        threading.Thread(target=pumpLines, args=(proc.stderr, logging.WARNING, progress)),
+        threading.Thread(target=pumpLines, args=(proc.stdout, logging.DEBUG, progress)),
+    ]
+    for pump in pumps:
+        pump.daemon = True
+        pump.start()
+    for pump in pumps:
+        pump.join()
+
+    returncode = finishCommand(proc)
+    progress.write(force=True)
+
+    if returncode != 0:
+        logging.critical('Command failed with return code "' + str(returncode) + '"')
+        return 1
+    else:
+        logging.debug('Command successfully finished with returncode "' + str(returncode) + '"')
+        return 0
+
+
+def resetSignals():
+    # Pool workers must die on terminate() instead of cancelling the run
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def compressChunk(codec, level, data):
+    # Runs in the archive worker pool; every chunk becomes a complete
+    # gzip member / bzip2 stream / zstd or lz4 frame, so the concatenated
+    # output still decompresses with the standard tools
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+    elif codec == 'bzip2':
+        return bz2.compress(data, level)
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    elif codec == 'lz4':
+        return lz4.frame.compress(data, compression_level=level)
+    raise ValueError('Unknown codec "' + codec + '"')
+
+
+def checkCodec(codec):
+    if codec not in archiveCodecs:
+        logging.critical('Unknown compression codec "' + codec + '"')
+        return False
+    if codec == 'zstd' and zstandard is None:
+        logging.critical('The zstd codec needs the "zstandard" Python module')
+        return False
+    if codec == 'lz4' and lz4 is None:
+        logging.critical('The lz4 codec needs the "lz4" Python module')
+        return False
+    return True
+
+
+def codecLevel(codec):
+    if archiveLevel != '':
+        return int(archiveLevel)
+    return archiveCodecs[codec][1]
+
+
+def acquireCpuWorkers():
+    # Every worker needs a CPU slot when compression CPU is budgeted;
+    # wait for one, take as many more as are free
+    slots = []
+    if cpuBudget == 0:
+        return (archiveWorkers, slots)
+    slot = acquireSlot('cpu', cpuBudget)
+    while slot is not None and len(slots) < archiveWorkers:
+        slots.append(slot)
+        slot = acquireSlot('cpu', cpuBudget, wait=False)
+    if slot is not None:
+        slot.close()
+    logging.debug('Compressing on ' + str(len(slots)) + ' of ' + str(archiveWorkers) + ' workers within the CPU budget')
+    return (len(slots), slots)
+
+
+class ArchiveWriter(object):
+    # File-like sink that cuts everything written to it into chunks,
+    # compresses them across a process pool and writes them out in order
+
+    def __init__(self, out, codec, level):
+        self.out = out
+        self.codec = codec
+        self.level = level
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.rawBytes = 0
+        self.compressedBytes = 0
+        self.chunkSizes = []
+        self.checksum = hashlib.sha256()
+        self.hasher = None
+        if checksumAlgorithm != 'none':
+            self.hasher = ChunkHasher(Manifest(copyRangeSize), os.path.basename(out.name))
+        self.started = time.time()
+        self.bucket = deviceBucket(os.path.dirname(os.path.abspath(out.name)))
+        (self.workers, self.cpuSlots) = acquireCpuWorkers()
+        # Fork explicitly, the workers must not re-run this script
+        self.pool = multiprocessing.get_context('fork').Pool(self.workers, initializer=resetSignals)
+
+    def write(self, data):
+        if cancelled.is_set():
+            raise IOError(errno.ECANCELED, 'Run has been cancelled')
+        self.buffer.extend(data)
+        self.rawBytes += len(data)
+        while len(self.buffer) >= archiveChunkSize:
+            self.submit(bytes(self.buffer[:archiveChunkSize]))
+            del self.buffer[:archiveChunkSize]
+        return len(data)
+
+    def submit(self, chunk):
+        self.pending.append(self.pool.apply_async(compressChunk, (self.codec, self.level, chunk)))
+        # Keep every worker busy without buffering the whole archive
+        while len(self.pending) > self.workers * 2:
+            self.drain()
+
+    def drain(self):
+        data = self.pending.popleft().get()
+        self.bucket.consume(len(data))
+        self.out.write(data)
+        self.chunkSizes.append(len(data))
+        self.checksum.update(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.compressedBytes += len(data)
+
+    def close(self):
+        try:
+            if len(self.buffer) > 0:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while len(self.pending) > 0:
+                self.drain()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            for slot in self.cpuSlots:
+                slot.close()
+            self.cpuSlots = []
+        self.elapsed = time.time() - self.started
+
+    def saveSidecars(self, archive):
+        # Chunk boundaries let a restore decompress in parallel
+        writeManifest(archive + '.index', {'codec': self.codec, 'chunks': self.chunkSizes})
+        if self.hasher is not None:
+            self.hasher.finish()
+            self.hasher.manifest.save(archive + '.checksums')
+
+
+class PartWriter(object):
+    # Sink for one part of a sharded archive; the worker building the part
+    # compresses it chunk by chunk itself
+
+    def __init__(self, out, codec, level):
+        self.out = out
+        self.codec = codec
+        self.level = level
+        self.buffer = bytearray()
+        self.rawBytes = 0
+        self.chunkSizes = []
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.rawBytes += len(data)
+        while len(self.buffer) >= archiveChunkSize:
+            self.flushChunk(bytes(self.buffer[:archiveChunkSize]))
+            del self.buffer[:archiveChunkSize]
+        return len(data)
+
+    def flushChunk(self, chunk):
+        data = compressChunk(self.codec, self.level, chunk)
+        self.out.write(data)
+        self.chunkSizes.append(len(data))
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self.flushChunk(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+def buildPart(source, prefix, names, partFile, codec, level):
+    # Runs in the archive worker pool: one complete tar per part, so every
+    # part can be unpacked on its own. Returns where each member starts and
+    # ends in the uncompressed part.
+    members = []
+    with open(partFile, 'wb') as out:
+        writer = PartWriter(out, codec, level)
+        with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+            for name in names:
+                start = tar.offset
+                tar.add(os.path.normpath(os.path.join(source, name)), arcname=os.path.normpath(prefix + '/' + name), recursive=False)
+                members.append([name, start, tar.offset])
+        writer.close()
+    return (members, writer.chunkSizes, writer.rawBytes)
+
+
+def partsInFlight(workers):
+    return workers + 1
+
+
+def archiveStagingKB():
+    # Room the part files of a sharded archive take next to it at most
+    if archivePartSize == 0:
+        return 0
+    return partsInFlight(archiveWorkers) * archivePartSize // 1024
+
+
+class ShardedArchive(object):
+    # Archive made of independently compressed parts of about
+    # archivePartSize bytes, built in parallel and written one after the
+    # other into a single file. The parts are complete tar archives, so
+    # "<codec> -dc | tar -xi" still unpacks the whole thing.
+
+    def __init__(self, archive, codec, level):
+        self.archive = archive
+        self.codec = codec
+        self.level = level
+        self.rawBytes = 0
+        self.compressedBytes = 0
+        self.chunkSizes = []
+        self.parts = []
+        self.files = {}
+        self.checksum = hashlib.sha256()
+        self.hasher = None
+        if checksumAlgorithm != 'none':
+            self.hasher = ChunkHasher(Manifest(copyRangeSize), os.path.basename(archive))
+        self.bucket = deviceBucket(os.path.dirname(os.path.abspath(archive)))
+        (self.workers, self.cpuSlots) = acquireCpuWorkers()
+
+    def split(self, source):
+        # Parts follow the directory order, so a schema ends up in as few
+        # parts as possible
+        parts = [[]]
+        size = 0
+        for (root, dirs, names) in os.walk(source):
+            dirs.sort()
+            for name in ['.'] + sorted(names):
+                path = os.path.join(root, name)
+                if size >= archivePartSize:
+                    parts.append([])
+                    size = 0
+                parts[-1].append(os.path.relpath(os.path.normpath(path), source))
+                if name != '.' and not os.path.islink(path):
+                    size += os.path.getsize(path)
+        return parts
+
+    def build(self, source):
+        started = time.time()
+        parts = self.split(source)
+        logging.debug('Archiving in ' + str(len(parts)) + ' parts on ' + str(self.workers) + ' workers')
+        partFiles = [self.archive + '.part-{0:04d}'.format(number) for number in range(len(parts))]
+        pool = multiprocessing.get_context('fork').Pool(self.workers, initializer=resetSignals)
+
+        # Finished parts wait on disk until it is their turn, so only one
+        # part more than there are workers is handed out at a time
+        def submit(number):
+            return pool.apply_async(buildPart, (source, source.lstrip('/'), parts[number], partFiles[number], self.codec, self.level))
+        try:
+            results = collections.deque(submit(number) for number in range(min(partsInFlight(self.workers), len(parts))))
+            with open(self.archive, 'wb') as out:
+                for number in range(len(parts)):
+                    (members, chunkSizes, rawBytes) = results.popleft().get()
+                    self.parts.append({'offset': self.compressedBytes, 'chunks': chunkSizes, 'rawBytes': rawBytes})
+                    for (name, start, end) in members:
+                        self.files[name] = [number, start, end]
+                    self.append(out, partFiles[number])
+                    self.chunkSizes.extend(chunkSizes)
+                    self.rawBytes += rawBytes
+                    if number + len(results) + 1 < len(parts):
+                        results.append(submit(number + len(results) + 1))
+        finally:
+            pool.terminate()
+            pool.join()
+            for slot in self.cpuSlots:
+                slot.close()
+            self.cpuSlots = []
+            for partFile in partFiles:
+                if os.path.exists(partFile):
+                    os.remove(partFile)
+        self.elapsed = time.time() - started
+
+    def append(self, out, partFile):
+        # Parts are written out in order as they finish, digested on the way
+        with open(partFile, 'rb') as src:
+            while True:
+                if cancelled.is_set():
+                    raise IOError(errno.ECANCELED, 'Run has been cancelled')
+                data = src.read(streamChunkSize * 4)
+                if not data:
+                    break
+                self.bucket.consume(len(data))
+                out.write(data)
+                self.checksum.update(data)
+                if self.hasher is not None:
+                    self.hasher.update(data)
+                self.compressedBytes += len(data)
+        os.remove(partFile)
+
+    def saveSidecars(self, archive):
+        # The index maps every file to its part and place in it, so a
+        # single table is read from the parts it is in and nothing else
+        writeManifest(archive + '.index', {
+            'codec': self.codec,
+            'chunks': self.chunkSizes,
+            'chunkSize': archiveChunkSize,
+            'parts': self.parts,
+            'files': self.files,
+        })
+        if self.hasher is not None:
+            self.hasher.finish()
+            self.hasher.manifest.save(archive + '.checksums')
+
+
+def recordArchiveStats(archive, writer):
+    ratio = float(writer.rawBytes) / max(writer.compressedBytes, 1)
+    speed = writer.rawBytes / 1048576.0 / max(writer.elapsed, 0.001)
+    logging.info('Archived {0} MB to {1} MB with {2} (ratio {3:.2f}, {4:.1f} MB/s)'.format(
+        writer.rawBytes // 1048576, writer.compressedBytes // 1048576, writer.codec, ratio, speed))
+
+    stats = {
+        'timestamp': time.strftime("%Y-%m-%d_%H-%M-%S"),
+        'archive': archive,
+        'codec': writer.codec,
+        'level': writer.level,
+        'workers': writer.workers,
+        'rawBytes': writer.rawBytes,
+        'compressedBytes': writer.compressedBytes,
+        'sha256': writer.checksum.hexdigest(),
+        'ratio': round(ratio, 3),
+        'seconds': round(writer.elapsed, 3),
+        'mbPerSecond': round(speed, 2),
+    }
+    try:
+        with open(archiveStatsFile, 'a') as f:
+            f.write(json.dumps(stats, sort_keys=True) + '\n')
+    except IOError:
+        logging.warning('Unable to write to "' + archiveStatsFile + '"')
+
+
+def archiveBackup(source, archive):
+    if not checkCodec(archiveCodec):
+        return 1
+
+    # If dry run, return log statement
+    if args.dryrun:
+        logging.info('Would have archived "' + source + '" to "' + archive + '" with ' + archiveCodec)
+        return 0
+
+    logging.debug('Archiving "' + source + '" with ' + archiveCodec + ' using ' + str(archiveWorkers) + ' workers')
+    try:
+        if archivePartSize > 0:
+            writer = ShardedArchive(archive, archiveCodec, codecLevel(archiveCodec))
+            writer.build(source)
+        else:
+            with open(archive, 'wb') as out:
+                writer = ArchiveWriter(out, archiveCodec, codecLevel(archiveCodec))
+                try:
+                    # Same member names as "tar caf archive /abs/path" would store
+                    with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                        tar.add(source, arcname=source.lstrip('/'))
+                finally:
+                    writer.close()
+        writer.saveSidecars(archive)
+    except (IOError, OSError, tarfile.TarError) as exception:
+        logging.critical('Archiving failed: ' + str(exception))
+        return 1
+
+    recordArchiveStats(archive, writer)
+    recordBackupSize(source, writer.rawBytes // 1024)
+    catalogRecord(os.path.basename(source), archive_checksum=writer.checksum.hexdigest())
+    return 0
+
+
+def streamCommand(command, targets, archive=None, expectedBytes=None):
+    # Run a streaming backup command and fan its output out, in a single
+    # pass, to one extracting consumer per target plus an optional archive
+
+    if streamFormat not in extractCommands:
+        logging.critical('Unknown stream format "' + streamFormat + '"')
+        return 1
+
+    if archive is not None and not checkCodec(streamCompressor):
+        return 1
+
+    # If dry run, just return the command
+    if args.dryrun:
+        logging.info('Would run command: "' + command + '"')
+        for target in targets:
+            logging.info('Would have extracted stream to "' + target + '"')
+        if archive is not None:
+            logging.info('Would have archived stream to "' + archive + '"')
+        return 0
+
+    # Start the archive pool first, its forked workers must not inherit
+    # the consumer pipes
+    writer = None
+    if archive is not None:
+        logging.debug('Archiving stream with ' + streamCompressor + ' to "' + archive + '"')
+        writer = ArchiveWriter(open(archive, 'wb'), streamCompressor, codecLevel(streamCompressor))
+
+    # Start the consumers before the producer so the stream has somewhere to go
+    sinks = []
+    for target in targets:
+        if checkDirectory(target) == 1:
+            if writer is not None:
+                writer.close()
+            return 1
+        extract = extractCommands[streamFormat].format(target)
+        logging.debug('Extracting stream with: "' + extract + '"')
+        sinks.append(Popen(shlex.split(extract), stdin=PIPE))
+
+    # Tar streams are checksummed on the way through; the local target is
+    # prepared in place, so only the other copies get checksums
+    manifest = None
+    hashing = None
+    if checksumAlgorithm != 'none' and len(targets) > 1 and streamFormat == 'tar':
+        manifest = Manifest(copyRangeSize)
+        (readEnd, writeEnd) = os.pipe()
+        hashing = threading.Thread(target=hashTarStream, args=(os.fdopen(readEnd, 'rb'), manifest))
+        hashing.daemon = True
+        hashing.start()
+        hashStream = os.fdopen(writeEnd, 'wb')
+
+    cmd = shlex.split(command)
+    logging.debug('Running command: "' + command + '"')
+    try:
+        proc = startCommand(cmd, stdout=PIPE, stderr=PIPE)
+    except OSError as exception:
+        logging.critical('Unable to run command: ' + str(exception))
+        for sink in sinks:
+            sink.stdin.close()
+            sink.wait()
+        if hashing is not None:
+            hashStream.close()
+            hashing.join()
+        if writer is not None:
+            writer.close()
+        return 1
+
+    # Drain stderr on its own so a chatty producer never blocks the stream
+    progress = CommandProgress(command, expectedBytes)
+    pump = threading.Thread(target=pumpLines, args=(proc.stderr, logging.WARNING, progress))
+    pump.daemon = True
+    pump.start()
+
+    failed = False
+    streamed = 0
+    while True:
+        chunk = proc.stdout.read(streamChunkSize)
+        if not chunk:
+            break
+        streamed += len(chunk)
+        for sink in sinks:
+            try:
+                sink.stdin.write(chunk)
+            except IOError:
+                logging.critical('Stream consumer exited early')
+                failed = True
+                break
+        if writer is not None and not failed:
+            writer.write(chunk)
+        if hashing is not None and not failed:
+            hashStream.write(chunk)
+        if failed:
+            proc.kill()
+            break
+
+    proc.stdout.close()
+    for sink in sinks:
+        try:
+            sink.stdin.close()
+        except IOError:
+            failed = True
+    if hashing is not None:
+        hashStream.close()
+        hashing.join()
+    pump.join()
+    returncode = finishCommand(proc)
+    progress.write(force=True)
+
+    if writer is not None:
+        try:
+            writer.close()
+            writer.out.close()
+            writer.saveSidecars(archive)
+            recordArchiveStats(archive, writer)
+        except (IOError, OSError) as exception:
+            logging.critical('Unable to write stream archive: ' + str(exception))
+            failed = True
+
+    if returncode != 0:
+        logging.critical('Command failed with return code "' + str(returncode) + '"')
+        failed = True
+
+    for sink in sinks:
+        sink.wait()
+        if sink.returncode != 0:
+            logging.critical('Stream consumer failed with return code "' + str(sink.returncode) + '"')
+            failed = True
+
+    if failed:
+        return 1
+    else:
+        logging.debug('Streamed ' + str(streamed) + ' bytes to ' + str(len(sinks)) + ' consumer(s)')
+        for target in targets:
+            recordBackupSize(target, streamed // 1024)
+        if checksumAlgorithm != 'none':
+            for target in targets[1:]:
+                if manifest is not None and not manifest.failed:
+                    try:
+                        manifest.save(target + '.checksums')
+                    except (IOError, OSError):
+                        logging.error('Unable to write "' + target + '.checksums"')
+                        return 1
+                # xbstream is not parsed here, the extracted copy is read back instead
+                elif writeChecksums(target) == 1:
+                    return 1
+        return 0
+
+
+def streamTargets(copy):
+    # Work out where a streamed backup should end up
+    targets = [targetDir]
+    # The deduplicated store is filled from the local target afterwards
+    if copy and not dedupStore:
+        targets.append(secondaryBaseDir + '/' + timeStamp)
+    archive = None
+    if streamCompressor != '':
+        extension = archiveCodecs.get(streamCompressor, (streamCompressor, None))[0]
+        archive = "{0}/{1}.{2}.{3}".format(secondaryBaseDir, timeStamp, streamFormat, extension)
+    return (targets, archive)
+
+
+def checkBackup(checkType):
+    full = latestBackup(['full'])
+    if full is None:
+        logging.debug('No completed full backup in the catalog')
+        return False
+
+    if checkType == 'backupType':
+        logging.debug('Full backup type "' + str(full['backup_type']) + '"')
+        return full['backup_type'] == 'full-prepared'
+
+    elif checkType == 'lsn':
+        inc = latestBackup(['firstinc', 'inc', 'lastinc'], fullId=full['id'])
+        if inc is None:
+            logging.debug('No completed incremental backup for "' + full['id'] + '" in the catalog')
+            return False
+
+        logging.debug('Full backup LSN "' + str(full['prepared_lsn']) + '"')
+        logging.debug('Incremental backup LSN "' + str(inc['to_lsn']) + '"')
+
+        if lazyPrepare:
+            # Increments are applied later, the chain only has to be unbroken
+            return pendingIncrements(full) is not None
+
+        return full['prepared_lsn'] is not None and full['prepared_lsn'] == inc['to_lsn']
+
+    else:
+        return False
+
+
+def pendingIncrements(full, backupId=None):
+    # Increments of a chain not yet applied to the full backup, in apply
+    # order; None when their LSNs leave a gap. backupId is the running one.
+    if full['prepared_lsn'] is None:
+        logging.critical('Full backup "' + full['id'] + '" has not been prepared')
+        return None
+    rows = catalogQuery('SELECT * FROM backups WHERE full_id = ? AND type != ? AND (state = ? OR id = ?) ORDER BY from_lsn',
+                        (full['id'], 'full', 'completed', backupId))
+    lsn = full['prepared_lsn']
+    pending = []
+    for row in rows:
+        if row['to_lsn'] is None or row['to_lsn'] <= lsn:
+            continue
+        if row['from_lsn'] != lsn:
+            logging.critical('Increment "' + row['id'] + '" starts at LSN ' + str(row['from_lsn']) + ', expected ' + str(lsn))
+            return None
+        pending.append(dict(row))
+        lsn = row['to_lsn']
+    if not catalogHealthy('applying increments'):
+        return None
+    return pending
+
+
+def applyIncrements(full, pending):
+    # Roll the full backup forward one increment at a time; the prepared
+    # LSN is recorded after each, so a failed batch continues from there
+    for inc in pending:
+        logging.info('Applying "' + inc['id'] + '" (LSN ' + str(inc['from_lsn']) + ' to ' + str(inc['to_lsn']) + ')')
+        command = "innobackupex --apply-log --redo-only {0}/ --incremental-dir={1}/".format(full['path'], inc['path']) + prepareOptions
+        if runCommand(command, cachedBackupBytes(inc['path'])) == 1:
+            return 1
+        recordPrepared(full['id'], full['path'])
+        snapshotBackup(inc['id'], full['id'], full['path'])
+    return 0
+
+
+def snapshotBackup(backupId, fullId, path):
+    # Keep the prepared full as it is after applying backupId. Files that
+    # did not change since the previous snapshot are hardlinked to it, the
+    # others are reflinked where the filesystem can and copied where not,
+    # so a snapshot costs about what the increment changed
+    if not snapshots:
+        return 0
+    destination = snapshotDir + '/' + backupId
+    if args.dryrun:
+        logging.info('Would have snapshotted "' + path + '" to "' + destination + '"')
+        return 0
+
+    started = time.time()
+    source = os.path.realpath(path)
+    previous = None
+    for row in catalogQuery('SELECT path FROM snapshots WHERE full_id = ? AND backup_id != ? ORDER BY lsn DESC', (fullId, backupId)):
+        if os.path.isdir(row['path']):
+            previous = row['path']
+            break
+    counts = {'linked': 0, 'cloned': 0, 'copied': 0}
+    copiedBytes = 0
+    try:
+        # Left behind by an interrupted attempt
+        if os.path.isdir(destination):
+            shutil.rmtree(destination)
+        reflink = True
+        directories = []
+        files = []
+        ranges = []
+        with ThreadPoolExecutor(max_workers=copyThreads) as pool:
+            for (root, dirs, names) in os.walk(source):
+                relative = os.path.relpath(root, source)
+                target = os.path.normpath(os.path.join(destination, relative))
+                os.makedirs(target)
+                directories.append((root, target))
+                for name in dirs + names:
+                    sourceFile = os.path.join(root, name)
+                    targetFile = os.path.join(target, name)
+                    if os.path.islink(sourceFile):
+                        os.symlink(os.readlink(sourceFile), targetFile)
+                        continue
+                    if name not in names:
+                        continue
+                    info = os.stat(sourceFile)
+                    if previous is not None:
+                        previousFile = os.path.normpath(os.path.join(previous, relative, name))
+                        try:
+                            before = os.stat(previousFile)
+                            if before.st_size == info.st_size and before.st_mtime_ns == info.st_mtime_ns:
+                                os.link(previousFile, targetFile)
+                                counts['linked'] += 1
+                                continue
+                        except OSError:
+                            pass
+                    with open(targetFile, 'wb') as f:
+                        f.truncate(info.st_size)
+                    files.append((sourceFile, targetFile))
+                    if reflink and cloneFile(sourceFile, targetFile):
+                        counts['cloned'] += 1
+                        continue
+                    reflink = False
+                    counts['copied'] += 1
+                    copiedBytes += info.st_size
+                    for offset in range(0, info.st_size, copyRangeSize):
+                        ranges.append(pool.submit(copyRange, sourceFile, targetFile, offset, min(copyRangeSize, info.st_size - offset)))
+            for future in ranges:
+                future.result()
+        for (sourceFile, targetFile) in files:
+            copyMetadata(sourceFile, targetFile)
+        for (root, target) in reversed(directories):
+            copyMetadata(root, target)
+    except (IOError, OSError) as exception:
+        logging.error('Snapshot of "' + backupId + '" failed: ' + str(exception))
+        return 1
+
+    checkpoints = readCheckpoints(destination) or {}
+    catalogQuery('INSERT OR REPLACE INTO snapshots (backup_id, full_id, path, lsn, bytes, created) VALUES (?, ?, ?, ?, ?, ?)',
+                 (backupId, fullId, destination, checkpoints.get('to_lsn'), copiedBytes, time.time()))
+    logging.info('Snapshot "{0}": {1} file(s) hardlinked, {2} reflinked, {3} copied ({4} MB) in {5:.1f}s'.format(
+        destination, counts['linked'], counts['cloned'], counts['copied'], copiedBytes // 1048576, time.time() - started))
+    return 0
+
+
+def showSnapshots():
+    # Prepared states a restore can start from without applying anything
+    line = '{0:<20} {1:<9} {2:<20} {3:>14} {4:>10}  {5}'
+    print(line.format('id', 'type', 'full', 'lsn', 'copied (MB)', 'path'))
+    for row in catalogQuery('SELECT snapshots.*, backups.type FROM snapshots LEFT JOIN backups ON backups.id = snapshots.backup_id ORDER BY backup_id'):
+        if os.path.isdir(row['path']):
+            print(line.format(row['backup_id'], row['type'] or '', row['full_id'], str(row['lsn']), str((row['bytes'] or 0) // 1048576), row['path']))
+    return 0
+
+
+def prepareBackups():
+    # Apply everything captured so far, e.g. before a restore
+    syncCatalog()
+    full = latestBackup(['full'])
+    if full is None:
+        logging.critical('No full backup in the catalog')
+        return 1
+    pending = pendingIncrements(full)
+    if pending is None:
+        return 1
+    if len(pending) == 0:
+        logging.info('Nothing to apply, "' + full['id'] + '" is prepared up to LSN ' + str(full['prepared_lsn']))
+        return 0
+    logging.info('Applying ' + str(len(pending)) + ' increment(s) to "' + full['id'] + '"')
+    return applyIncrements(full, pending)
+
+
+def scanBackups(directory):
+    # One pass over a backup location; every entry named after a backup
+    entries = []
+    try:
+        iterator = os.scandir(directory)
+    except OSError:
+        logging.warning('Unable to scan "' + directory + '"')
+        return entries
+    with iterator:
+        for entry in iterator:
+            match = backupIdPattern.match(entry.name)
+            if match is None or entry.is_symlink():
+                continue
+            entries.append((match.group(1), entry.path, entry.is_dir(follow_symlinks=False)))
+    return entries
+
+
+def retainedChains(chainTimes, daily, weekly, monthly):
+    # Grandfather-father-son: the newest chain of each of the last
+    # daily days, weekly weeks and monthly months that have one
+    keep = set()
+    newestFirst = sorted(chainTimes, key=lambda chainId: chainTimes[chainId], reverse=True)
+    for (count, bucket) in [(daily, '%Y-%m-%d'), (weekly, '%G-%V'), (monthly, '%Y-%m')]:
+        seen = set()
+        for chainId in newestFirst:
+            key = time.strftime(bucket, time.strptime(chainTimes[chainId], '%Y-%m-%d_%H-%M-%S'))
+            if key in seen:
+                continue
+            if len(seen) == count:
+                break
+            seen.add(key)
+            keep.add(chainId)
+    return keep
+
+
+def removeEntry(path, isDir):
+    try:
+        if isDir:
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError as exception:
+        logging.error('Unable to remove "' + path + '": ' + str(exception))
+        return 1
+    logging.debug('Removed "' + path + '"')
+    return 0
+
+
+def cleanupBackups():
+    # Apply the retention policies to the local, secondary and offsite
+    # locations. Whole chains are kept or removed, so a full backup never
+    # goes while an increment that needs it stays.
+    syncCatalog()
+    known = {}
+    for row in catalogQuery('SELECT * FROM backups'):
+        known[row['id']] = dict(row)
+    fullIds = sorted(backupId for backupId in known if known[backupId]['type'] == 'full')
+
+    def chainOf(backupId):
+        if backupId in known and known[backupId]['full_id']:
+            return known[backupId]['full_id']
+        # Not cataloged: it belongs to the newest full taken before it
+        older = [fullId for fullId in fullIds if fullId <= backupId]
+        if len(older) > 0:
+            return older[-1]
+        return backupId
+
+    # Location: (catalog column, policy)
+    locations = collections.OrderedDict([
+        (baseDir + '/prepared', ('path', localRetention)),
+        (secondaryBaseDir, ('secondary_path', localRetention)),
+        (offsiteBaseDir, ('offsite_path', offsiteRetention)),
+    ])
+    if os.path.isdir(snapshotDir):
+        locations[snapshotDir] = ('snapshots', localRetention)
+    # The catalog only tracks the copy in offsiteBaseDir
+    for target in offsiteDestinations[1:]:
+        if not remoteDestination(target['path']) and os.path.isdir(target['path']):
+            locations[target['path']] = (None, offsiteRetention)
+    # Snapshots share unchanged files, so only what each one copied counts
+    snapshotBytes = {}
+    for row in catalogQuery('SELECT path, bytes FROM snapshots'):
+        snapshotBytes[row['path']] = row['bytes'] or 0
+
+    # A chain is as recent as the newest backup in it
+    chainTimes = {}
+    for backupId in known:
+        chainId = chainOf(backupId)
+        chainTimes[chainId] = max(chainTimes.get(chainId, backupId), backupId)
+    scanned = {}
+    for location in locations:
+        scanned[location] = scanBackups(location)
+        for (backupId, path, isDir) in scanned[location]:
+            chainId = chainOf(backupId)
+            chainTimes[chainId] = max(chainTimes.get(chainId, backupId), backupId)
+
+    # The current chain and anything still being written are never removed
+    protected = set()
+    if os.path.islink(lastFull):
+        protected.add(chainOf(os.path.basename(os.path.realpath(lastFull))))
+    elif len(chainTimes) > 0:
+        protected.add(max(chainTimes))
+    for backupId in known:
+        if known[backupId]['state'] == 'running':
+            protected.add(chainOf(backupId))
+
+    removals = []
+    for location in locations:
+        (column, policy) = locations[location]
+        present = dict((chainOf(backupId), chainTimes[chainOf(backupId)]) for (backupId, path, isDir) in scanned[location])
+        keep = retainedChains(present, *policy) | protected
+        for (backupId, path, isDir) in scanned[location]:
+            if chainOf(backupId) not in keep:
+                removals.append((backupId, path, isDir, column))
+
+    if not catalogHealthy('removing anything'):
+        return 1
+
+    # Sizes for the report come from the catalog when it knows them
+    removals.sort(key=lambda removal: removal[1])
+    totalBytes = 0
+    for (backupId, path, isDir, column) in removals:
+        if column == 'snapshots':
+            size = snapshotBytes.get(path, 0)
+        else:
+            size = backupSize(path) * 1024
+        totalBytes += size
+        if args.dryrun:
+            logging.info('Would have removed "' + path + '" (' + str(size // (1024 * 1024)) + 'MB)')
+            print('{0:<60} {1:>10} MB'.format(path, size // (1024 * 1024)))
+    if args.dryrun:
+        msg = 'Would have reclaimed {0} MB in {1} backups'.format(totalBytes // (1024 * 1024), len(removals))
+        logging.info(msg)
+        print(msg)
+        return collectGarbage(set(removal[1] for removal in removals))
+
+    logging.info('Removing ' + str(len(removals)) + ' expired backups (' + str(totalBytes // (1024 * 1024)) + 'MB)')
+    status = 0
+    with ThreadPoolExecutor(max_workers=copyThreads) as executor:
+        results = list(executor.map(lambda removal: removeEntry(removal[1], removal[2]), removals))
+    for (result, (backupId, path, isDir, column)) in zip(results, removals):
+        if result == 1:
+            status = 1
+            continue
+        if column == 'snapshots':
+            catalogQuery('DELETE FROM snapshots WHERE path = ?', (path,))
+            continue
+        if column is None:
+            continue
+        if backupId not in known or os.path.splitext(path)[1] in archiveSidecars:
+            continue
+        backup = known[backupId]
+        if column == 'path' and not isDir:
+            column = 'archive'
+        backup[column] = None
+        fields = {column: None}
+        if not any(backup[key] for key in ['path', 'secondary_path', 'archive', 'offsite_path']):
+            fields['state'] = 'expired'
+        catalogRecord(backupId, **fields)
+    if collectGarbage(set()) == 1:
+        status = 1
+    logging.info('Cleanup done, reclaimed ' + str(totalBytes // (1024 * 1024)) + 'MB')
+    return status
+
+
+def decompressChunk(codec, data):
+    # Runs in the restore worker pool, one archive chunk at a time
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    elif codec == 'bzip2':
+        return bz2.decompress(data)
+    elif codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif codec == 'lz4':
+        return lz4.frame.decompress(data)
+    raise ValueError('Unknown codec "' + codec + '"')
+
+
+class ChunkReader(object):
+    # Decompressed bytes of a run of archive chunks, read like a stream
+
+    def __init__(self, src, codec, offset, chunks, skip, length):
+        self.src = src
+        self.codec = codec
+        self.chunks = collections.deque(chunks)
+        self.skip = skip
+        self.left = length
+        self.buffer = b''
+        self.src.seek(offset)
+
+    def read(self, size=-1):
+        while len(self.buffer) < size and len(self.chunks) > 0 or size < 0 and len(self.chunks) > 0:
+            if cancelled.is_set():
+                raise IOError(errno.ECANCELED, 'Run has been cancelled')
+            self.buffer += decompressChunk(self.codec, self.src.read(self.chunks.popleft()))[self.skip:]
+            self.skip = 0
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[:min(size, self.left)]
+        self.buffer = self.buffer[len(data):]
+        self.left -= len(data)
+        return data
+
+
+def extractPart(archive, codec, part, target, strip):
+    # Unpack one part of a sharded archive with its own tar
+    extract = "tar -xif - -C {0} --strip-components={1}".format(target, strip)
+    tar = Popen(shlex.split(extract), stdin=PIPE)
+    try:
+        with open(archive, 'rb') as src:
+            reader = ChunkReader(src, codec, part['offset'], part['chunks'], 0, part['rawBytes'])
+            while True:
+                data = reader.read(archiveChunkSize)
+                if not data:
+                    break
+                tar.stdin.write(data)
+        tar.stdin.close()
+    except (IOError, OSError, ValueError) as exception:
+        logging.critical('Extracting "' + archive + '" failed: ' + str(exception))
+        tar.kill()
+        tar.wait()
+        return 1
+    tar.wait()
+    if tar.returncode != 0:
+        logging.critical('tar failed with return code "' + str(tar.returncode) + '"')
+        return 1
+    return 0
+
+
+def matchingFiles(index, patterns):
+    # Files of a sharded archive matching any of the patterns, or inside a
+    # directory that does
+    matches = []
+    for name in index['files']:
+        parents = [name] + [os.path.dirname(name)]
+        while parents[-1] != '':
+            parents.append(os.path.dirname(parents[-1]))
+        if any(fnmatch.fnmatch(parent, pattern.strip('/')) for parent in parents for pattern in patterns):
+            matches.append(name)
+    return matches
+
+
+def extractFiles(archive, codec, index, target, strip, names):
+    # Unpack some files of a sharded archive, decompressing only the
+    # chunks they are in
+    runs = collections.defaultdict(list)
+    for name in sorted(names, key=lambda name: index['files'][name][:2]):
+        (number, start, end) = index['files'][name]
+        # Members next to each other in a part are read in one go
+        if len(runs[number]) > 0 and runs[number][-1][1] == start:
+            runs[number][-1][1] = end
+        else:
+            runs[number].append([start, end])
+
+    chunkSize = index['chunkSize']
+    work = []
+    for number in sorted(runs):
+        part = index['parts'][number]
+        for (start, end) in runs[number]:
+            first = start // chunkSize
+            last = (end - 1) // chunkSize
+            offset = part['offset'] + sum(part['chunks'][:first])
+            work.append((offset, part['chunks'][first:last + 1], start - first * chunkSize, end - start))
+    readBytes = sum(sum(chunks) for (offset, chunks, skip, length) in work)
+    logging.info('Reading ' + str(readBytes // 1048576) + ' of ' + str(sum(index['chunks']) // 1048576) + ' MB from ' + str(len(runs)) + ' of ' + str(len(index['parts'])) + ' parts')
+
+    def extractRun(run):
+        with open(archive, 'rb') as src:
+            with tarfile.open(fileobj=ChunkReader(src, codec, *run), mode='r|') as tar:
+                for member in tar:
+                    member.name = '/'.join(member.name.split('/')[strip:])
+                    if member.name != '':
+                        tar.extract(member, target)
+
+    with ThreadPoolExecutor(max_workers=archiveWorkers) as pool:
+        list(pool.map(extractRun, work))
+    return readBytes
+
+
+def codecOf(archive):
+    for (name, (extension, level)) in archiveCodecs.items():
+        if archive.endswith('.' + extension):
+            return name
+    return None
+
+
+def archiveIndex(archive):
+    try:
+        with open(archive + '.index', 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def extractArchive(archive, target, strip):
+    # Decompress an archive straight into target. With the chunk index the
+    # chunks are decompressed in parallel, otherwise by the standard tool.
+    # The parts of a sharded archive are unpacked side by side.
+    codec = codecOf(archive)
+    if codec is None:
+        logging.critical('Unknown archive type "' + archive + '"')
+        return 1
+    index = archiveIndex(archive)
+    if index is None:
+        logging.debug('No chunk index for "' + archive + '", decompressing in one stream')
+
+    extract = "tar -xif - -C {0} --strip-components={1}".format(target, strip)
+    logging.debug('Extracting with: "' + extract + '"')
+    if index is None or (codec == 'zstd' and zstandard is None) or (codec == 'lz4' and lz4 is None):
+        with open(archive, 'rb') as src:
+            decompress = Popen([codec, '-dc'], stdin=src, stdout=PIPE)
+            tar = Popen(shlex.split(extract), stdin=decompress.stdout)
+            decompress.stdout.close()
+            tar.wait()
+            decompress.wait()
+        if decompress.returncode != 0 or tar.returncode != 0:
+            logging.critical('Extracting "' + archive + '" failed')
+            return 1
+        return 0
+
+    if 'parts' in index:
+        logging.debug('Extracting ' + str(len(index['parts'])) + ' parts with ' + str(archiveWorkers) + ' workers')
+        with ThreadPoolExecutor(max_workers=archiveWorkers) as pool:
+            results = list(pool.map(lambda part: extractPart(archive, codec, part, target, strip), index['parts']))
+        if 1 in results:
+            return 1
+        return 0
+
+    # Start the pool first, its forked workers must not inherit the tar pipe
+    pool = multiprocessing.get_context('fork').Pool(archiveWorkers, initializer=resetSignals)
+    tar = Popen(shlex.split(extract), stdin=PIPE)
+    pending = collections.deque()
+    try:
+        with open(archive, 'rb') as src:
+            for size in index['chunks']:
+                if cancelled.is_set():
+                    raise IOError(errno.ECANCELED, 'Run has been cancelled')
+                pending.append(pool.apply_async(decompressChunk, (codec, src.read(size))))
+                while len(pending) > archiveWorkers * 2:
+                    tar.stdin.write(pending.popleft().get())
+            while len(pending) > 0:
+                tar.stdin.write(pending.popleft().get())
+        tar.stdin.close()
+    except (IOError, OSError, ValueError) as exception:
+        logging.critical('Extracting "' + archive + '" failed: ' + str(exception))
+        tar.kill()
+        return 1
+    finally:
+        pool.terminate()
+        pool.join()
+        tar.wait()
+    if tar.returncode != 0:
+        logging.critical('tar failed with return code "' + str(tar.returncode) + '"')
+        return 1
+    return 0
+
+
+def restoreChain(untilTime):
+    # The newest completed backup taken at or before untilTime (any prefix
+    # of a backup id), its full backup and the increments up to it
+    syncCatalog()
+    limit = (untilTime or '9999') + '~'
+    rows = catalogQuery('SELECT * FROM backups WHERE id <= ? AND state = ? AND type IN (?, ?, ?, ?) ORDER BY id DESC LIMIT 1',
+                        (limit, 'completed', 'full', 'firstinc', 'inc', 'lastinc'))
+    if not catalogHealthy('restoring'):
+        return (None, None, None)
+    if len(rows) == 0:
+        logging.critical('No completed backup to restore')
+        return (None, None, None)
+    backup = dict(rows[0])
+    full = catalogBackup(backup['full_id'])
+    increments = [dict(row) for row in catalogQuery(
+        'SELECT * FROM backups WHERE full_id = ? AND type != ? AND state = ? AND id <= ? ORDER BY from_lsn',
+        (full['id'], 'full', 'completed', backup['id']))]
+    lsn = full['to_lsn']
+    for inc in increments:
+        if inc['from_lsn'] != lsn:
+            logging.critical('Increment "' + inc['id'] + '" starts at LSN ' + str(inc['from_lsn']) + ', expected ' + str(lsn))
+            return (None, None, None)
+        lsn = inc['to_lsn']
+    return (backup, full, increments)
+
+
+def restoreFiles(backup, full, archive, target, patterns):
+    # Single files only come out of the sharded archive of a finished chain
+    if archive is None or backup['type'] != 'lastinc' or full['prepared_lsn'] != backup['to_lsn']:
+        logging.critical('Files can only be restored from the archive of a finished chain')
+        return 1
+    codec = codecOf(archive)
+    index = archiveIndex(archive)
+    if codec is None or index is None or 'files' not in index:
+        logging.critical('"' + archive + '" is not a sharded archive, restore it whole')
+        return 1
+    if not checkCodec(codec):
+        return 1
+    names = matchingFiles(index, patterns.split(','))
+    if len(names) == 0:
+        logging.critical('Nothing in "' + archive + '" matches "' + patterns + '"')
+        return 1
 
+    msg = 'Restoring ' + str(len(names)) + ' file(s) of "' + backup['id'] + '" to "' + target + '" from "' + archive + '"'
+    logging.info(msg)
+    print(msg)
+    if args.dryrun:
+        for name in sorted(names):
+            print('  ' + name)
+        return 0
 
-def checkStatus(statFile):
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    startPhase('extract')
     try:
-        with open(statFile, 'r') as stat:
-            logging.debug('Reading "' + statFile + '"')
-            status = stat.readline().strip()
-            logging.debug('Status: "' + status + '"')
-        return status
-    except IOError:
-        logging.warning('Unable to read "' + statFile + '" file')
-        return None
+        readBytes = extractFiles(archive, codec, index, target, len(full['path'].strip('/').split('/')), names)
+        status = 0
+    except (IOError, OSError, ValueError, tarfile.TarError) as exception:
+        logging.critical('Extracting from "' + archive + '" failed: ' + str(exception))
+        readBytes = None
+        status = 1
+    status = endPhase('extract', status, readBytes)
+    if status == 1:
+        return 1
+    msg = 'Restored {0} file(s) in {1:.1f}s'.format(len(names), time.time() - runStats['started'])
+    logging.info(msg)
+    print(msg)
+    return 0
 
 
-def runCommand(command):
+def restoreBackup(untilTime, target, patterns=None):
+    # Restore into an empty datadir: unpack the archive of a finished chain,
+    # or copy a full backup and apply the increments in place
+    (backup, full, increments) = restoreChain(untilTime)
+    if backup is None:
+        return 1
+    target = os.path.abspath(target)
+    if os.path.exists(target) and len(os.listdir(target)) > 0:
+        logging.critical('Restore target "' + target + '" is not empty')
+        return 1
 
-    # If dry run, just return the command
+    # Pick the source that needs the least work
+    archive = None
+    for candidate in [full['archive'], full['offsite_path']]:
+        if candidate and os.path.isfile(candidate):
+            archive = candidate
+            break
+    if patterns is not None:
+        return restoreFiles(backup, full, archive, target, patterns)
+    local = full['path'] and os.path.isdir(full['path']) and full['prepared_lsn'] is not None and full['prepared_lsn'] <= backup['to_lsn']
+    if local and lockHeld('inc'):
+        logging.info('Local full backup is being prepared, not using it')
+        local = False
+    secondary = full['secondary_path'] and os.path.exists(full['secondary_path'])
+    # The newest snapshot of the chain at or before the backup
+    snapshot = None
+    for row in catalogQuery('SELECT * FROM snapshots WHERE full_id = ? AND lsn <= ? ORDER BY lsn DESC', (full['id'], backup['to_lsn'])):
+        if os.path.isdir(row['path']):
+            snapshot = dict(row)
+            break
+    redoFull = False
+    if local and (snapshot is None or snapshot['lsn'] <= full['prepared_lsn']):
+        source = full['path']
+        applied = full['prepared_lsn']
+    elif archive is not None and backup['type'] == 'lastinc' and full['prepared_lsn'] == backup['to_lsn']:
+        source = archive
+        applied = backup['to_lsn']
+    elif snapshot is not None:
+        source = snapshot['path']
+        applied = snapshot['lsn']
+    elif secondary:
+        source = full['secondary_path']
+        applied = full['to_lsn']
+        redoFull = True
+    else:
+        logging.critical('No copy of full backup "' + full['id'] + '" left to restore from')
+        return 1
+    increments = [inc for inc in increments if inc['to_lsn'] > applied]
+    for inc in increments:
+        for column in ['path', 'secondary_path']:
+            if inc[column] and os.path.exists(inc[column]):
+                inc['source'] = inc[column]
+        if 'source' not in inc:
+            logging.critical('No copy of increment "' + inc['id'] + '" left to restore from')
+            return 1
+
+    if not catalogHealthy('restoring'):
+        return 1
+    msg = 'Restoring "' + backup['id'] + '" to "' + target + '" from "' + source + '" and ' + str(len(increments)) + ' increment(s)'
+    logging.info(msg)
+    print(msg)
     if args.dryrun:
-        logging.info('Would run command: "' + command + '"')
+        for inc in increments:
+            print('  apply "' + inc['source'] + '"')
         return 0
 
-    cmd = shlex.split(command)
-    logging.debug('Running command: "' + command + '"')
+    # Unpack or copy straight into the datadir
+    if source == archive:
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        startPhase('extract')
+        status = extractArchive(archive, target, len(full['path'].strip('/').split('/')))
+        status = endPhase('extract', status, (full['size'] or 0) * 1024)
+    elif source.endswith('.dedup'):
+        startPhase('copy')
+        status = rebuildTree(source, target)
+        status = endPhase('copy', status)
+    else:
+        if os.path.isdir(target):
+            os.rmdir(target)
+        startPhase('copy')
+        status = copyTree(source, target, checksums=False)
+        status = endPhase('copy', status, cachedBackupBytes(source))
+    if status == 1:
+        return 1
 
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    for line in proc.stderr:
-        logging.warning(str(line.strip()))
+    # Increments in the deduplicated store are rebuilt next to the target
+    # and removed once applied
+    rebuilt = []
+    stored = [inc for inc in increments if inc['source'].endswith('.dedup')]
+    if len(stored) > 0:
+        startPhase('rebuild')
+        for inc in stored:
+            rebuilt.append(target + '.inc-' + inc['id'])
+            status = rebuildTree(inc['source'], rebuilt[-1])
+            if status == 1:
+                break
+            inc['source'] = rebuilt[-1]
+        status = endPhase('rebuild', status)
+        if status == 1:
+            return 1
 
-    for line in proc.stdout:
-        logging.debug(str(line.strip()))
+    # Roll forward in the datadir itself, the backups stay untouched
+    if source != archive:
+        startPhase('prepare')
+        commands = []
+        if redoFull:
+            commands.append("innobackupex --apply-log --redo-only {0}/".format(target) + prepareOptions)
+        for inc in increments:
+            commands.append("innobackupex --apply-log --redo-only {0}/ --incremental-dir={1}/".format(target, inc['source']) + prepareOptions)
+        commands.append("innobackupex --apply-log {0}/".format(target) + prepareOptions)
+        status = 0
+        for command in commands:
+            status = runCommand(command)
+            if status == 1:
+                break
+        status = endPhase('prepare', status, sum(cachedBackupBytes(inc['source']) or 0 for inc in increments))
+        for path in rebuilt:
+            shutil.rmtree(path)
+        if status == 1:
+            return 1
 
-    proc.wait()
+    elapsed = time.time() - runStats['started']
+    for (name, phase) in runStats['phases'].items():
+        print('  {0:<10} {1:>8.1f}s {2:>10.1f} MB/s'.format(name, phase['seconds'], phase.get('mbPerSecond') or 0))
+    msg = 'Restored "' + backup['id'] + '" in {0:.1f}s, fix the ownership of "{1}" before starting MySQL'.format(elapsed, target)
+    logging.info(msg)
+    print(msg)
+    return 0
 
-    if proc.returncode != 0:
-        logging.critical('Command failed with return code "' + str(proc.returncode) + '"')
-        return 1
-    else:
-        logging.debug('Command successfully finished with returncode "' + str(proc.returncode) + '"')
-        return 0
 
+def makeSample(directory, size):
+    # Copy of the start of the biggest datadir files, cut into eight files
+    # so both the per-file and the per-range parallelism get exercised
+    sources = []
+    for (root, dirs, names) in os.walk(databaseDir):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                sources.append((os.path.getsize(path), path))
+    sources.sort(reverse=True)
+    os.makedirs(directory)
+    pieceSize = max(size // 8, 1)
+    written = 0
+    piece = None
+    for (fileSize, path) in sources:
+        with open(path, 'rb') as src:
+            while written < size:
+                if written % pieceSize == 0:
+                    if piece is not None:
+                        piece.close()
+                    piece = open(directory + '/sample-' + str(written // pieceSize), 'wb')
+                data = src.read(min(streamChunkSize * 4, pieceSize - written % pieceSize, size - written))
+                if not data:
+                    break
+                piece.write(data)
+                written += len(data)
+        if written >= size:
+            break
+    if piece is not None:
+        piece.close()
+    return written
 
-def runCommandWithOutput(command):
 
-    cmd = shlex.split(command)
-    logging.debug('Running command: "' + command + '"')
+def dropCache(directory):
+    # Reads in a measurement must come from the disk, not the page cache
+    for name in os.listdir(directory):
+        fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
 
-    proc = Popen(cmd, stdout=PIPE, stderr=STDOUT)
-    output = proc.communicate()[0].strip()
 
-    if proc.returncode != 0:
-        logging.critical('Command failed with return code "' + str(proc.returncode) + '"')
-        logging.critical(str(output.strip()))
-        returnval = 1
-    else:
-        logging.debug('Command successfully finished with returncode "' + str(proc.returncode) + '"')
-        logging.debug('Command output "' + str(output) + '"')
-        returnval = 0
+def kneeOf(results):
+    # Fewest threads that get within 10% of the best throughput
+    best = max(results.values())
+    return min(count for count in results if results[count] >= best * 0.9)
 
-    return (output, returnval)
 
+def calibrate():
+    # Measure copy and compression throughput at increasing thread counts
+    # on a sample of the datadir; the resource profile uses the result
+    # for every setting that is not set in settings.conf
+    global copyThreads, archiveWorkers
+    copyCounts = [count for count in [1, 2, 4, 8, 16, 32] if count <= max(hostCores * 2, 4)]
+    workerCounts = sorted(set([count for count in [1, 2, 4, 8, 16, 32, 64] if count < hostCores] + [hostCores]))
+    msg = 'Calibrating with {0} MB of "{1}": copy on {2} threads, {3} compression on {4} workers'.format(
+        calibrateSize // 1048576, databaseDir, copyCounts, archiveCodec, workerCounts)
+    logging.info(msg)
+    print(msg)
+    if args.dryrun:
+        return 0
+    if not checkCodec(archiveCodec):
+        return 1
 
-def checkBackup(checkType):
-    if checkType == 'backupType':
-        backupTypeCommand = "grep backup_type {0}/xtrabackup_checkpoints".format(lastFull)
-        result = runCommandWithOutput(backupTypeCommand)
-        status = result[1]
-        if status != 0:
-            return False
-        else:
-            check = result[0].split(' = ')[1]
+    sampleDir = baseDir + '/calibrate-' + str(os.getpid())
+    copyResults = collections.OrderedDict()
+    archiveResults = collections.OrderedDict()
+    try:
+        sampleBytes = makeSample(sampleDir + '/sample', calibrateSize)
+        if sampleBytes == 0:
+            logging.critical('No data in "' + databaseDir + '" to calibrate with')
+            return 1
+        for count in copyCounts:
+            copyThreads = count
+            dropCache(sampleDir + '/sample')
+            started = time.time()
+            if copyTree(sampleDir + '/sample', sampleDir + '/copy') == 1:
+                return 1
+            copyResults[count] = round(sampleBytes / 1048576.0 / max(time.time() - started, 0.001), 1)
+            removeEntry(sampleDir + '/copy', True)
+            if os.path.exists(sampleDir + '/copy.checksums'):
+                os.remove(sampleDir + '/copy.checksums')
+            print('  copy     {0:>3} threads {1:>10.1f} MB/s'.format(count, copyResults[count]))
+        for count in workerCounts:
+            archiveWorkers = count
+            with open(os.devnull, 'wb') as out:
+                writer = ArchiveWriter(out, archiveCodec, codecLevel(archiveCodec))
+                try:
+                    for name in sorted(os.listdir(sampleDir + '/sample')):
+                        with open(sampleDir + '/sample/' + name, 'rb') as src:
+                            shutil.copyfileobj(src, writer, archiveChunkSize)
+                finally:
+                    writer.close()
+            archiveResults[count] = round(writer.rawBytes / 1048576.0 / max(writer.elapsed, 0.001), 1)
+            print('  {0:<8} {1:>3} workers {2:>10.1f} MB/s'.format(archiveCodec, count, archiveResults[count]))
+    except (IOError, OSError) as exception:
+        logging.critical('Calibration failed: ' + str(exception))
+        return 1
+    finally:
+        if os.path.isdir(sampleDir):
+            shutil.rmtree(sampleDir)
 
-        if check != 'full-prepared':
-            return False
-        else:
-            return True
+    result = {
+        'timestamp': time.strftime("%Y-%m-%d_%H-%M-%S"),
+        'cores': hostCores,
+        'sampleBytes': sampleBytes,
+        'codec': archiveCodec,
+        'copy': copyResults,
+        'archive': archiveResults,
+        'copyThreads': kneeOf(copyResults),
+        'archiveWorkers': kneeOf(archiveResults),
+    }
+    writeManifest(calibrationFile, result)
+    msg = 'Calibrated: copyThreads = {0}, archiveWorkers = {1}, saved in "{2}"'.format(result['copyThreads'], result['archiveWorkers'], calibrationFile)
+    logging.info(msg)
+    print(msg)
+    return 0
 
-    elif checkType == 'lsn':
-        fullLsnCommand = "grep to_lsn {0}/xtrabackup_checkpoints".format(lastFull)
-        result = runCommandWithOutput(fullLsnCommand)
-        status = result[1]
-        if status != 0:
-            return False
-        else:
-            fullLsn = result[0].split(' = ')[1]
 
-        incLsnCommand = "grep to_lsn {0}/xtrabackup_checkpoints".format(lastInc)
-        result = runCommandWithOutput(incLsnCommand)
-        status = result[1]
-        if status != 0:
-            return False
-        else:
-            incLsn = result[0].split(' = ')[1]
+def resumeRun():
+    # Pick up the newest failed (or crashed) backup of this type, as long
+    # as nothing of the same type completed after it
+    global resumed, timeStamp, targetDir
+    rows = catalogQuery('SELECT * FROM backups WHERE type = ? ORDER BY id DESC LIMIT 1', (args.backupType,))
+    if len(rows) == 0 or rows[0]['state'] == 'completed':
+        logging.critical('No failed ' + args.backupType + ' backup to resume')
+        return 1
 
-        logging.debug('Full backup LSN "' + str(fullLsn) + '"')
-        logging.debug('Incremental backup LSN "' + str(incLsn) + '"')
+    resumed = dict(rows[0])
+    timeStamp = resumed['id']
+    targetDir = resumed['path']
+    runStats['timestamp'] = timeStamp
+    runStats['resumed'] = True
+    for phase in catalogQuery('SELECT name FROM phases WHERE backup_id = ? AND state = ?', (timeStamp, 'completed')):
+        completedPhases.add(phase['name'])
+    logging.info('Resuming ' + args.backupType + ' backup ' + timeStamp + ', completed phases: ' + (', '.join(sorted(completedPhases)) or 'none'))
+    return 0
 
-        if fullLsn == incLsn:
-            return True
-        else:
-            return False
 
+def phaseCompleted(name):
+    return name in completedPhases
+
+
+def clearPartial(path):
+    # Leftovers of an interrupted phase are in the way of redoing it
+    if resumed is None or not os.path.lexists(path):
+        return
+    if args.dryrun:
+        logging.info('Would have removed partial "' + path + '"')
+        return
+    logging.info('Removing partial "' + path + '"')
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
     else:
+        os.remove(path)
+
+
+def incrementApplied(fullPath, incPath):
+    # An apply-log that finished right before a crash must not run twice
+    if resumed is None:
         return False
+    full = readCheckpoints(fullPath)
+    increment = readCheckpoints(incPath)
+    if full is None or increment is None:
+        return False
+    return full.get('to_lsn') == increment.get('to_lsn')
 
 
 def fullBackup(copy):
-    status = checkStatus(fullStatusFile)
-    if status == 'started':
-        logging.critical('Last full backup still running?!')
-        return 1
+    if resumed is None:
+        status = checkStatus(fullStatusFile)
+        if status == 'started':
+            # The lock is ours, so whatever left this behind is gone
+            logging.warning('Last full backup did not finish')
 
     setStatus(fullStatusFile, 'started')
+    catalogRecord(timeStamp, type='full', state='running', path=targetDir, full_id=timeStamp)
 
     # Run the full backup
-    logging.info('Running backup')
-    command = "innobackupex --user={0} --password={1} --socket={2} --no-timestamp {3}/".format(dbuser, dbpass, socketPath, targetDir)
-    status = runCommand(command)
-    if status == 1:
-        return 1
+    if phaseCompleted('backup'):
+        logging.info('Skipping backup, already completed')
+    else:
+        logging.info('Running backup')
+        clearPartial(targetDir)
+        if streaming and copy and not dedupStore:
+            clearPartial(secondaryBaseDir + '/' + timeStamp)
+        startPhase('backup')
+        if streaming:
+            command = "innobackupex --user={0} --password={1} --socket={2} --stream={3} {4}/".format(dbuser, dbpass, socketPath, streamFormat, baseDir) + backupOptions
+            (targets, archive) = streamTargets(copy)
+            status = streamCommand(command, targets, archive, cachedBackupBytes(lastFull))
+        else:
+            command = "innobackupex --user={0} --password={1} --socket={2} --no-timestamp {3}/".format(dbuser, dbpass, socketPath, targetDir) + backupOptions
+            status = runCommand(command, cachedBackupBytes(lastFull))
+            if status == 0:
+                recordBackupSize(targetDir)
+        status = endPhase('backup', status, cachedBackupBytes(targetDir))
+        if status == 1:
+            return 1
+        recordCheckpoints(timeStamp, targetDir)
 
     # Copy the unprepared backup to secondary location
     logging.info('Copying backup to secondary location')
-    if copy:
-        command = "cp -a {0} {1}/".format(targetDir, secondaryBaseDir)
-        status = runCommand(command)
+    if streaming and copy and not dedupStore:
+        logging.debug('Backup already streamed to secondary location')
+        catalogRecord(timeStamp, secondary_path=secondaryBaseDir + '/' + timeStamp)
+    elif copy and phaseCompleted('copy'):
+        logging.info('Skipping copy, already completed')
+    elif copy:
+        clearPartial(secondaryPath())
+        startPhase('copy')
+        status = storeSecondary(targetDir, secondaryPath())
+        status = endPhase('copy', status, cachedBackupBytes(targetDir))
         if status == 1:
             return 1
+        catalogRecord(timeStamp, secondary_path=secondaryPath())
     else:
         logging.warning('Skipping copy to secondary location, not enough free space!')
 
     # Prepare the full backup
-    logging.info('Preparing backup')
-    command = "innobackupex --apply-log --redo-only {0}/".format(targetDir)
-    status = runCommand(command)
-    if status == 1:
-        return 1
+    if phaseCompleted('prepare'):
+        logging.info('Skipping prepare, already completed')
+    else:
+        logging.info('Preparing backup')
+        startPhase('prepare')
+        command = "innobackupex --apply-log --redo-only {0}/".format(targetDir) + prepareOptions
+        status = endPhase('prepare', runCommand(command), cachedBackupBytes(targetDir))
+        if status == 1:
+            return 1
+        recordPrepared(timeStamp, targetDir)
+        snapshotBackup(timeStamp, timeStamp, targetDir)
 
     # Create latest_full link
     if args.dryrun:
@@ -343,50 +4245,105 @@ def fullBackup(copy):
 
 
 def incBackup(incType, copy=True, offsite=True):
-    status = checkStatus(incStatusFile)
-    if status == 'started' and incType != 'first':
-        logging.critical('Last inc backup still running?!')
-        return 1
-
-    if incType == 'first':
-        incBaseDir = lastFull
-        if not checkBackup('backupType'):
-            logging.critical('Full backup is not fully prepared!')
-            return 1
+    if resumed is not None:
+        # The chain was validated when the resumed run started
+        full = catalogBackup(resumed['full_id'])
+        parent = resumed['parent']
+        incBaseDir = catalogBackup(parent)['path']
     else:
-        incBaseDir = lastInc
-        if not checkBackup('lsn'):
-            logging.critical('Last backup is not fully prepared!')
-            return 1
+        status = checkStatus(incStatusFile)
+        if status == 'started' and incType != 'first':
+            # The lock is ours, so whatever left this behind is gone
+            logging.warning('Last inc backup did not finish')
+
+        syncCatalog()
+        full = latestBackup(['full'])
+        if incType == 'first':
+            incBaseDir = lastFull
+            if not checkBackup('backupType'):
+                logging.critical('Full backup is not fully prepared!')
+                return 1
+            parent = full['id']
+        else:
+            incBaseDir = lastInc
+            if not checkBackup('lsn'):
+                logging.critical('Last backup is not fully prepared!')
+                return 1
+            parent = latestBackup(['firstinc', 'inc', 'lastinc'], fullId=full['id'])['id']
 
     setStatus(incStatusFile, 'started')
+    catalogRecord(timeStamp, type=args.backupType, state='running', path=targetDir, parent=parent, full_id=full['id'])
 
     # Run the incremental backup
-    logging.info('Running backup')
-    command = "innobackupex --user={0} --password={1} --socket={2} --incremental {3} --incremental-basedir={4}/ --no-timestamp".format(dbuser, dbpass, socketPath, targetDir, incBaseDir)
-    status = runCommand(command)
-    if status == 1:
-        return 1
+    if phaseCompleted('backup'):
+        logging.info('Skipping backup, already completed')
+    else:
+        logging.info('Running backup')
+        clearPartial(targetDir)
+        if streaming and copy and not dedupStore:
+            clearPartial(secondaryBaseDir + '/' + timeStamp)
+        startPhase('backup')
+        if streaming:
+            command = "innobackupex --user={0} --password={1} --socket={2} --incremental --incremental-basedir={3}/ --stream={4} {5}/".format(dbuser, dbpass, socketPath, incBaseDir, streamFormat, baseDir) + backupOptions
+            (targets, archive) = streamTargets(copy)
+            status = streamCommand(command, targets, archive)
+        else:
+            command = "innobackupex --user={0} --password={1} --socket={2} --incremental {3} --incremental-basedir={4}/ --no-timestamp".format(dbuser, dbpass, socketPath, targetDir, incBaseDir) + backupOptions
+            status = runCommand(command)
+            if status == 0:
+                recordBackupSize(targetDir)
+        status = endPhase('backup', status, cachedBackupBytes(targetDir))
+        if status == 1:
+            return 1
+        recordCheckpoints(timeStamp, targetDir)
 
     # Copy the unprepared backup to secondary location
     logging.info('Copying backup to secondary location')
-    if copy:
-        command = "cp -a {0} {1}/".format(targetDir, secondaryBaseDir)
-        status = runCommand(command)
+    if streaming and copy and not dedupStore:
+        logging.debug('Backup already streamed to secondary location')
+        catalogRecord(timeStamp, secondary_path=secondaryBaseDir + '/' + timeStamp)
+    elif copy and phaseCompleted('copy'):
+        logging.info('Skipping copy, already completed')
+    elif copy:
+        clearPartial(secondaryPath())
+        startPhase('copy')
+        status = storeSecondary(targetDir, secondaryPath())
+        status = endPhase('copy', status, cachedBackupBytes(targetDir))
         if status == 1:
             return 1
+        catalogRecord(timeStamp, secondary_path=secondaryPath())
     else:
         logging.warning('Skipping copy to secondary location, not enough free space!')
 
     # Prepare the incremental backup
-    logging.info('Preparing backup')
-    if incType == 'lastinc':
-        command = "innobackupex --apply-log {0}/ --incremental-dir={1}/".format(lastFull, targetDir)
+    if lazyPrepare and incType != 'last':
+        logging.info('Lazy prepare, increment left for the next batch')
+    elif phaseCompleted('prepare') or incrementApplied(lastFull, targetDir):
+        logging.info('Skipping prepare, already applied to the full backup')
+    elif lazyPrepare:
+        # Everything captured since the last batch, checked by LSN
+        logging.info('Preparing pending increments')
+        startPhase('prepare')
+        pending = pendingIncrements(catalogBackup(full['id']), timeStamp)
+        if pending is None:
+            status = 1
+        else:
+            status = applyIncrements(full, pending)
+        status = endPhase('prepare', status, sum(cachedBackupBytes(inc['path']) or 0 for inc in pending or []))
+        if status == 1:
+            return 1
     else:
-        command = "innobackupex --apply-log --redo-only {0}/ --incremental-dir={1}/".format(lastFull, targetDir)
-    status = runCommand(command)
-    if status == 1:
-        return 1
+        logging.info('Preparing backup')
+        startPhase('prepare')
+        if incType == 'last':
+            command = "innobackupex --apply-log {0}/ --incremental-dir={1}/".format(lastFull, targetDir) + prepareOptions
+        else:
+            command = "innobackupex --apply-log --redo-only {0}/ --incremental-dir={1}/".format(lastFull, targetDir) + prepareOptions
+        status = endPhase('prepare', runCommand(command), cachedBackupBytes(targetDir))
+        if status == 1:
+            return 1
+        snapshotBackup(timeStamp, full['id'], lastFull)
+    recordPrepared(full['id'], lastFull)
 
     # Create latest_inc link
     if args.dryrun:
@@ -404,65 +4361,84 @@ def incBackup(incType, copy=True, offsite=True):
 
     if args.backupType == 'lastinc':
         # Get name of full backup
-        logging.debug('Getting name of full backup')
-        command = "readlink {0}".format(lastFull)
-        result = runCommandWithOutput(command)
-        status = result[1]
-        if status != 0:
-            return 1
-        else:
-            fullName = result[0].split('/')[-1]
-
+        fullName = full['id']
         logging.debug('Full backup name: "' + fullName + '"')
 
         # Prepare the full backup
-        logging.info('Preparing full backup')
-        command = "innobackupex --apply-log {0}/".format(lastFull)
-        status = runCommand(command)
-        if status == 1:
-            return 1
+        if phaseCompleted('prepare-full'):
+            logging.info('Skipping full backup prepare, already completed')
         else:
-            setStatus(incStatusFile, 'completed')
+            logging.info('Preparing full backup')
+            startPhase('prepare-full')
+            command = "innobackupex --apply-log {0}/".format(lastFull) + prepareOptions
+            status = endPhase('prepare-full', runCommand(command), cachedBackupBytes(lastFull))
+            if status == 1:
+                return 1
+            else:
+                recordPrepared(fullName, lastFull)
+                setStatus(incStatusFile, 'completed')
 
         # Tar and compress newly prepared full backup
-        freeSpace = checkFreeSpace(lastFull, baseDir, 1)
-        if not freeSpace:
-            logging.warning('Not enough free space, skipping archiving!')
-            return 1
-
-        logging.info('Archiving full backup')
-        tarball = "{0}/prepared/{1}.tar.bz2".format(baseDir, fullName)
-        command = "tar caf {0} {1}/prepared/{2}".format(tarball, baseDir, fullName)
-        status = runCommand(command)
-        if status == 1:
-            return 1
+        tarball = "{0}/prepared/{1}.tar.{2}".format(baseDir, fullName, archiveCodecs.get(archiveCodec, (archiveCodec, None))[0])
+        archived = catalogBackup(fullName) or {}
+        if phaseCompleted('archive') and (archived.get('offsite_path') or os.path.isfile(tarball)):
+            logging.info('Skipping archiving, already completed')
         else:
-            setStatus(incStatusFile, 'completed')
-
-        if offsite:
-            logging.info('Moving archive to offsite location')
-            if args.dryrun:
-                freeSpace = checkFreeSpace(lastFull, baseDir, 1)
-            else:
-                freeSpace = checkFreeSpace(tarball, offsiteBaseDir, 1)
-
+            freeSpace = checkFreeSpace(lastFull, baseDir, 1, archiveStagingKB())
             if not freeSpace:
-                logging.warning('Not enough free space, not moving archive!')
+                logging.warning('Not enough free space, skipping archiving!')
                 return 1
 
-            # Move newly created tar.gz-file to online share. The transfer speed is limited to 8000kB/sec.
-            command = "rsync -rlvc --bwlimit=5000 {0} {1}/".format(tarball, offsiteBaseDir)
-            status = runCommand(command)
+            logging.info('Archiving full backup')
+            clearPartial(tarball)
+            startPhase('archive')
+            status = archiveBackup("{0}/prepared/{1}".format(baseDir, fullName), tarball)
+            status = endPhase('archive', status, cachedBackupBytes(lastFull))
             if status == 1:
                 return 1
             else:
-                logging.debug('Copying of bzipped backup to online share successful')
+                catalogRecord(fullName, archive=tarball)
+                setStatus(incStatusFile, 'completed')
+
+        if offsite and phaseCompleted('cleanup'):
+            logging.info('Skipping move to offsite location, already completed')
+        elif offsite:
+            if phaseCompleted('transfer'):
+                logging.info('Skipping transfer, already completed')
+            else:
+                logging.info('Moving archive to offsite location')
+                if args.dryrun:
+                    freeSpace = checkFreeSpace(lastFull, baseDir, 1)
+                else:
+                    freeSpace = all(checkFreeSpace(tarball, target['path'], 1) for target in offsiteDestinations
+                                    if not remoteDestination(target['path']) and os.path.isdir(target['path']))
+
+                if not freeSpace:
+                    logging.warning('Not enough free space, not moving archive!')
+                    return 1
+
+                # Move newly created archive to every offsite destination. The transfer speed is limited per
+                # destination. An interrupted transfer continues from its manifest.
+                startPhase('transfer')
+                status = transferFile(tarball, offsiteDestinations)
+                status = endPhase('transfer', status, cachedBackupBytes(tarball))
+                if status == 1:
+                    return 1
+                else:
+                    logging.debug('Copying of bzipped backup to online share successful')
+                    catalogRecord(fullName, offsite_path=offsiteBaseDir + '/' + os.path.basename(tarball))
+            startPhase('cleanup')
+            tarballBytes = cachedBackupBytes(tarball)
             command = "rm {0}".format(tarball)
-            status = runCommand(command)
+            status = endPhase('cleanup', runCommand(command), tarballBytes)
             if status == 1:
                 return 1
             else:
                 logging.debug('Removal of locally stored bzipped backup file successful')
+                catalogRecord(fullName, archive=None)
+                for sidecar in archiveSidecars:
+                    if os.path.exists(tarball + sidecar) and not args.dryrun:
+                        os.remove(tarball + sidecar)
         else:
             logging.warning('Skipping move to offsite location')
 
@@ -471,9 +4447,620 @@ def incBackup(incType, copy=True, offsite=True):
     return 0
 
 
+def jobGroup(backupType):
+    # Jobs in the same group never run at the same time
+    if backupType in ['firstinc', 'inc', 'lastinc', 'prepare']:
+        return 'inc'
+    return backupType
+
+
+def acquireLock(group):
+    # Held until the process exits, so a crashed run never blocks the next one
+    lockFile = open(settings['logDir'] + '/lock-' + group, 'a')
+    try:
+        fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lockFile.close()
+        return False
+    heldLocks[group] = lockFile
+    return True
+
+
+def lockHeld(group):
+    if not acquireLock(group):
+        return True
+    heldLocks.pop(group).close()
+    return False
+
+
+def parseSchedule(spec):
+    # "<days> <HH:MM>[,<HH:MM>...]", days being *, Mon, Mon-Fri or Mon,Wed
+    (daySpec, timeSpec) = spec.split()
+    days = set()
+    for part in daySpec.split(','):
+        if part == '*':
+            days.update(range(7))
+        elif '-' in part:
+            (first, last) = [weekDays.index(day.capitalize()) for day in part.split('-')]
+            days.update(range(first, last + 1))
+        else:
+            days.add(weekDays.index(part.capitalize()))
+    times = sorted(tuple(int(value) for value in clock.split(':')) for clock in timeSpec.split(','))
+    return (days, times)
+
+
+def nextRun(schedule, after):
+    (days, times) = schedule
+    today = time.localtime(after)
+    for offset in range(8):
+        for (hour, minute) in times:
+            candidate = time.mktime((today.tm_year, today.tm_mon, today.tm_mday + offset, hour, minute, 0, 0, 0, -1))
+            if candidate > after and time.localtime(candidate).tm_wday in days:
+                return candidate
+    return None
+
+
+def startRun(backupType):
+    # Fresh per-run state for a job forked off by the daemon
+    global timeStamp, targetDir, statsFile, catalogConnection
+    args.backupType = backupType
+    args.resume = False
+    args.id = None
+    timeStamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+    targetDir = baseDir + '/prepared/' + timeStamp
+    statsFile = settings['logDir'] + '/stats-' + backupType
+    runStats.update(backupType=backupType, timestamp=timeStamp, status='running',
+                    started=time.time(), phases=collections.OrderedDict())
+    # SQLite connections must not cross a fork
+    catalogConnection = None
+    startLogging(forked=True)
+    sizeMemory()
+    logging.debug('Applying logs with --use-memory=' + str(resourceProfile['useMemory']) + 'M')
+    signal.signal(signal.SIGTERM, cancelRun)
+    signal.signal(signal.SIGINT, cancelRun)
+    logging.info('Starting ' + backupType + ' backup run')
+
+
+def stopDaemon(signum, frame):
+    logging.info('Received signal ' + str(signum) + ', stopping daemon')
+    daemonStopping.set()
+
+
+def daemonStatus(jobs):
+    status = {'pid': os.getpid(), 'jobs': collections.OrderedDict()}
+    for (backupType, job) in jobs.items():
+        status['jobs'][backupType] = dict((key, job[key]) for key in job if key != 'schedule')
+        if job['next'] is not None:
+            status['jobs'][backupType]['next'] = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime(job['next']))
+    return json.dumps(status, indent=2)
+
+
+def controlRequest(connection, jobs):
+    # One command per connection: status, run <type> or cancel <type>
+    connection.settimeout(5)
+    request = b''
+    while not request.endswith(b'\n') and len(request) < 1024:
+        data = connection.recv(1024)
+        if not data:
+            break
+        request += data
+    words = request.decode('utf-8', 'replace').split()
+    if len(words) == 1 and words[0] == 'status':
+        return daemonStatus(jobs)
+    if len(words) == 2 and words[0] == 'run' and words[1] in daemonJobTypes:
+        job = jobs.setdefault(words[1], {'schedule': None, 'next': None, 'state': 'idle', 'pid': None,
+                                         'pending': False, 'lastStarted': None, 'lastResult': None})
+        job['pending'] = True
+        logging.info('Control socket: ' + words[1] + ' requested')
+        return 'ok ' + words[1] + ' queued'
+    if len(words) == 2 and words[0] == 'cancel' and words[1] in jobs and jobs[words[1]]['pid'] is not None:
+        os.kill(jobs[words[1]]['pid'], signal.SIGTERM)
+        logging.info('Control socket: ' + words[1] + ' cancelled')
+        return 'ok ' + words[1] + ' cancelled'
+    return 'error unknown command "' + ' '.join(words) + '"'
+
+
+def runDaemon():
+    # Keep the settings loaded and fork a child for every job that is due.
+    # Only returns in a child, which then carries on as a normal run.
+    jobs = collections.OrderedDict()
+    for backupType in daemonJobTypes:
+        spec = settings['schedule' + backupType.capitalize()]
+        if spec == '':
+            continue
+        try:
+            schedule = parseSchedule(spec)
+        except ValueError:
+            logging.critical('Invalid schedule "' + spec + '" for ' + backupType)
+            sys.exit(1)
+        jobs[backupType] = {'schedule': schedule, 'next': nextRun(schedule, time.time()), 'state': 'idle',
+                            'pid': None, 'pending': False, 'lastStarted': None, 'lastResult': None}
+        logging.info('Scheduled ' + backupType + ' for ' + time.strftime('%Y-%m-%d %H:%M', time.localtime(jobs[backupType]['next'])))
+
+    if os.path.exists(controlSocket):
+        os.remove(controlSocket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(controlSocket)
+    os.chmod(controlSocket, 0o600)
+    server.listen(5)
+
+    signal.signal(signal.SIGTERM, stopDaemon)
+    signal.signal(signal.SIGINT, stopDaemon)
+    logging.info('Daemon started, control socket "' + controlSocket + '"')
+
+    while not daemonStopping.is_set():
+        # Collect finished jobs
+        for job in jobs.values():
+            if job['pid'] is None:
+                continue
+            (pid, status) = os.waitpid(job['pid'], os.WNOHANG)
+            if pid == 0:
+                continue
+            job['pid'] = None
+            job['state'] = 'idle'
+            job['lastResult'] = 'ok' if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0 else 'failed'
+
+        now = time.time()
+        for (backupType, job) in jobs.items():
+            if job['next'] is not None and job['next'] <= now:
+                job['pending'] = True
+                job['next'] = nextRun(job['schedule'], now)
+
+        # Start what is due once nothing else in its group is running
+        busy = set(jobGroup(backupType) for (backupType, job) in jobs.items() if job['pid'] is not None)
+        for (backupType, job) in jobs.items():
+            group = jobGroup(backupType)
+            if not job['pending'] or group in busy:
+                continue
+            if lockHeld(group):
+                job['state'] = 'waiting'
+                continue
+            # Nothing may sit in a log buffer when the process is copied
+            stopLogging()
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                startRun(backupType)
+                return
+            startLogging()
+            logging.info('Started ' + backupType + ' as process ' + str(pid))
+            busy.add(group)
+            job.update(pid=pid, state='running', pending=False, lastStarted=time.strftime("%Y-%m-%d_%H-%M-%S"))
+
+        try:
+            (readable, writable, exceptional) = select.select([server], [], [], 1.0)
+        except (OSError, select.error):
+            continue
+        if server in readable:
+            (connection, address) = server.accept()
+            try:
+                connection.sendall((controlRequest(connection, jobs) + '\n').encode('utf-8'))
+            except (IOError, OSError) as exception:
+                logging.warning('Control socket: ' + str(exception))
+            finally:
+                connection.close()
+
+    # Let running jobs stop cleanly
+    for job in jobs.values():
+        if job['pid'] is not None:
+            os.kill(job['pid'], signal.SIGTERM)
+            os.waitpid(job['pid'], 0)
+    server.close()
+    os.remove(controlSocket)
+    logging.info('Daemon stopped')
+    sys.exit(0)
+
+
+def controlDaemon(command):
+    # Send one command to a running daemon and print the answer
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(controlSocket)
+        client.sendall((command + '\n').encode('utf-8'))
+        response = b''
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            response += data
+    except (IOError, OSError) as exception:
+        print('Unable to reach the daemon on "' + controlSocket + '": ' + str(exception))
+        return 1
+    finally:
+        client.close()
+    response = response.decode('utf-8').strip()
+    print(response)
+    if response.startswith('error'):
+        return 1
+    return 0
+
+
+def acquireSlot(prefix, count, wait=True):
+    # One of count lock files in the global logDir, shared by every
+    # instance; the slot is held until the file is closed or the process ends
+    while True:
+        for index in range(count):
+            slot = open(globalLogDir + '/' + prefix + '-' + str(index), 'a')
+            try:
+                fcntl.flock(slot.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except (IOError, OSError):
+                slot.close()
+        if not wait or cancelled.is_set():
+            return None
+        time.sleep(1)
+
+
+def lockDevice(device):
+    # Registering with a device and sweeping its stale registrations
+    # exclude each other, so a registration is never removed between its
+    # open and its flock
+    lock = open(globalLogDir + '/io-' + str(device) + '.lock', 'a')
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    return lock
+
+
+def deviceJobs(device):
+    # Jobs writing to a device right now, counted by their live lock files
+    directory = globalLogDir + '/io-' + str(device)
+    count = 0
+    if not os.path.isdir(directory):
+        return count
+    lock = lockDevice(device)
+    try:
+        for entry in os.scandir(directory):
+            try:
+                fd = os.open(entry.path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                # Nobody holds it any more
+                os.remove(entry.path)
+            except (IOError, OSError):
+                count += 1
+            finally:
+                os.close(fd)
+    finally:
+        lock.close()
+    return count
+
+
+def diskStats(name):
+    # (reads, writes, milliseconds spent on them, milliseconds busy) of a
+    # block device, from /proc/diskstats
+    with open('/proc/diskstats', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if fields[2] == name:
+                return (int(fields[3]), int(fields[7]), int(fields[6]) + int(fields[10]), int(fields[12]))
+    raise IOError(errno.ENODEV, 'No device "' + name + '" in /proc/diskstats')
+
+
+def databaseDevice():
+    # Name of the block device databaseDir is on, as in /proc/diskstats
+    if throttleDevice != '':
+        return throttleDevice
+    device = os.stat(databaseDir).st_dev
+    try:
+        with open('/sys/dev/block/{0}:{1}/uevent'.format(os.major(device), os.minor(device)), 'r') as f:
+            for line in f:
+                if line.startswith('DEVNAME='):
+                    return line.strip().split('=', 1)[1]
+    except IOError:
+        pass
+    return None
+
+
+def throttleLoop(bucket, name):
+    # Additive increase, multiplicative decrease: halve the rate as soon as
+    # the database device is busy or slow, raise it by a tenth of
+    # throttleMax for every interval it stays below half of throttleBusy
+    step = max(throttleMax // 10, 1)
+    (reads, writes, ioTime, busyTime) = diskStats(name)
+    sampled = time.time()
+    while not cancelled.wait(throttleInterval):
+        try:
+            current = diskStats(name)
+        except IOError as exception:
+            logging.warning('Adaptive throttling stopped: ' + str(exception))
+            return
+        now = time.time()
+        ios = current[0] - reads + current[1] - writes
+        latency = float(current[2] - ioTime) / ios if ios > 0 else 0.0
+        utilization = 100.0 * (current[3] - busyTime) / max((now - sampled) * 1000, 1)
+        (reads, writes, ioTime, busyTime) = current
+        sampled = now
+
+        rate = bucket.rate
+        if utilization > throttleBusy or latency > throttleLatency:
+            rate = max(rate // 2, throttleMin)
+        elif utilization < throttleBusy / 2.0:
+            rate = min(rate + step, throttleMax)
+        msg = 'Throttle {0}: {1:.0f}% busy, {2:.1f} ms per I/O, {3} -> {4} KB/s'.format(name, utilization, latency, bucket.rate, rate)
+        if rate != bucket.rate:
+            logging.info(msg)
+            with bucket.lock:
+                bucket.rate = rate
+        else:
+            logging.debug(msg)
+
+
+def startThrottle():
+    global ioThrottle
+    name = databaseDevice()
+    try:
+        if name is None:
+            raise IOError(errno.ENODEV, 'no block device for "' + databaseDir + '"')
+        diskStats(name)
+    except IOError as exception:
+        logging.warning('Adaptive throttling disabled, ' + str(exception) + ', set throttleDevice')
+        ioThrottle = TokenBucket(0)
+        return
+    logging.info('Adaptive throttling on "' + name + '", starting at ' + str(throttleMax) + ' KB/s')
+    ioThrottle = TokenBucket(throttleMax)
+    thread = threading.Thread(target=throttleLoop, args=(ioThrottle, name))
+    thread.daemon = True
+    thread.start()
+
+
+def registerDevice(path):
+    # Count this run as a writer to the device holding path; the lock file
+    # is opened and locked once, by the main thread, before any worker
+    # starts: a second flock on another open of the same file would wait
+    # for the first one forever
+    device = os.stat(mountPoint(path)).st_dev
+    with deviceBucketsLock:
+        if device in deviceBuckets:
+            return
+        directory = globalLogDir + '/io-' + str(device)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        lock = lockDevice(device)
+        try:
+            registration = open(directory + '/' + str(os.getpid()), 'a')
+            fcntl.flock(registration.fileno(), fcntl.LOCK_EX)
+        finally:
+            lock.close()
+        deviceBuckets[device] = TokenBucket(deviceBwlimit, device=device, parent=ioThrottle)
+        deviceBuckets[device].registration = registration
+
+
+def startIo(paths):
+    # Once per run, before any copy, archive or transfer thread: the
+    # adaptive throttle and the registration with every device written to
+    if args.dryrun:
+        return
+    if adaptiveThrottle:
+        startThrottle()
+    if deviceBwlimit > 0:
+        for path in paths:
+            registerDevice(path)
+
+
+def deviceBucket(path):
+    # Share of deviceBwlimit for writes to the device holding path, within
+    # the adaptive limit
+    if deviceBwlimit <= 0 or args.dryrun:
+        return TokenBucket(0, parent=ioThrottle)
+    device = os.stat(path).st_dev
+    with deviceBucketsLock:
+        if device not in deviceBuckets:
+            # Not registered up front: share with the others without
+            # being counted by them
+            logging.debug('Writing to unregistered device ' + str(device))
+            deviceBuckets[device] = TokenBucket(deviceBwlimit, device=device, parent=ioThrottle)
+        return deviceBuckets[device]
+
+
+def runInstances():
+    # Run the same command for every instance section, each in its own
+    # process; job slots, device budgets and compression CPU are shared
+    # through lock files in the global logDir
+    command = [sys.executable, os.path.abspath(sys.argv[0]), args.backupType, '-s', os.path.abspath(args.settings)]
+    if args.dryrun:
+        command.append('--dryrun')
+    if not args.no_offsite:
+        command.append('--no-offsite')
+    if args.resume:
+        command.append('--resume')
+    if args.id is not None:
+        command += ['--id', args.id]
+    if args.time is not None:
+        command += ['--time', args.time]
+    if args.files is not None:
+        command += ['--files', args.files]
+    if args.backupType == 'control':
+        command += ['--command', args.command]
+    if args.backupType == 'status':
+        command += ['--format', args.format]
+
+    # Backups are named by time, so instances sharing a directory would
+    # overwrite each other
+    for key in ['baseDir', 'secondaryBaseDir', 'offsiteBaseDir']:
+        directories = [instances[name].get(key, sharedSettings.get(key)) for name in instances]
+        if len(set(directories)) < len(directories):
+            logging.critical('Every instance needs its own ' + key + '!')
+            return 1
+
+    # Each instance restores into its own subdirectory of --target, or
+    # into its own databaseDir without one
+    if args.backupType == 'restore' and args.target is None:
+        directories = [instances[name].get('databaseDir', sharedSettings.get('databaseDir')) for name in instances]
+        if len(set(directories)) < len(directories):
+            logging.critical('Every instance needs its own databaseDir to restore without --target!')
+            return 1
+    if args.backupType == 'restore' and args.target is not None and not args.dryrun:
+        if not os.path.isdir(args.target):
+            os.makedirs(args.target)
+
+    # Listings go one instance at a time so the output stays readable
+    sequential = args.backupType in ['catalog', 'snapshots', 'status', 'control', 'calibrate']
+    started = time.time()
+    children = []
+    outputs = []
+    for name in instances:
+        logging.info('Starting ' + args.backupType + ' for instance ' + name)
+        instanceCommand = command + ['--instance', name]
+        if args.target is not None:
+            instanceCommand += ['--target', os.path.join(args.target, name)]
+        # Monitoring agents get one answer for all instances
+        if args.backupType == 'status':
+            proc = Popen(instanceCommand, stdout=PIPE, universal_newlines=True)
+            outputs.append((name, proc.communicate()[0], proc.returncode))
+            continue
+        if sequential:
+            print('[' + name + ']')
+            sys.stdout.flush()
+        proc = Popen(instanceCommand)
+        children.append((name, proc))
+        if sequential:
+            proc.wait()
+    if args.backupType == 'status':
+        return showInstanceStatus(outputs)
+
+    def forward(signum, frame):
+        logging.critical('Received signal ' + str(signum) + ', stopping instances')
+        for (name, proc) in children:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    status = 0
+    for (name, proc) in children:
+        proc.wait()
+        if proc.returncode != 0:
+            logging.critical('Instance ' + name + ' failed with return code "' + str(proc.returncode) + '"')
+            status = 1
+
+    if args.backupType in ['full', 'firstinc', 'inc', 'lastinc'] and not args.dryrun:
+        recordInstanceStats(time.time() - started)
+    return status
+
+
+def recordInstanceStats(elapsed):
+    # Throughput of all instances together over the wall time of the run
+    aggregate = {
+        'backupType': args.backupType,
+        'timestamp': timeStamp,
+        'seconds': round(elapsed, 3),
+        'instances': collections.OrderedDict(),
+    }
+    totalBytes = 0
+    for name in instances:
+        logDir = instances[name].get('logDir', globalLogDir + '/' + name)
+        try:
+            with open(logDir + '/stats-' + args.backupType + '.json', 'r') as f:
+                stats = json.load(f)
+        except (IOError, ValueError):
+            logging.warning('No statistics for instance ' + name)
+            continue
+        instanceBytes = sum(phase.get('bytes') or 0 for phase in stats['phases'].values())
+        totalBytes += instanceBytes
+        aggregate['instances'][name] = {'status': stats['status'], 'seconds': stats.get('seconds'), 'bytes': instanceBytes}
+    aggregate['bytes'] = totalBytes
+    aggregate['mbPerSecond'] = round(totalBytes / 1048576.0 / max(elapsed, 0.001), 2)
+    logging.info('{0} instance(s): {1} MB in {2:.1f}s ({3:.1f} MB/s)'.format(
+        len(aggregate['instances']), totalBytes // 1048576, elapsed, aggregate['mbPerSecond']))
+    try:
+        with open(statsFile + '.json.tmp', 'w') as f:
+            json.dump(aggregate, f, indent=1)
+        os.rename(statsFile + '.json.tmp', statsFile + '.json')
+    except (IOError, OSError):
+        logging.warning('Unable to write "' + statsFile + '.json"')
+
+
 # Main
 # ----
 
+# Kill running commands and stop the run on termination
+signal.signal(signal.SIGTERM, cancelRun)
+signal.signal(signal.SIGINT, cancelRun)
+
+# Write the run statistics however the run ends
+atexit.register(finishRun)
+
+# Several instances: this process only starts one run per instance
+if args.instance is None and len(instances) > 0:
+    sys.exit(runInstances())
+
+# Talk to a running daemon
+if args.backupType == 'control':
+    sys.exit(controlDaemon(args.command))
+
+# Monitoring agents poll this, it only reads the status store
+if args.backupType == 'status':
+    sys.exit(showStatus(args.format))
+
+# The daemon forks a child for every job, which carries on below as if
+# it had been started from cron
+if args.backupType == 'daemon':
+    runDaemon()
+
+# Catalog listing does not touch any backups
+if args.backupType == 'catalog':
+    sys.exit(showCatalog(args.id))
+if args.backupType == 'snapshots':
+    sys.exit(showSnapshots())
+
+# Retention only removes expired backups
+if args.backupType == 'cleanup':
+    if not acquireLock('cleanup'):
+        logging.critical('Cleanup already running')
+        sys.exit(1)
+    sys.exit(cleanupBackups())
+
+# Verification only reads the copies
+if args.backupType == 'verify':
+    sys.exit(verifyBackups(args.id))
+
+# Calibration only reads the datadir and writes scratch files in baseDir
+if args.backupType == 'calibrate':
+    startIo([baseDir])
+    sys.exit(calibrate())
+
+# Restore writes into an empty datadir, never into the backups
+if args.backupType == 'restore':
+    startIo([args.target or databaseDir])
+    sys.exit(restoreBackup(args.time, args.target or databaseDir, args.files))
+
+# One run per chain at a time; the lock goes with the process, so a
+# crashed run never blocks the next one
+if not acquireLock(jobGroup(args.backupType)):
+    msg = 'Last ' + jobGroup(args.backupType) + ' backup still running?!'
+    logging.critical(msg)
+    if args.backupType == 'full':
+        setMonitor(fullMonitorFile, 'critical', msg)
+    else:
+        setMonitor(incMonitorFile, 'critical', msg)
+    sys.exit(1)
+
+# Wait for one of the job slots shared by all instances
+if maxParallelJobs > 0:
+    logging.debug('Waiting for one of ' + str(maxParallelJobs) + ' job slots')
+    jobSlot = acquireSlot('slot', maxParallelJobs)
+    if jobSlot is None:
+        sys.exit(1)
+
+# Devices and throttle are set up before any worker thread needs them
+startIo([baseDir, secondaryBaseDir] + [target['path'] for target in offsiteDestinations
+                                      if not remoteDestination(target['path']) and os.path.isdir(target['path'])])
+
+# Apply pending increments on demand
+if args.backupType == 'prepare':
+    if prepareBackups() == 1:
+        msg = 'Applying pending increments failed!'
+        logging.critical(msg)
+        setMonitor(incMonitorFile, 'critical', msg)
+        sys.exit(1)
+    sys.exit(0)
+
+# Continue an interrupted run instead of starting a new one
+if args.resume:
+    if resumeRun() == 1:
+        sys.exit(1)
+
 # Check some important dirs
 logging.debug('Checking critical directories')
 
@@ -500,12 +5087,8 @@ else:
 if args.backupType == 'full':
     if not os.path.islink(lastFull):
         logging.warning('This seems like the first run, skipping latest_full link')
-        # Check free space
-        freeSpace = checkFreeSpace(databaseDir, baseDir, 1.5)
-        freeSpaceSecondary = checkFreeSpace(databaseDir, secondaryBaseDir, 1.5)
-    else:
-        freeSpace = checkFreeSpace(lastFull, baseDir, 1.5)
-        freeSpaceSecondary = checkFreeSpace(lastFull, secondaryBaseDir, 1.5)
+    # Check free space against the forecast of this run
+    (freeSpace, freeSpaceSecondary) = admitRun('full')
     if not freeSpace:
         msg = 'Not enough free space!'
         logging.critical(msg)
@@ -539,11 +5122,8 @@ if args.backupType == 'full':
 else:
     if not os.path.islink(lastInc):
         logging.warning('This seems like the first run, skipping latest_inc link')
-        freeSpace = checkFreeSpace(databaseDir, baseDir, 1.5)
-        freeSpaceSecondary = checkFreeSpace(databaseDir, secondaryBaseDir, 1.5)
-    else:
-        freeSpace = checkFreeSpace(lastInc, baseDir, 1.5)
-        freeSpaceSecondary = checkFreeSpace(lastInc, secondaryBaseDir, 1.5)
+    # Check free space against the forecast of this run
+    (freeSpace, freeSpaceSecondary) = admitRun(args.backupType)
     if not freeSpace:
         msg = 'Not enough free space!'
         logging.critical(msg)
@@ -0,0 +1,57 @@
+import atexit
+import importlib.util
+import logging
+import os
+import signal
+import sys
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ibex-backup.py')
+
+
+@pytest.fixture(scope='session')
+def ibex(tmp_path_factory):
+    # The script runs its main code on import; a status query against an
+    # empty logDir loads every function and touches nothing
+    root = tmp_path_factory.mktemp('ibex')
+    settingsFile = root / 'settings.conf'
+    settingsFile.write_text('\n'.join([
+        'dbuser = test',
+        'dbpass = test',
+        'baseDir = ' + str(root / 'base'),
+        'secondaryBaseDir = ' + str(root / 'base' / 'unprepared'),
+        'offsiteBaseDir = ' + str(root / 'offsite'),
+        'logDir = ' + str(root / 'log'),
+        'databaseDir = ' + str(root / 'data'),
+        'copyThreads = 4',
+        'archiveWorkers = 2',
+        '',
+    ]))
+    for directory in ['base', 'base/unprepared', 'offsite', 'log', 'data']:
+        (root / directory).mkdir(parents=True, exist_ok=True)
+
+    argv = sys.argv
+    handlers = dict((signum, signal.getsignal(signum)) for signum in [signal.SIGINT, signal.SIGTERM])
+    sys.argv = ['ibex-backup.py', 'status', '-s', str(settingsFile)]
+    spec = importlib.util.spec_from_file_location('ibex_backup', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    # Archive workers get their functions by module name
+    sys.modules['ibex_backup'] = module
+    try:
+        spec.loader.exec_module(module)
+    except SystemExit:
+        pass
+    finally:
+        sys.argv = argv
+        for (signum, handler) in handlers.items():
+            signal.signal(signum, handler)
+    module.root = root
+    yield module
+
+    # Nothing of the script may outlive the session
+    module.stopLogging()
+    atexit.unregister(module.stopLogging)
+    atexit.unregister(module.finishRun)
+    logging.getLogger().removeHandler(module.queueHandler)
+    del sys.modules['ibex_backup']
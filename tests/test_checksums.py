@@ -0,0 +1,94 @@
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def small_chunks(ibex, monkeypatch):
+    monkeypatch.setattr(ibex, 'copyRangeSize', 4096)
+    return 4096
+
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_chunk_hasher_matches_ranges(ibex, tmp_path):
+    data = os.urandom(10000)
+    path = write(tmp_path / 'ibdata1', data)
+    manifest = ibex.Manifest(4096)
+    hasher = ibex.ChunkHasher(manifest, 'ibdata1')
+    # Pieces that do not line up with the chunks
+    for (start, end) in [(0, 1000), (1000, 4000), (4000, 10000)]:
+        hasher.update(data[start:end])
+    hasher.finish()
+
+    entry = manifest.files['ibdata1']
+    assert entry['size'] == 10000
+    assert sorted(entry['chunks']) == [0, 1, 2]
+    for index in range(3):
+        length = min(4096, 10000 - index * 4096)
+        assert entry['chunks'][index] == ibex.hashChunk(path, index * 4096, length, ibex.checksumAlgorithm)
+
+
+def test_chunk_hasher_empty_file(ibex):
+    manifest = ibex.Manifest(4096)
+    hasher = ibex.ChunkHasher(manifest, 'empty')
+    hasher.finish()
+    assert manifest.files['empty'] == {'size': 0, 'chunks': {}}
+
+
+def test_manifest_saves_chunks_in_order(ibex, tmp_path):
+    manifest = ibex.Manifest(4096)
+    manifest.declare('db1/t1.ibd', 9000)
+    for index in [2, 0, 1]:
+        manifest.add('db1/t1.ibd', index, 'digest-' + str(index))
+    manifest.save(str(tmp_path / 'backup.checksums'))
+
+    saved = json.loads((tmp_path / 'backup.checksums').read_text())
+    assert saved['chunkSize'] == 4096
+    assert saved['algorithm'] == ibex.checksumAlgorithm
+    assert saved['files']['db1/t1.ibd'] == {'size': 9000, 'chunks': ['digest-0', 'digest-1', 'digest-2']}
+    assert saved['digest']
+
+
+def test_copy_tree_checksums_verify(ibex, tmp_path, small_chunks):
+    source = tmp_path / 'source'
+    write(source / 'ibdata1', os.urandom(3 * small_chunks + 17))
+    write(source / 'db1' / 't1.ibd', os.urandom(small_chunks))
+    write(source / 'db1' / 'empty.frm', b'')
+    os.link(str(source / 'db1' / 't1.ibd'), str(source / 'db1' / 't1.link'))
+    destination = str(tmp_path / 'copy')
+
+    assert ibex.copyTree(str(source), destination) == 0
+    assert ibex.verifyCopy(destination) == 0
+    # Hardlinks stay hardlinks, and only the first name is checksummed
+    assert os.stat(destination + '/db1/t1.ibd').st_ino == os.stat(destination + '/db1/t1.link').st_ino
+    saved = json.loads(open(destination + '.checksums').read())
+    names = set(saved['files'])
+    assert len(names & {'db1/t1.ibd', 'db1/t1.link'}) == 1
+    assert {'db1/empty.frm', 'ibdata1'} <= names
+    assert len(saved['files']['ibdata1']['chunks']) == 4
+
+    # A single flipped byte in the middle of a chunk is found
+    with open(destination + '/ibdata1', 'r+b') as f:
+        f.seek(small_chunks + 100)
+        byte = f.read(1)
+        f.seek(small_chunks + 100)
+        f.write(bytes([byte[0] ^ 0xff]))
+    assert ibex.verifyCopy(destination) == 1
+
+
+def test_write_checksums_matches_copy(ibex, tmp_path, small_chunks):
+    source = tmp_path / 'source'
+    write(source / 'ibdata1', os.urandom(2 * small_chunks + 1))
+    destination = str(tmp_path / 'copy')
+    assert ibex.copyTree(str(source), destination) == 0
+    copied = json.loads(open(destination + '.checksums').read())['files']
+
+    assert ibex.writeChecksums(str(source)) == 0
+    written = json.loads(open(str(source) + '.checksums').read())['files']
+    assert written == copied
@@ -0,0 +1,131 @@
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def devices(ibex, monkeypatch, tmp_path):
+    monkeypatch.setattr(ibex, 'deviceBwlimit', 1024 * 1024)
+    monkeypatch.setattr(ibex, 'globalLogDir', str(tmp_path / 'log'))
+    monkeypatch.setattr(ibex, 'deviceBuckets', {})
+    yield ibex.deviceBuckets
+    for bucket in ibex.deviceBuckets.values():
+        if bucket.registration is not None:
+            bucket.registration.close()
+
+
+def hammer(ibex, path, threads=16):
+    # Every thread asks for the bucket at once and writes through it
+    barrier = threading.Barrier(threads)
+    buckets = []
+
+    def worker():
+        barrier.wait()
+        bucket = ibex.deviceBucket(path)
+        bucket.consume(4096)
+        buckets.append(bucket)
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in workers), 'workers are stuck on the device bucket'
+    assert len(buckets) == threads, 'workers failed on the device bucket'
+    return buckets
+
+
+def test_registered_device_shared_by_workers(ibex, devices, tmp_path):
+    ibex.registerDevice(str(tmp_path))
+    device = os.stat(str(tmp_path)).st_dev
+    assert ibex.deviceJobs(device) == 1
+
+    buckets = hammer(ibex, str(tmp_path))
+    assert all(bucket is devices[device] for bucket in buckets)
+    # Still one job: workers do not register on their own
+    assert ibex.deviceJobs(device) == 1
+
+
+def test_register_twice_is_one_job(ibex, devices, tmp_path):
+    ibex.registerDevice(str(tmp_path))
+    ibex.registerDevice(str(tmp_path))
+    assert ibex.deviceJobs(os.stat(str(tmp_path)).st_dev) == 1
+
+
+def test_unregistered_device_gets_one_bucket(ibex, devices, tmp_path):
+    buckets = hammer(ibex, str(tmp_path))
+    assert len(set(id(bucket) for bucket in buckets)) == 1
+    assert buckets[0].registration is None
+    assert buckets[0].rate == 1024 * 1024
+
+
+def test_unlimited_without_device_budget(ibex, devices, monkeypatch, tmp_path):
+    monkeypatch.setattr(ibex, 'deviceBwlimit', 0)
+    assert not ibex.deviceBucket(str(tmp_path)).limited()
+    assert devices == {}
+
+
+def stale(ibex, device, count):
+    # Registrations of jobs that are gone: files nobody holds a lock on
+    directory = ibex.globalLogDir + '/io-' + str(device)
+    os.makedirs(directory, exist_ok=True)
+    for pid in range(count):
+        open(directory + '/' + str(1000000 + pid), 'a').close()
+    return directory
+
+
+def test_sweep_keeps_live_registrations(ibex, devices, tmp_path):
+    ibex.registerDevice(str(tmp_path))
+    device = os.stat(str(tmp_path)).st_dev
+    directory = stale(ibex, device, 5)
+    assert ibex.deviceJobs(device) == 1
+    assert os.listdir(directory) == [str(os.getpid())]
+
+
+def test_concurrent_sweeps(ibex, devices, tmp_path):
+    ibex.registerDevice(str(tmp_path))
+    device = os.stat(str(tmp_path)).st_dev
+    stale(ibex, device, 200)
+    counts = []
+    errors = []
+
+    def sweep():
+        try:
+            counts.append(ibex.deviceJobs(device))
+        except Exception as exception:
+            errors.append(exception)
+    sweepers = [threading.Thread(target=sweep) for _ in range(8)]
+    for thread in sweepers:
+        thread.start()
+    for thread in sweepers:
+        thread.join(10)
+    assert errors == []
+    assert counts == [1] * 8
+
+
+def test_vanished_entry_not_counted(ibex, devices, monkeypatch, tmp_path):
+    device = os.stat(str(tmp_path)).st_dev
+    directory = stale(ibex, device, 1)
+    scandir = ibex.os.scandir
+
+    class Gone(object):
+        path = directory + '/gone'
+
+    monkeypatch.setattr(ibex.os, 'scandir', lambda path: [Gone()] + list(scandir(path)))
+    assert ibex.deviceJobs(device) == 0
+
+
+def test_registration_waits_for_sweep(ibex, devices, tmp_path):
+    device = os.stat(str(tmp_path)).st_dev
+    stale(ibex, device, 0)
+    lock = ibex.lockDevice(device)
+    registering = threading.Thread(target=ibex.registerDevice, args=(str(tmp_path),), daemon=True)
+    registering.start()
+    registering.join(0.3)
+    # No registration file may appear while a sweep holds the directory
+    assert registering.is_alive()
+    assert os.listdir(ibex.globalLogDir + '/io-' + str(device)) == []
+    lock.close()
+    registering.join(10)
+    assert not registering.is_alive()
+    assert ibex.deviceJobs(device) == 1
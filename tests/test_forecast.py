@@ -0,0 +1,109 @@
+import json
+import time
+
+import pytest
+
+
+@pytest.fixture
+def history(ibex, monkeypatch, tmp_path):
+    # A catalog and run history of its own for every test
+    monkeypatch.setattr(ibex, 'catalogFile', str(tmp_path / 'catalog.db'))
+    monkeypatch.setattr(ibex, 'catalogConnection', None)
+    monkeypatch.setattr(ibex, 'catalogErrors', 0)
+    monkeypatch.setattr(ibex, 'statsHistoryFile', str(tmp_path / 'stats-history'))
+    monkeypatch.setattr(ibex, 'archiveStatsFile', str(tmp_path / 'archive-stats'))
+    monkeypatch.setattr(ibex, 'snapshots', False)
+    yield tmp_path
+    if ibex.catalogConnection is not None:
+        ibex.catalogConnection.close()
+
+
+def addRuns(path, entries):
+    with open(str(path), 'a') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+
+
+def test_growth_line(ibex):
+    day = 86400
+    points = [(0, 1000), (day, 2000), (2 * day, 3000)]
+    (size, growth) = ibex.growthForecast(points, 3 * day)
+    assert size == 4000
+    assert growth == pytest.approx(1000)
+
+
+def test_growth_needs_a_day(ibex):
+    assert ibex.growthForecast([], 0) == (None, 0)
+    assert ibex.growthForecast([(0, 1000), (600, 5000)], 7200) == (5000, 0)
+
+
+def test_median(ibex):
+    assert ibex.median([]) is None
+    assert ibex.median([3, 1, 2]) == 2
+    assert ibex.median([4, 1, 2, 3]) == 2.5
+
+
+def test_no_history_uses_datadir(ibex, history):
+    (ibex.root / 'data' / 'ibdata1').write_bytes(b'\0' * 1024 * 1024)
+    forecast = ibex.forecastRun('full')
+    assert forecast['basis'].startswith('no history')
+    assert forecast['backupBytes'] == int(ibex.treeSize(ibex.databaseDir) * 1024 * 1.5)
+    assert forecast['writes'][ibex.targetDir] == forecast['backupBytes']
+    assert forecast['writes'][ibex.secondaryPath()] == forecast['backupBytes']
+    assert forecast['phases'] == {} and forecast['seconds'] is None
+    # Both copies land on one filesystem here, with the margin on top
+    assert len(forecast['devices']) == 1
+    device = forecast['devices'][0]
+    assert device['needed'] == int(2 * forecast['backupBytes'] * (1 + ibex.forecastMargin / 100.0))
+
+
+def test_catalog_sizes_and_growth(ibex, history):
+    now = time.time()
+    for day in range(5):
+        created = now - (5 - day) * 86400
+        ibex.catalogQuery('INSERT INTO backups (id, type, state, size, created) VALUES (?, ?, ?, ?, ?)',
+                          ('full-' + str(day), 'full', 'completed', 1024 * (day + 1), created))
+    forecast = ibex.forecastRun('full', copy=False)
+    assert forecast['basis'].startswith('5 earlier backups')
+    assert forecast['backupBytes'] == pytest.approx(6 * 1024 * 1024, rel=0.01)
+    assert forecast['growthPerDay'] == pytest.approx(1024 * 1024, rel=0.01)
+    assert ibex.secondaryPath() not in forecast['writes']
+
+
+def test_phases_scaled_and_unsampled_skipped(ibex, history):
+    (ibex.root / 'data' / 'ibdata1').write_bytes(b'\0' * 1024 * 1024)
+    backupBytes = ibex.forecastRun('inc')['backupBytes']
+    addRuns(history / 'stats-history', [
+        {'backupType': 'inc', 'status': 'ok', 'phases': {
+            'backup': {'bytes': backupBytes // 2, 'seconds': 10.0},
+            'copy': {'seconds': 4.0},
+            # Never finished in any run, so no time to go on
+            'transfer': {'status': 'failed'}}},
+        {'backupType': 'inc', 'status': 'ok', 'phases': {
+            'backup': {'bytes': backupBytes // 2, 'seconds': 20.0},
+            'copy': {'seconds': 6.0}}},
+        {'backupType': 'inc', 'status': 'failed', 'phases': {'backup': {'bytes': 1, 'seconds': 1000.0}}},
+        {'backupType': 'full', 'status': 'ok', 'phases': {'backup': {'bytes': 1, 'seconds': 1000.0}}},
+    ])
+    forecast = ibex.forecastRun('inc')
+    assert list(forecast['phases']) == ['backup', 'copy']
+    assert forecast['phases']['backup'] == pytest.approx(30.0, abs=0.2)
+    assert forecast['phases']['copy'] == pytest.approx(10.0, abs=0.2)
+    assert forecast['seconds'] == pytest.approx(40.0, abs=0.3)
+
+
+def test_sharded_archive_staging(ibex, history, monkeypatch):
+    monkeypatch.setattr(ibex, 'archivePartSize', 1024 * 1024)
+    monkeypatch.setattr(ibex, 'archiveWorkers', 2)
+    (ibex.root / 'data' / 'ibdata1').write_bytes(b'\0' * 8 * 1024 * 1024)
+    forecast = ibex.forecastRun('lastinc')
+    staging = [location for location in forecast['writes'] if location.endswith('.part-*')]
+    assert len(staging) == 1
+    archive = staging[0][:-len('.part-*')]
+    assert forecast['writes'][staging[0]] == min(3 * 1024 * 1024, forecast['writes'][archive])
+
+
+def test_dry_run_leaves_no_catalog(ibex, history, monkeypatch):
+    monkeypatch.setattr(ibex.args, 'dryrun', True)
+    ibex.forecastRun('full')
+    assert not (history / 'catalog.db').exists()
@@ -0,0 +1,49 @@
+import pytest
+
+
+def test_knee_is_fewest_threads_near_best(ibex):
+    assert ibex.kneeOf({1: 100.0, 2: 190.0, 4: 290.0, 8: 300.0, 16: 305.0}) == 4
+    assert ibex.kneeOf({1: 100.0, 2: 101.0, 4: 99.0}) == 1
+
+
+def test_knee_ignores_dips(ibex):
+    # Contention past the knee does not matter, only the best result does
+    assert ibex.kneeOf({1: 50.0, 2: 200.0, 4: 120.0, 8: 80.0}) == 2
+
+
+def test_knee_single_result(ibex):
+    assert ibex.kneeOf({4: 10.0}) == 4
+
+
+@pytest.mark.parametrize('available, total, share, limit, expected', [
+    # Half of what is free
+    (4000, 64000, 25, 65536, 2000),
+    # No more than the share of the host
+    (60000, 64000, 25, 65536, 16000),
+    # No more than useMemoryMax
+    (60000, 64000, 50, 4096, 4096),
+    # Never below 128 MB
+    (100, 64000, 25, 4096, 128),
+])
+def test_memory_budget(ibex, monkeypatch, available, total, share, limit, expected):
+    monkeypatch.setattr(ibex, 'useMemoryShare', share)
+    monkeypatch.setattr(ibex, 'useMemoryMax', limit)
+    assert ibex.memoryBudget({'MemAvailable': available, 'MemTotal': total}) == expected
+
+
+def test_memory_sized_per_run(ibex, monkeypatch):
+    monkeypatch.setitem(ibex.resourceProfile, 'source', dict(ibex.resourceProfile['source'], useMemory='host'))
+    monkeypatch.setitem(ibex.resourceProfile, 'useMemory', 0)
+    monkeypatch.setitem(ibex.resourceProfile, 'availableMB', 0)
+    monkeypatch.setattr(ibex, 'prepareOptions', '')
+    monkeypatch.setattr(ibex, 'useMemoryShare', 100)
+    monkeypatch.setattr(ibex, 'useMemoryMax', 65536)
+    monkeypatch.setattr(ibex, 'readMemory', lambda: {'MemAvailable': 3000, 'MemTotal': 8000})
+    ibex.sizeMemory()
+    assert ibex.resourceProfile['useMemory'] == 1500
+    assert ibex.prepareOptions == ' --use-memory=1500M'
+
+    # Less free memory at the next run gives a smaller buffer pool
+    monkeypatch.setattr(ibex, 'readMemory', lambda: {'MemAvailable': 1000, 'MemTotal': 8000})
+    ibex.sizeMemory()
+    assert ibex.prepareOptions == ' --use-memory=500M'
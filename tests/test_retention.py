@@ -0,0 +1,43 @@
+import datetime
+
+
+def chains(days, start=datetime.datetime(2024, 3, 31, 1, 0), hours=(1,)):
+    # One chain per day (or per hour listed) going back from start
+    chainTimes = {}
+    for day in range(days):
+        for hour in hours:
+            stamp = (start - datetime.timedelta(days=day)).replace(hour=hour).strftime('%Y-%m-%d_%H-%M-%S')
+            chainTimes[stamp] = stamp
+    return chainTimes
+
+
+def test_daily_keeps_newest_days(ibex):
+    keep = ibex.retainedChains(chains(10), 3, 0, 0)
+    assert keep == {'2024-03-31_01-00-00', '2024-03-30_01-00-00', '2024-03-29_01-00-00'}
+
+
+def test_one_chain_per_day(ibex):
+    keep = ibex.retainedChains(chains(5, hours=(1, 13)), 2, 0, 0)
+    assert keep == {'2024-03-31_13-00-00', '2024-03-30_13-00-00'}
+
+
+def test_weekly_uses_iso_weeks(ibex):
+    # 2024-03-31 is a Sunday, so the newest of the week before is Sunday 24th
+    keep = ibex.retainedChains(chains(30), 0, 2, 0)
+    assert keep == {'2024-03-31_01-00-00', '2024-03-24_01-00-00'}
+
+
+def test_monthly_and_overlap(ibex):
+    keep = ibex.retainedChains(chains(70), 1, 0, 3)
+    assert keep == {'2024-03-31_01-00-00', '2024-02-29_01-00-00', '2024-01-31_01-00-00'}
+
+
+def test_gaps_do_not_count(ibex):
+    # Days without a chain are skipped, not counted
+    chainTimes = chains(1)
+    chainTimes.update(chains(1, start=datetime.datetime(2024, 3, 20, 1, 0)))
+    assert ibex.retainedChains(chainTimes, 2, 0, 0) == set(chainTimes)
+
+
+def test_nothing_retained(ibex):
+    assert ibex.retainedChains(chains(5), 0, 0, 0) == set()
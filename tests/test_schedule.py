@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+
+def local(year, month, day, hour, minute):
+    return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+
+
+def test_parse_days_and_times(ibex):
+    assert ibex.parseSchedule('* 03:00') == (set(range(7)), [(3, 0)])
+    assert ibex.parseSchedule('Mon-Fri 13:00,01:30') == ({0, 1, 2, 3, 4}, [(1, 30), (13, 0)])
+    assert ibex.parseSchedule('mon,Wed,sun 2:05') == ({0, 2, 6}, [(2, 5)])
+
+
+@pytest.mark.parametrize('spec', ['03:00', 'Funday 03:00', 'Mon 3h', 'Mon-Fri 01:00 extra'])
+def test_parse_rejects_bad_specs(ibex, spec):
+    with pytest.raises(ValueError):
+        ibex.parseSchedule(spec)
+
+
+def test_next_run_later_today(ibex):
+    schedule = ibex.parseSchedule('Mon-Fri 01:30,13:00')
+    # 2024-03-29 is a Friday
+    assert ibex.nextRun(schedule, local(2024, 3, 29, 12, 0)) == local(2024, 3, 29, 13, 0)
+
+
+def test_next_run_skips_weekend(ibex):
+    schedule = ibex.parseSchedule('Mon-Fri 01:30,13:00')
+    assert ibex.nextRun(schedule, local(2024, 3, 29, 14, 0)) == local(2024, 4, 1, 1, 30)
+
+
+def test_next_run_is_strictly_after(ibex):
+    schedule = ibex.parseSchedule('Fri 13:00')
+    assert ibex.nextRun(schedule, local(2024, 3, 29, 13, 0)) == local(2024, 4, 5, 13, 0)
+
+
+def test_next_run_crosses_month_and_year(ibex):
+    schedule = ibex.parseSchedule('* 00:15')
+    assert ibex.nextRun(schedule, local(2024, 12, 31, 23, 0)) == local(2025, 1, 1, 0, 15)
+
+
+def test_next_run_without_days(ibex):
+    assert ibex.nextRun((set(), [(1, 0)]), local(2024, 3, 29, 12, 0)) is None
@@ -0,0 +1,109 @@
+import glob
+import gzip
+import io
+import os
+import random
+import tarfile
+
+import pytest
+
+
+@pytest.fixture
+def sharded(ibex, monkeypatch):
+    monkeypatch.setattr(ibex, 'archivePartSize', 32 * 1024)
+    monkeypatch.setattr(ibex, 'archiveChunkSize', 16 * 1024)
+    monkeypatch.setattr(ibex, 'archiveWorkers', 2)
+    monkeypatch.setattr(ibex, 'cpuBudget', 0)
+
+
+def tree(root):
+    rng = random.Random(1)
+    files = {}
+    for schema in ['db1', 'db2', 'mysql']:
+        for table in range(4):
+            name = '{0}/t{1}.ibd'.format(schema, table)
+            files[name] = rng.randbytes(rng.randint(1, 40 * 1024))
+    files['ibdata1'] = rng.randbytes(100 * 1024)
+    for (name, data) in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return files
+
+
+@pytest.fixture
+def archive(ibex, sharded, tmp_path, monkeypatch):
+    source = tmp_path / 'backup'
+    files = tree(source)
+    path = str(tmp_path / 'backup.tar.gz')
+
+    # Count the staged part files whenever one is appended
+    staged = []
+    append = ibex.ShardedArchive.append
+
+    def counting(self, out, partFile):
+        staged.append(len(glob.glob(path + '.part-*')))
+        return append(self, out, partFile)
+    monkeypatch.setattr(ibex.ShardedArchive, 'append', counting)
+
+    writer = ibex.ShardedArchive(path, 'gzip', 1)
+    writer.build(str(source))
+    writer.saveSidecars(path)
+    return {'path': path, 'source': source, 'files': files, 'writer': writer, 'staged': staged,
+            'index': ibex.archiveIndex(path)}
+
+
+def test_index_covers_every_file(ibex, archive):
+    index = archive['index']
+    writer = archive['writer']
+    assert index['codec'] == 'gzip'
+    assert len(index['parts']) > 5
+    assert set(archive['files']) <= set(index['files'])
+    # Parts follow each other in the archive and their chunks add up
+    offsets = [part['offset'] for part in index['parts']]
+    assert offsets == sorted(offsets) and offsets[0] == 0
+    assert sum(index['chunks']) == writer.compressedBytes == os.path.getsize(archive['path'])
+    assert writer.rawBytes == sum(part['rawBytes'] for part in index['parts'])
+    for (name, (number, start, end)) in index['files'].items():
+        assert 0 <= number < len(index['parts'])
+        assert 0 <= start < end <= index['parts'][number]['rawBytes']
+
+
+def test_staged_parts_are_bounded(ibex, archive):
+    assert len(archive['staged']) == len(archive['index']['parts'])
+    assert max(archive['staged']) <= ibex.partsInFlight(archive['writer'].workers)
+    assert glob.glob(archive['path'] + '.part-*') == []
+
+
+def test_whole_archive_unpacks_with_tar(ibex, archive, tmp_path):
+    data = gzip.decompress(open(archive['path'], 'rb').read())
+    prefix = str(archive['source']).lstrip('/')
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:', ignore_zeros=True) as tar:
+        members = dict((member.name, member) for member in tar.getmembers() if member.isfile())
+        for (name, content) in archive['files'].items():
+            assert tar.extractfile(members[prefix + '/' + name]).read() == content
+
+
+def test_matching_files(ibex):
+    index = {'files': {'ibdata1': [0, 0, 1], 'db1': [0, 1, 2], 'db1/t1.ibd': [0, 2, 3],
+                       'db1/t2.ibd': [1, 0, 1], 'db2/t1.ibd': [1, 1, 2], 'mysql/user.MYD': [1, 2, 3]}}
+    assert sorted(ibex.matchingFiles(index, ['db1'])) == ['db1', 'db1/t1.ibd', 'db1/t2.ibd']
+    assert sorted(ibex.matchingFiles(index, ['/db1/'])) == ['db1', 'db1/t1.ibd', 'db1/t2.ibd']
+    assert sorted(ibex.matchingFiles(index, ['*/t1.ibd'])) == ['db1/t1.ibd', 'db2/t1.ibd']
+    assert sorted(ibex.matchingFiles(index, ['ibdata1', 'mysql/*'])) == ['ibdata1', 'mysql/user.MYD']
+    assert ibex.matchingFiles(index, ['db3']) == []
+
+
+def test_extract_single_files(ibex, archive, tmp_path):
+    names = ibex.matchingFiles(archive['index'], ['db2/t1.ibd', 'mysql'])
+    target = tmp_path / 'restore'
+    target.mkdir()
+    strip = len(str(archive['source']).strip('/').split('/'))
+    readBytes = ibex.extractFiles(archive['path'], 'gzip', archive['index'], str(target), strip, names)
+
+    assert readBytes < os.path.getsize(archive['path'])
+    assert (target / 'db2' / 't1.ibd').read_bytes() == archive['files']['db2/t1.ibd']
+    for table in range(4):
+        name = 'mysql/t{0}.ibd'.format(table)
+        assert (target / name).read_bytes() == archive['files'][name]
+    assert not (target / 'db1').exists()
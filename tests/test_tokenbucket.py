@@ -0,0 +1,41 @@
+import pytest
+
+
+@pytest.fixture
+def sleeps(ibex, monkeypatch):
+    waits = []
+    monkeypatch.setattr(ibex.time, 'sleep', waits.append)
+    return waits
+
+
+def test_unlimited_never_waits(ibex, sleeps):
+    bucket = ibex.TokenBucket(0)
+    for _ in range(100):
+        bucket.consume(1024 * 1024)
+    assert sleeps == []
+    assert not bucket.limited()
+
+
+def test_rate_limits_throughput(ibex, sleeps):
+    bucket = ibex.TokenBucket(1024)
+    bucket.consume(512 * 1024)
+    assert len(sleeps) == 1
+    assert sleeps[0] == pytest.approx(0.5, abs=0.05)
+
+
+def test_override_file_changes_rate(ibex, sleeps, tmp_path):
+    overrideFile = tmp_path / 'bwlimit'
+    overrideFile.write_text('0\n')
+    bucket = ibex.TokenBucket(1024, str(overrideFile))
+    bucket.consume(10 * 1024 * 1024)
+    assert bucket.rate == 0
+    assert sleeps == []
+
+
+def test_parent_limits_child(ibex, sleeps):
+    parent = ibex.TokenBucket(1024)
+    child = ibex.TokenBucket(0, parent=parent)
+    assert child.limited()
+    child.consume(256 * 1024)
+    assert len(sleeps) == 1
+    assert sleeps[0] == pytest.approx(0.25, abs=0.05)